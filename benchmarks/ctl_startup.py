@@ -0,0 +1,143 @@
+"""
+Startup benchmark of aiovisorctl: scripts call it in loops so its
+invocations must stay fast. Results are written as JSON to track
+regressions over time.
+
+Usage:
+
+    python benchmarks/ctl_startup.py --runs 20 --max-ms 50 -o results.json
+
+It measures:
+
+* wall time of ``aiovisorctl --help`` (``python -m aiovisor.ctl``), compared
+  with the server command line (``python -m aiovisor.server.cli``)
+* wall time of ``aiovisorctl status`` against a server with ``--procs``
+  programs listening on a Unix socket
+* cumulative import time of ``aiovisor.ctl`` (``python -X importtime``)
+* the server dependencies imported by ``aiovisor.ctl`` (must be none)
+
+With ``--max-ms`` it exits with an error if the median ``aiovisorctl
+status`` is slower.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+
+
+HEAVY_MODULES = ("aiohttp", "aiohttp_sse", "asyncio", "blinker", "psutil")
+
+
+def percentiles(values):
+    values = sorted(values)
+    last = len(values) - 1
+    return dict(
+        count=len(values),
+        mean=statistics.fmean(values),
+        p50=values[int(last * 0.5)],
+        p90=values[int(last * 0.9)],
+        max=values[-1],
+    )
+
+
+def wall_times(args, runs):
+    """Wall times (ms) of running python *args* *runs* times"""
+    command = [sys.executable, *args]
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+        times.append((time.perf_counter() - start) * 1000)
+    return percentiles(times)
+
+
+def import_time(module):
+    """Cumulative import time (ms) of the module"""
+    command = [sys.executable, "-X", "importtime", "-c", f"import {module}"]
+    stderr = subprocess.run(command, capture_output=True, text=True).stderr
+    for line in stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = [field.strip() for field in line.split("|")]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1]) / 1000
+
+
+def imported_heavy_modules(module):
+    code = (
+        f"import sys, {module};"
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    output = subprocess.check_output([sys.executable, "-c", code], text=True)
+    return [name for name in output.strip().split(",") if name]
+
+
+def status_times(nprocs, runs):
+    """Wall times of ``aiovisorctl status`` against a server on a Unix socket"""
+    with tempfile.TemporaryDirectory() as directory:
+        config = os.path.join(directory, "aiovisor.toml")
+        path = os.path.join(directory, "aiovisor.sock")
+        with open(config, "w") as fobj:
+            fobj.write(f'[web.unix]\npath = "{path}"\n')
+            for i in range(nprocs):
+                fobj.write(f'[programs.bench-{i}]\ncommand = "sleep 3600"\n')
+        server = subprocess.Popen(
+            [sys.executable, "-m", "aiovisor.server.cli", "-c", config],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            ctl = ["-m", "aiovisor.ctl", "-s", path, "status"]
+            for _ in range(100):
+                if os.path.exists(path):
+                    break
+                time.sleep(0.1)
+            subprocess.run([sys.executable, *ctl], stdout=subprocess.DEVNULL)
+            return wall_times(ctl, runs)
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--procs", type=int, default=10)
+    parser.add_argument("--max-ms", type=float, default=None)
+    parser.add_argument("-o", "--output", default="benchmark-ctl-startup.json")
+    args = parser.parse_args(args)
+    results = dict(
+        timestamp=time.time(),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        args=vars(args),
+        python_startup=wall_times(["-c", "pass"], args.runs),
+        ctl_help=wall_times(["-m", "aiovisor.ctl", "--help"], args.runs),
+        ctl_status=status_times(args.procs, args.runs),
+        server_help=wall_times(["-m", "aiovisor.server.cli", "--help"], args.runs),
+        ctl_import_time=import_time("aiovisor.ctl"),
+        ctl_heavy_imports=imported_heavy_modules("aiovisor.ctl"),
+    )
+    with open(args.output, "w") as fobj:
+        json.dump(results, fobj, indent=2)
+    median = results["ctl_status"]["p50"]
+    print(
+        f"aiovisorctl status: {median:.1f}ms,"
+        f" --help: {results['ctl_help']['p50']:.1f}ms"
+        f" (python alone: {results['python_startup']['p50']:.1f}ms,"
+        f" server --help: {results['server_help']['p50']:.1f}ms)"
+    )
+    print(f"Results written to {args.output}")
+    if results["ctl_heavy_imports"]:
+        sys.exit(f"aiovisor.ctl imports {', '.join(results['ctl_heavy_imports'])}")
+    if args.max_ms is not None and median > args.max_ms:
+        sys.exit(f"aiovisorctl is too slow: {median:.1f}ms > {args.max_ms}ms")
+
+
+if __name__ == "__main__":
+    main()
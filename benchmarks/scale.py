@@ -0,0 +1,229 @@
+"""
+Scale benchmark: supervise N synthetic programs and measure the supervision
+and web paths. Results are written as JSON to track regressions over time.
+
+Usage:
+
+    python benchmarks/scale.py -n 10 100 1000 --clients 10 -o results.json
+
+For each N it measures:
+
+* time for all programs to be Running and ``stop()`` wall time
+* spawn latency percentiles
+* ``/api/processes`` and ``/`` latency (sequential and concurrent requests)
+* ws and SSE fan-out to M clients while all programs are restarted
+* supervisor RSS and CPU time
+"""
+
+import json
+import time
+import asyncio
+import argparse
+import platform
+import resource
+import statistics
+
+import psutil
+from aiohttp import ClientSession, WSMsgType
+from aiohttp.test_utils import TestServer
+
+from aiovisor.server.config import parse_raw_config
+from aiovisor.server.core import AIOVisor
+from aiovisor.server.process import ProcessState
+from aiovisor.server.web.app import web_app
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    last = len(values) - 1
+    return dict(
+        count=len(values),
+        mean=statistics.fmean(values),
+        p50=values[int(last * 0.5)],
+        p90=values[int(last * 0.9)],
+        p99=values[int(last * 0.99)],
+        max=values[-1],
+    )
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def make_config(nprocs, command, startsecs):
+    programs = {
+        f"bench-{i}": dict(command=command, startsecs=startsecs, tags=["bench"])
+        for i in range(nprocs)
+    }
+    return parse_raw_config({"programs": programs})
+
+
+async def wait_all(aiovisor, state, timeout):
+    stop = time.perf_counter() + timeout
+    while time.perf_counter() < stop:
+        if all(proc.state == state for proc in aiovisor.procs.values()):
+            return True
+        await asyncio.sleep(0.01)
+    return False
+
+
+async def request_latency(session, path, requests, concurrency):
+    """Latencies of *requests* GET of *path*, *concurrency* at a time"""
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def get():
+        async with semaphore:
+            start = time.perf_counter()
+            async with session.get(path) as response:
+                await response.read()
+                response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(get() for _ in range(requests)))
+    duration = time.perf_counter() - start
+    return dict(percentiles(latencies), throughput=requests / duration)
+
+
+async def ws_client(session, counts, index):
+    async with session.ws_connect("/api/ws") as ws:
+        counts[index] = 0
+        async for msg in ws:
+            if msg.type != WSMsgType.TEXT:
+                break
+            counts[index] += 1
+
+
+async def sse_client(session, counts, index):
+    async with session.get("/processes/table/events") as response:
+        counts[index] = 0
+        async for line in response.content:
+            if line.startswith(b"event:"):
+                counts[index] += 1
+
+
+async def fan_out(aiovisor, session, clients, client, settle):
+    """
+    Connect *clients* clients and restart all programs: returns the events
+    received by the clients and the delivery rate
+    """
+    counts = {}
+    tasks = [
+        asyncio.create_task(client(session, counts, i)) for i in range(clients)
+    ]
+    while len(counts) < clients:
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(settle)
+    start = time.perf_counter()
+    await aiovisor.bulk("restart", list(aiovisor.procs.values()))
+    # let the last events be delivered
+    last, total = -1, sum(counts.values())
+    while total != last:
+        last = total
+        await asyncio.sleep(settle)
+        total = sum(counts.values())
+    duration = time.perf_counter() - start - settle
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return dict(
+        clients=clients,
+        events=total,
+        events_per_client=percentiles(list(counts.values())),
+        duration=duration,
+        events_per_second=total / duration if duration > 0 else None,
+    )
+
+
+def supervisor_usage(me):
+    with me.oneshot():
+        cpu = me.cpu_times()
+        return dict(
+            rss=me.memory_info().rss,
+            cpu_user=cpu.user,
+            cpu_system=cpu.system,
+            num_fds=me.num_fds(),
+        )
+
+
+async def run(nprocs, args):
+    me = psutil.Process()
+    result = dict(procs=nprocs, usage_before=supervisor_usage(me))
+    aiovisor = AIOVisor(make_config(nprocs, args.command, args.startsecs))
+    app = await web_app(aiovisor)
+    # the web app starts the programs on startup
+    start = time.perf_counter()
+    async with TestServer(app) as server:
+        running = await wait_all(aiovisor, ProcessState.Running, args.timeout)
+        result["all_running"] = running
+        result["start_time"] = time.perf_counter() - start
+        result["spawn_latency"] = percentiles(
+            [p.spawn_latency for p in aiovisor.procs.values() if p.spawn_latency]
+        )
+        result["usage_running"] = supervisor_usage(me)
+        async with ClientSession(str(server.make_url(""))) as session:
+            for name, path in (("api_processes", "/api/processes"), ("index", "/")):
+                result[name] = dict(
+                    sequential=await request_latency(session, path, args.requests, 1),
+                    concurrent=await request_latency(
+                        session, path, args.requests, args.concurrency
+                    ),
+                )
+            for name, client in (("ws", ws_client), ("sse", sse_client)):
+                result[f"{name}_fan_out"] = await fan_out(
+                    aiovisor, session, args.clients, client, args.settle
+                )
+        result["usage_loaded"] = supervisor_usage(me)
+        start = time.perf_counter()
+        await aiovisor.stop()
+        result["stop_time"] = time.perf_counter() - start
+    return result
+
+
+async def main_loop(args):
+    raise_fd_limit()
+    results = dict(
+        timestamp=time.time(),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        cpu_count=psutil.cpu_count(),
+        args=vars(args),
+        runs=[],
+    )
+    for nprocs in args.procs:
+        print(f"Running with {nprocs} programs...", flush=True)
+        run_result = await run(nprocs, args)
+        print(
+            f"  all running in {run_result['start_time']:.3f}s,"
+            f" stopped in {run_result['stop_time']:.3f}s",
+            flush=True,
+        )
+        results["runs"].append(run_result)
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("-n", "--procs", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--command", default="sleep 3600")
+    parser.add_argument("--startsecs", type=float, default=0.1)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--clients", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--settle", type=float, default=0.5)
+    parser.add_argument("-o", "--output", default="benchmark-scale.json")
+    args = parser.parse_args(args)
+    results = asyncio.run(main_loop(args))
+    with open(args.output, "w") as fobj:
+        json.dump(results, fobj, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,43 +1,232 @@
 import json
+import asyncio
+
 import aiohttp
 
+from .util import log, AIOVisorError
+
+
+log = log.getChild("client")
+
+CLIENT_ERRORS = (AIOVisorError, aiohttp.ClientError, asyncio.TimeoutError)
+
+
+async def check(response, method, path):
+    if response.status >= 400:
+        text = await response.text()
+        raise AIOVisorError(f"{method} {path}: {response.status} {text}")
+
+
+def next_event(event, since):
+    """
+    (event to yield, seq of the last event) of an event received after
+    event *since*. A gap in the seq numbers becomes a resync event and an
+    event already received is skipped (None).
+    """
+    seq = event.get("seq")
+    if seq is None:
+        return event, since
+    if since is not None and event["event_type"] != "resync":
+        if seq <= since:
+            return None, since
+        if seq > since + 1:
+            log.warning("Missed events %d to %d", since + 1, seq - 1)
+            event = dict(event_type="resync", seq=seq)
+    return event, seq
+
 
 class AIOVisor:
-    def __init__(self, base_url):
-        self.base_url = base_url
-        self.client = aiohttp.ClientSession()
+    """
+    Async client of the aiovisor web API.
+
+    Requests share a pool of keep-alive connections (at most *limit*
+    connections, idle ones closed after *keepalive_timeout* seconds). If
+    *unix_socket* is given requests go through that Unix socket instead of
+    TCP (*base_url* is then only used for the Host header).
+
+    Use it as an async context manager::
+
+        async with AIOVisor("http://localhost:8080") as client:
+            await client.start_many(["web-1", "web-2"], concurrency=10)
+            async for event in client.events():
+                print(event)
+    """
+
+    def __init__(
+        self,
+        base_url="http://localhost",
+        unix_socket=None,
+        limit=100,
+        keepalive_timeout=30,
+        timeout=60,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.unix_socket = unix_socket
+        self.limit = limit
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self.session = None
 
     async def __aenter__(self):
+        await self.open()
         return self
 
     async def __aexit__(self, ext_type, exc_value, tb):
-        await self.aclose()
+        await self.close()
+
+    async def open(self):
+        if self.session is not None:
+            return
+        options = dict(limit=self.limit, keepalive_timeout=self.keepalive_timeout)
+        if self.unix_socket is None:
+            connector = aiohttp.TCPConnector(**options)
+        else:
+            connector = aiohttp.UnixConnector(path=str(self.unix_socket), **options)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
 
-    async def aclose(self):
-        await self.client.aclose()
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
 
-    async def stream(self):
-        async with self.client.stream("GET", "/api/stream", timeout=None) as stream:
-            async for chunk in stream.aiter_bytes():
-                if chunk.startswith(b"data:"):
-                    yield json.loads(chunk[5:])
+    def url(self, path):
+        return f"{self.base_url}{path}"
+
+    async def request(self, method, path, **params):
+        """JSON result of the API request (None parameters are not sent)"""
+        if self.session is None:
+            await self.open()
+        params = {key: value for key, value in params.items() if value is not None}
+        url = self.url(path)
+        async with self.session.request(method, url, params=params) as response:
+            await check(response, method, path)
+            return await response.json()
 
     async def state(self):
-        response = await self.client.get(f"{self.base_url}/api/state")
-        return await response.json()
+        return await self.request("GET", "/api/state")
+
+    async def processes(self, state=None, tag=None, match=None, fields=None):
+        if fields is not None and not isinstance(fields, str):
+            fields = ",".join(fields)
+        return await self.request(
+            "GET", "/api/processes", state=state, tag=tag, match=match, fields=fields
+        )
 
-    async def processes(self):
-        response = await self.client.get(f"{self.base_url}/api/processes")
-        return await response.json()
+    async def snapshot(self):
+        """
+        (seq, processes): info of all processes and the number of the last
+        event they include (see events())
+        """
+        if self.session is None:
+            await self.open()
+        async with self.session.get(self.url("/api/processes")) as response:
+            await check(response, "GET", "/api/processes")
+            seq = int(response.headers["X-Aiovisor-Seq"])
+            return seq, await response.json()
 
     async def process_info(self, name):
-        response = await self.client.get(f"{self.base_url}/api/process/info/{name}")
-        return await response.json()
+        return await self.request("GET", f"/api/process/info/{name}")
 
     async def process_start(self, name):
-        response = await self.client.post(f"{self.base_url}/api/process/start/{name}")
-        return await response.json()
+        return await self.request("POST", f"/api/process/start/{name}")
 
     async def process_stop(self, name):
-        response = await self.client.post(f"{self.base_url}/api/process/stop/{name}")
-        return await response.json()
+        return await self.request("POST", f"/api/process/stop/{name}")
+
+    async def process_kill(self, name):
+        return await self.request("POST", f"/api/process/kill/{name}")
+
+    async def process_log(self, name, tail=None, stream=None):
+        """Last lines of the output of the process (text)"""
+        if self.session is None:
+            await self.open()
+        path = f"/api/process/{name}/log"
+        params = dict(tail=tail, stream=stream)
+        params = {key: value for key, value in params.items() if value is not None}
+        async with self.session.get(self.url(path), params=params) as response:
+            await check(response, "GET", path)
+            return await response.text()
+
+    async def group_action(self, tag, action, concurrency=None, batch_size=None):
+        """Server side bulk action on the processes with the given tag"""
+        return await self.request(
+            "POST",
+            f"/api/group/{tag}/{action}",
+            concurrency=concurrency,
+            batch_size=batch_size,
+        )
+
+    async def reload(self):
+        return await self.request("POST", "/api/reload")
+
+    async def scale(self, pool, numprocs):
+        return await self.request("POST", f"/api/pool/{pool}/scale/{numprocs}")
+
+    async def _many(self, func, names, concurrency):
+        """
+        Run func(name) for all names, *concurrency* at a time. Returns a map
+        of name to the result or to the error raised
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(name):
+            async with semaphore:
+                try:
+                    return await func(name)
+                except CLIENT_ERRORS as error:
+                    return dict(result="ERROR", error=str(error))
+
+        results = await asyncio.gather(*(run(name) for name in names))
+        return dict(zip(names, results))
+
+    async def start_many(self, names, concurrency=10):
+        return await self._many(self.process_start, list(names), concurrency)
+
+    async def stop_many(self, names, concurrency=10):
+        return await self._many(self.process_stop, list(names), concurrency)
+
+    async def events(
+        self, since=None, reconnect=True, reconnect_delay=1.0, max_reconnect_delay=30.0
+    ):
+        """
+        Async iterator over the /api/ws events following event *since*.
+        When the connection is lost it reconnects (with exponential delay)
+        and resumes from the last event received. A ``resync`` event means
+        some events were missed and the whole state must be fetched again:
+        it is also yielded (instead of the event) when the ``seq`` numbers
+        have a gap, as the server discards events for slow clients.
+
+        With *reconnect* false it stops (or raises the connection error)
+        when the connection is lost instead.
+        """
+        if self.session is None:
+            await self.open()
+        delay = reconnect_delay
+        while True:
+            params = {} if since is None else {"since": since}
+            try:
+                async with self.session.ws_connect(
+                    self.url("/api/ws"),
+                    params=params,
+                    timeout=aiohttp.ClientWSTimeout(ws_close=None),
+                    heartbeat=30,
+                ) as ws:
+                    delay = reconnect_delay
+                    async for message in ws:
+                        if message.type != aiohttp.WSMsgType.TEXT:
+                            break
+                        event, since = next_event(json.loads(message.data), since)
+                        if event is not None:
+                            yield event
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as error:
+                if not reconnect:
+                    raise
+                log.warning("Event stream error: %r", error)
+            if not reconnect:
+                return
+            log.info("Event stream closed. Reconnecting in %g seconds", delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_reconnect_delay)
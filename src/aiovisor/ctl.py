@@ -0,0 +1,297 @@
+"""
+aiovisorctl: command line control of a running aiovisor server.
+
+Scripts call it in loops so it must start fast: it only uses a few
+standard library modules and imports nothing from the server side
+(aiohttp, blinker, psutil...). Even http.client is too slow to import
+(email, ssl...): requests are sent with a minimal HTTP/1.1 client over TCP
+or a Unix socket. Keep it that way (see benchmarks/ctl_startup.py).
+
+Examples::
+
+    aiovisorctl status
+    aiovisorctl -s /run/aiovisor.sock restart "web-*"
+    aiovisorctl stop all
+    aiovisorctl tail -f worker-1
+"""
+
+import os
+import sys
+import time
+import argparse
+
+
+DEFAULT_URL = "http://localhost:8080"
+
+# unreserved URL characters (RFC 3986)
+SAFE = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~")
+
+
+class CtlError(Exception):
+    pass
+
+
+def quote(text, safe=""):
+    """Percent-encode text (urllib.parse is slow to import)"""
+    result = []
+    for char in str(text):
+        if char in SAFE or char in safe:
+            result.append(char)
+        else:
+            result.extend(f"%{byte:02X}" for byte in char.encode())
+    return "".join(result)
+
+
+class Response:
+    """Minimal HTTP/1.1 response reader"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.fobj = sock.makefile("rb")
+        status_line = self.fobj.readline().decode("latin-1")
+        if not status_line:
+            raise CtlError("Server closed the connection")
+        self.status = int(status_line.split()[1])
+        self.headers = {}
+        while (line := self.fobj.readline()) not in (b"\r\n", b"\n", b""):
+            key, _, value = line.decode("latin-1").partition(":")
+            self.headers[key.strip().lower()] = value.strip()
+        self.chunked = self.headers.get("transfer-encoding") == "chunked"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def close(self):
+        self.fobj.close()
+        self.sock.close()
+
+    def chunks(self):
+        if not self.chunked:
+            if (length := self.headers.get("content-length")) is not None:
+                yield self.fobj.read(int(length))
+            else:
+                yield self.fobj.read()
+            return
+        while size := int(self.fobj.readline().split(b";")[0], 16):
+            yield self.fobj.read(size)
+            self.fobj.readline()
+
+    def read(self):
+        return b"".join(self.chunks())
+
+    def lines(self):
+        buffer = b""
+        for chunk in self.chunks():
+            *lines, buffer = (buffer + chunk).split(b"\n")
+            for line in lines:
+                yield line + b"\n"
+        if buffer:
+            yield buffer
+
+
+class Control:
+    """Minimal synchronous client of the aiovisor web API"""
+
+    def __init__(self, url=DEFAULT_URL, unix_socket=None, timeout=60):
+        self.url = url
+        self.unix_socket = unix_socket
+        self.timeout = timeout
+        scheme, _, host = url.partition("://")
+        if scheme != "http":
+            raise CtlError(f"Unsupported URL {url!r} (only http:// is supported)")
+        self.host = host.split("/")[0] or "localhost"
+        name, sep, port = self.host.rpartition(":")
+        if not sep or "]" in port:
+            name, port = self.host, "80"
+        self.address = name.strip("[]"), int(port)
+
+    def connect(self):
+        import socket
+
+        if self.unix_socket is not None:
+            sock = socket.socket(socket.AF_UNIX)
+            sock.settimeout(self.timeout)
+            sock.connect(self.unix_socket)
+            return sock
+        return socket.create_connection(self.address, self.timeout)
+
+    def open(self, method, path, **params):
+        """Response to the API request (None parameters are not sent)"""
+        params = [
+            f"{quote(key)}={quote(value)}"
+            for key, value in params.items()
+            if value is not None
+        ]
+        path = "/api" + quote(path, safe="/")
+        if params:
+            path = f"{path}?{'&'.join(params)}"
+        request = (
+            f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\n"
+            "Connection: close\r\nContent-Length: 0\r\n\r\n"
+        )
+        try:
+            sock = self.connect()
+            sock.sendall(request.encode())
+            response = Response(sock)
+        except OSError as error:
+            where = self.unix_socket or self.url
+            raise CtlError(f"Cannot reach aiovisor at {where}: {error}") from None
+        if response.status >= 400:
+            with response:
+                text = response.read().decode(errors="replace")
+            raise CtlError(f"{method} {path}: {response.status} {text}")
+        return response
+
+    def request(self, method, path, **params):
+        import json
+
+        with self.open(method, path, **params) as response:
+            return json.loads(response.read())
+
+
+def format_uptime(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    uptime = f"{hours}:{minutes:02}:{seconds:02}"
+    return f"{days} days, {uptime}" if days else uptime
+
+
+def status(ctl, opts):
+    procs = ctl.request(
+        "GET",
+        "/processes",
+        fields="name,state,pid,start_time,last_error",
+        match=opts.match,
+        tag=opts.tag,
+        state=opts.state,
+    )
+    if opts.json:
+        import json
+
+        print(json.dumps(procs, indent=2))
+        return 0
+    width = max((len(name) for name in procs), default=0)
+    now = time.time()
+    for name, proc in procs.items():
+        if proc["pid"] is not None:
+            detail = f"pid {proc['pid']}, uptime "
+            detail += format_uptime(now - proc["start_time"])
+        else:
+            detail = proc["last_error"] or ""
+        print(f"{name:<{width}}  {proc['state']:<10} {detail}".rstrip())
+    return 0
+
+
+def action(ctl, opts):
+    """start, stop or restart the processes matching the names (or all)"""
+    patterns = [None] if "all" in opts.names else opts.names
+    results = {}
+    for pattern in patterns:
+        reply = ctl.request(
+            "POST", f"/processes/{opts.command}", match=pattern, tag=opts.tag
+        )
+        if not reply["processes"] and pattern is not None:
+            print(f"{pattern}: no such process", file=sys.stderr)
+            results[pattern] = dict(result="ERROR")
+        results.update(reply["processes"])
+    for name, result in sorted(results.items()):
+        if result["result"] == "ACK":
+            print(f"{name}: {result['state']}")
+        elif "error" in result:
+            print(f"{name}: ERROR {result['error']}", file=sys.stderr)
+    return 0 if all(r["result"] == "ACK" for r in results.values()) else 1
+
+
+def follow(response, output):
+    """Write the data of the server sent events of the response"""
+    data = []
+    for line in response.lines():
+        line = line.decode("utf-8", "replace").rstrip("\r\n")
+        if line.startswith("data:"):
+            data.append(line[6:] if line.startswith("data: ") else line[5:])
+        elif not line and data:
+            output.write("\n".join(data))
+            output.flush()
+            data = []
+
+
+def tail(ctl, opts):
+    """Last lines of the output of a process (and the next ones if following)"""
+    path = f"/process/{opts.name}/log"
+    if opts.follow:
+        with ctl.open(
+            "GET", f"{path}/follow", tail=opts.lines, stream=opts.stream
+        ) as response:
+            # the stream may stay idle for long
+            response.sock.settimeout(None)
+            follow(response, sys.stdout)
+        return 0
+    with ctl.open("GET", path, tail=opts.lines, stream=opts.stream) as response:
+        sys.stdout.buffer.write(response.read())
+    return 0
+
+
+COMMANDS = {
+    "status": status,
+    "start": action,
+    "stop": action,
+    "restart": action,
+    "tail": tail,
+}
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        prog="aiovisorctl", description="Control a running aiovisor server"
+    )
+    parser.add_argument(
+        "-u",
+        "--url",
+        default=os.environ.get("AIOVISOR_URL", DEFAULT_URL),
+        help="server URL [env: AIOVISOR_URL] (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-s",
+        "--unix-socket",
+        default=os.environ.get("AIOVISOR_SOCKET"),
+        help="connect through this Unix socket [env: AIOVISOR_SOCKET]",
+    )
+    parser.add_argument("-t", "--timeout", type=float, default=60)
+    commands = parser.add_subparsers(dest="command", required=True)
+    cmd = commands.add_parser("status", help="state of the processes")
+    cmd.add_argument("match", nargs="?", help="process name (glob pattern)")
+    cmd.add_argument("--tag")
+    cmd.add_argument("--state", help="ex: Running, Stopped, Fatal")
+    cmd.add_argument("--json", action="store_true")
+    for name in ("start", "stop", "restart"):
+        cmd = commands.add_parser(name, help=f"{name} processes")
+        cmd.add_argument(
+            "names", nargs="+", help="process names (glob patterns) or 'all'"
+        )
+        cmd.add_argument("--tag", help="only the processes with this tag")
+    cmd = commands.add_parser("tail", help="output of a process")
+    cmd.add_argument("name")
+    cmd.add_argument("-f", "--follow", action="store_true")
+    cmd.add_argument("-n", "--lines", type=int, default=10)
+    cmd.add_argument("--stream", default="stdout", choices=["stdout", "stderr"])
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    opts = parse_args(args)
+    try:
+        ctl = Control(opts.url, opts.unix_socket, opts.timeout)
+        return COMMANDS[opts.command](ctl, opts)
+    except CtlError as error:
+        print(f"aiovisorctl: {error}", file=sys.stderr)
+        return 2
+    except KeyboardInterrupt:
+        return 130
+
+
+if __name__ == "__main__":
+    sys.exit(main())
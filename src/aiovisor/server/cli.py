@@ -5,7 +5,9 @@ import logging.config
 from ..util import log
 from .web.app import run_app
 from .core import AIOVisor
-from .config import load_config
+from .config import load_config, load_federation_config
+from .federation import Fleet
+from .web.federation import run_federation
 
 
 def prepare_logging(config):
@@ -17,8 +19,8 @@ def prepare_logging(config):
 def run(config_file):
     config = load_config(config_file)
     prepare_logging(config)
-    aiovisor = AIOVisor(config)
-    run_app(aiovisor, config["web"].get("aiohttp", {}))
+    aiovisor = AIOVisor(config, config_file=config_file)
+    run_app(aiovisor, config["web"])
 
 
 def main(args=None):
@@ -28,5 +30,21 @@ def main(args=None):
     run(opts.config_file)
 
 
+def run_fleet(config_file):
+    config = load_federation_config(config_file)
+    logging.config.dictConfig(config["federation"]["logging"])
+    log.info("Starting federation...")
+    fleet = Fleet(config)
+    run_federation(fleet, config["web"])
+
+
+def federation_main(args=None):
+    """Aggregator of several aiovisor servers"""
+    parser = argparse.ArgumentParser(description=federation_main.__doc__)
+    parser.add_argument("-c", "--config-file", required=True, type=pathlib.Path)
+    opts = parser.parse_args(args=args)
+    run_fleet(opts.config_file)
+
+
 if __name__ == "__main__":
     main()
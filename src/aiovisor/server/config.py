@@ -3,6 +3,9 @@
 Example:
 
 ```toml
+[include]
+files = ["conf.d/*.toml"]  # relative to this file. Each may define programs
+
 [main]
 name = "aiovisor"
 pidfile = "/tmp/aiovisor.pid"
@@ -11,23 +14,111 @@ umask = 0o27
 user = "homer"
 group = "simpsons"
 directory = {here}
+max_concurrent_starts = 16  # 0 means unlimited
+max_concurrent_stops = 0
+bulk_concurrency = 20  # bulk (group/tag) operations. 0 means unlimited
+bulk_batch_size = 0  # rolling batches of bulk operations. 0 means a single batch
 
 [main.logging]
 config = "./aiovisor_logging.conf"
 
+[main.sampler]
+interval = 2.0
+expensive_interval = 60.0
+cheap = ["cmdline", "cpu_times", "memory_info", "num_threads"]
+expensive = ["open_files", "memory_full_info", "net_connections"]
+
+[main.health]
+workers = 16  # health checks run concurrently
+
+[main.instrumentation]
+loop_lag_interval = 0.5  # 0 disables the event loop lag monitor
+slow_threshold = 0.1  # log operations slower than this (seconds). 0 disables
+
+[web.aiohttp]  # TCP listener (default: port 8080). Omit it to serve only web.unix
+host = "127.0.0.1"
+port = 8080
+
+[web.unix]  # optional Unix socket listener (alongside TCP if web.aiohttp is set)
+path = "/run/aiovisor.sock"
+mode = 0o660  # access control through the socket file permissions
+
+[web.ws]
+queue_size = 1000
+slow_consumer = "coalesce"  # or "drop" or "disconnect"
+history_size = 1000  # events kept for clients resuming with ?since=<seq>
+
+[web.sse]
+coalesce_window = 0.1
+
 [program.web-server-lab01]
 command = "/bin/apache"
 name = "web server"
+priority = 100  # started in ascending and stopped in descending order
+depends_on = ["database"]
+autorestart = "unexpected"  # true, false or "unexpected" (exit code not in exitcodes)
+backoff_initial = 1.0  # delay = initial * factor ** (attempt - 1)
+backoff_factor = 2.0
+backoff_max = 60.0
+backoff_jitter = 0.1  # delay randomized by +/- 10%
 tags = ["web", "lab01"]
+stdout_capture_maxbytes = 65536  # 0 disables capture
+stdout_logfile = "/var/log/apache.log"
+stdout_logfile_maxbytes = 52428800  # 0 disables rotation
+stdout_logfile_backups = 10
+
+[program.worker]
+command = "/bin/worker --port 80{process_num}"
+numprocs = 4  # worker-0 ... worker-3
+numprocs_start = 0
+process_name = "{program_name}-{process_num}"
+environment = {WORKER_ID = "{process_num}"}
+# Running only once ready; Unhealthy after 3 consecutive failures
+healthcheck = {type = "http", port = "80{process_num}", path = "/health"}
+# healthcheck = {type = "tcp", host = "127.0.0.1", port = 80}
+# healthcheck = {type = "exec", command = "/bin/check-worker"}
+# other keys: interval = 10, timeout = 2, retries = 3, start_interval = 0.5,
+# start_timeout = 60, restart = true (restart when Unhealthy)
+
+[program.web-server-lab01.sampler]
+expensive = ["open_files"]
 
+```
+
+Federation (aggregator of several aiovisor servers, see ``aiovisor-federation``):
+
+```toml
+[federation]
+name = "fleet"
+reconnect_delay = 1.0  # doubled on each failure up to max_reconnect_delay
+max_reconnect_delay = 30.0
+
+[federation.nodes]
+lab01 = "http://lab01:8080"
+lab02 = {url = "http://lab02:8080", timeout = 10.0}
+local = {url = "http://localhost", unix_socket = "/run/aiovisor.sock"}
+
+[web.aiohttp]
+port = 8000
 ```
 """
 
+import os
+import glob
 import shlex
 import pathlib
 import platform
+import concurrent.futures
 
 from ..util import is_posix
+from .metrics import timed
+from .sampler import CHEAP_ATTRS, EXPENSIVE_ATTRS
+from .health import HEALTHCHECK_TYPES
+
+
+# what to do with a web client which cannot keep up with the events
+# (see aiovisor.server.web.bus.Subscriber)
+SLOW_CONSUMER_POLICIES = {"drop", "coalesce", "disconnect"}
 
 
 DEFAULT_LOG_CONFIG = {
@@ -72,26 +163,143 @@ def load_config_raw(filename):
         return load(fobj)
 
 
+CONFIG_EXTENSIONS = {".toml", ".yml", ".yaml", ".json", ".py"}
+
+# absolute path: ((mtime_ns, size), raw config). Cached configs must not be modified.
+# Only the files of the last loaded config tree are kept
+PARSE_CACHE = {}
+
+# threads used to parse included files
+PARSE_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+
+def file_key(filename):
+    stat = os.stat(filename)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def load_config_cached(filename, key=None):
+    """load_config_raw() which re-parses only if the file changed"""
+    path = os.path.abspath(filename)
+    suffix = os.path.splitext(path)[1]
+    if suffix not in CONFIG_EXTENSIONS:
+        raise ValueError(f"Unsupported file {suffix!r}")
+    if key is None:
+        key = file_key(path)
+    cached = PARSE_CACHE.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    config = load_config_raw(pathlib.Path(path))
+    PARSE_CACHE[path] = key, config
+    return config
+
+
+def forget_parsed(paths):
+    """Drop the cached configs of the files not in *paths*"""
+    for path in set(PARSE_CACHE).difference(paths):
+        del PARSE_CACHE[path]
+
+
+def included_files(directory, patterns):
+    """Files matching the include glob patterns (relative to *directory*)"""
+    files = {}
+    for pattern in patterns:
+        pattern = os.path.join(directory, os.path.expanduser(pattern))
+        for filename in sorted(glob.glob(pattern)):
+            files.setdefault(os.path.normpath(filename), None)
+    return list(files)
+
+
+def load_included(files):
+    """
+    Raw configs of the included files. Only files changed since they were
+    last parsed are parsed again, in parallel.
+    """
+    keys = {filename: file_key(filename) for filename in files}
+    changed = [
+        filename
+        for filename, key in keys.items()
+        if PARSE_CACHE.get(filename, (None,))[0] != key
+    ]
+    if len(changed) > 1:
+        with concurrent.futures.ThreadPoolExecutor(PARSE_WORKERS) as pool:
+            list(pool.map(load_config_cached, changed, (keys[f] for f in changed)))
+    return [load_config_cached(filename, keys[filename]) for filename in files]
+
+
+def merge_config(config, included, filename):
+    """Merge the sections of an *included* raw config into *config*"""
+    for section, values in included.items():
+        if section == "include":
+            raise ValueError(f"{filename}: nested includes are not supported")
+        target = config.setdefault(section, {})
+        for key, value in values.items():
+            if section == "programs" and key in target:
+                raise ValueError(f"{filename}: program {key!r} already defined")
+            target[key] = value
+
+
+def load_config_tree(filename):
+    """Raw config of the main file merged with the files it includes"""
+    main = load_config_cached(filename)
+    patterns = main.get("include", {}).get("files", [])
+    directory = os.path.dirname(os.path.abspath(filename))
+    files = included_files(directory, patterns)
+    # removed or no longer included files
+    forget_parsed([os.path.abspath(path) for path in [filename, *files]])
+    if not patterns:
+        return main
+    # don't modify the cached raw configs
+    config = {
+        section: dict(values) if isinstance(values, dict) else values
+        for section, values in main.items()
+    }
+    for path, included in zip(files, load_included(files)):
+        merge_config(config, included, path)
+    return config
+
+
 def config_program(name, cfg):
     result = dict(
         name=name,
+        priority=999,
+        depends_on=[],
         environment=None,
         directory=None,
         exitcodes=[0],
         startsecs=1,
         startretries=3,
+        autorestart=False,
+        backoff_initial=1.0,
+        backoff_factor=2.0,
+        backoff_max=60.0,
+        backoff_jitter=0.1,
         autostart=True,
         stopwaitsecs=10,
         user=None,
         umask=-1 if is_posix else None,
         resources={},
         shell=False,
+        sampler={},
+        stdout_capture_maxbytes=64 * 1024,
+        stderr_capture_maxbytes=64 * 1024,
+        stdout_logfile=None,
+        stdout_logfile_maxbytes=50 * 1024 * 1024,
+        stdout_logfile_backups=10,
+        stderr_logfile=None,
+        stderr_logfile_maxbytes=50 * 1024 * 1024,
+        stderr_logfile_backups=10,
+        healthcheck=None,
     )
     if is_posix:
         import signal
 
         result["stopsignal"] = signal.SIGTERM
     result.update(cfg)
+    if result["autorestart"] not in {True, False, "unexpected"}:
+        raise ValueError(f"Unsupported autorestart {result['autorestart']!r}")
+    if result["healthcheck"] is not None:
+        result["healthcheck"] = config_healthcheck(name, result["healthcheck"])
     cmd = result["command"]
     if isinstance(cmd, str):
         cmd = shlex.split(cmd)
@@ -100,8 +308,150 @@ def config_program(name, cfg):
     return result
 
 
+def config_healthcheck(name, cfg):
+    result = dict(
+        host="127.0.0.1",
+        path="/",
+        interval=10.0,
+        timeout=2.0,
+        retries=3,
+        start_interval=0.5,
+        start_timeout=60.0,
+        restart=False,
+    )
+    result.update(cfg)
+    type_ = result.get("type")
+    if type_ not in HEALTHCHECK_TYPES:
+        raise ValueError(f"Program {name!r}: unsupported healthcheck type {type_!r}")
+    if type_ == "exec":
+        if "command" not in result:
+            raise ValueError(f"Program {name!r}: exec healthcheck needs a command")
+    elif "port" in result:
+        result["port"] = int(result["port"])
+    elif type_ == "tcp" or "url" not in result:
+        raise ValueError(f"Program {name!r}: {type_} healthcheck needs a port")
+    return result
+
+
+POOL_KEYS = {"numprocs", "numprocs_start", "process_name"}
+POOL_TEMPLATED_KEYS = (
+    "command",
+    "environment",
+    "directory",
+    "stdout_logfile",
+    "stderr_logfile",
+    "healthcheck",
+)
+DEFAULT_PROCESS_NAME = "{program_name}-{process_num}"
+
+
+def template(value, program_name, process_num):
+    """Replaces {program_name} and {process_num} in strings (recursively)"""
+    if isinstance(value, str):
+        return value.replace("{program_name}", program_name).replace(
+            "{process_num}", str(process_num)
+        )
+    elif isinstance(value, list):
+        return [template(item, program_name, process_num) for item in value]
+    elif isinstance(value, dict):
+        return {
+            key: template(item, program_name, process_num)
+            for key, item in value.items()
+        }
+    return value
+
+
+def pool_process_nums(cfg):
+    start = cfg.get("numprocs_start", 0)
+    return range(start, start + cfg["numprocs"])
+
+
+def config_pool_process(pool, cfg, process_num):
+    """(name, config) of the instance *process_num* of the *pool* program"""
+    name = template(cfg.get("process_name", DEFAULT_PROCESS_NAME), pool, process_num)
+    result = {key: value for key, value in cfg.items() if key not in POOL_KEYS}
+    for key in POOL_TEMPLATED_KEYS:
+        if key in result:
+            result[key] = template(result[key], pool, process_num)
+    result["pool"] = pool
+    result["process_num"] = process_num
+    return name, config_program(name, result)
+
+
+def config_pools(cfg):
+    """Raw configuration of programs which have numprocs"""
+    return {name: dict(pcfg) for name, pcfg in cfg.items() if "numprocs" in pcfg}
+
+
+def resolve_pool_dependencies(program, pools):
+    """
+    Depending on a pool means depending on all its processes: replace the
+    pools in depends_on by their processes (*pools* maps pool names to
+    process names) and remember them in depends_on_pools
+    """
+    deps = program["depends_on"]
+    program["depends_on_pools"] = [dep for dep in deps if dep in pools]
+    program["depends_on"] = [name for dep in deps for name in pools.get(dep, [dep])]
+
+
 def config_programs(cfg):
-    return {name: config_program(name, pcfg) for name, pcfg in cfg.items()}
+    programs, pools = {}, {}
+    for name, pcfg in cfg.items():
+        if "numprocs" in pcfg:
+            pools[name] = []
+            for process_num in pool_process_nums(pcfg):
+                pname, program = config_pool_process(name, pcfg, process_num)
+                if pname in programs or (pname != name and pname in cfg):
+                    raise ValueError(
+                        f"Pool {name!r}: process name {pname!r} already in use"
+                    )
+                programs[pname] = program
+                pools[name].append(pname)
+        else:
+            if name in programs:
+                raise ValueError(f"Program {name!r}: name already in use by a pool")
+            programs[name] = config_program(name, pcfg)
+    for program in programs.values():
+        resolve_pool_dependencies(program, pools)
+    check_dependencies(programs)
+    return programs
+
+
+def check_dependencies(programs):
+    """Raises ValueError if a dependency is unknown or if there is a cycle"""
+    for name, cfg in programs.items():
+        for dep in cfg["depends_on"]:
+            if dep not in programs:
+                raise ValueError(f"Program {name!r} depends on unknown {dep!r}")
+    visiting, visited = [], set()
+
+    def visit(name):
+        if name in visited:
+            return
+        if name in visiting:
+            cycle = visiting[visiting.index(name) :] + [name]
+            raise ValueError(f"Dependency cycle: {' -> '.join(cycle)}")
+        visiting.append(name)
+        for dep in programs[name]["depends_on"]:
+            visit(dep)
+        visiting.pop()
+        visited.add(name)
+
+    for name in programs:
+        visit(name)
+
+
+def diff_programs(old, new):
+    """
+    Names of the programs added, removed, changed (different effective
+    configuration) and unchanged between two parsed program configurations
+    """
+    return dict(
+        added=[name for name in new if name not in old],
+        removed=[name for name in old if name not in new],
+        changed=[name for name in new if name in old and new[name] != old[name]],
+        unchanged=[name for name in new if name in old and new[name] == old[name]],
+    )
 
 
 def config_logging(cfg):
@@ -110,11 +460,68 @@ def config_logging(cfg):
     return result
 
 
+def config_sampler(cfg):
+    result = dict(
+        interval=2.0,
+        expensive_interval=60.0,
+        cheap=list(CHEAP_ATTRS),
+        expensive=list(EXPENSIVE_ATTRS),
+    )
+    result.update(cfg)
+    return result
+
+
+def config_ws(cfg):
+    result = dict(queue_size=1000, slow_consumer="drop", history_size=1000)
+    result.update(cfg)
+    if result["slow_consumer"] not in SLOW_CONSUMER_POLICIES:
+        raise ValueError(f"Unsupported slow_consumer {result['slow_consumer']!r}")
+    return result
+
+
+def config_sse(cfg):
+    result = dict(coalesce_window=0.1)
+    result.update(cfg)
+    return result
+
+
+def config_health(cfg):
+    result = dict(workers=16)
+    result.update(cfg)
+    return result
+
+
+def config_instrumentation(cfg):
+    result = dict(loop_lag_interval=0.5, slow_threshold=0)
+    result.update(cfg)
+    return result
+
+
+def config_unix(cfg):
+    result = dict(path=None, mode=0o660)
+    result.update(cfg)
+    mode = result["mode"]
+    if isinstance(mode, str):
+        try:
+            mode = int(mode, 8)
+        except ValueError:
+            raise ValueError(f"Invalid unix socket mode {mode!r}") from None
+    if not 0 <= mode <= 0o777:
+        raise ValueError(f"Invalid unix socket mode {oct(mode)}")
+    result["mode"] = mode
+    if result["path"] is not None:
+        result["path"] = os.path.expanduser(result["path"])
+    return result
+
+
 def config_web(cfg):
     result = dict()
     if "aiohttp" in cfg:
         result["aiohttp"] = dict()
         result["aiohttp"].update(cfg["aiohttp"])
+    result["unix"] = config_unix(cfg.get("unix", {}))
+    result["ws"] = config_ws(cfg.get("ws", {}))
+    result["sse"] = config_sse(cfg.get("sse", {}))
     return result
 
 
@@ -122,10 +529,19 @@ def config_main(cfg):
     uname = platform.uname()
     result = dict(
         uname=uname,
-        name=uname.node
+        name=uname.node,
+        max_concurrent_starts=0,
+        max_concurrent_stops=0,
+        bulk_concurrency=0,
+        bulk_batch_size=0,
     )
     result.update(cfg)
     result["logging"] = config_logging(result.get("logging", DEFAULT_LOG_CONFIG))
+    result["sampler"] = config_sampler(result.get("sampler", {}))
+    result["health"] = config_health(result.get("health", {}))
+    result["instrumentation"] = config_instrumentation(
+        result.get("instrumentation", {})
+    )
     return result
 
 
@@ -133,10 +549,42 @@ def parse_raw_config(config):
     return dict(
         main=config_main(config.get("main", {})),
         programs=config_programs(config.get("programs", {})),
+        pools=config_pools(config.get("programs", {})),
+        web=config_web(config.get("web", {})),
+    )
+
+
+def config_node(cfg):
+    if isinstance(cfg, str):
+        cfg = dict(url=cfg)
+    result = dict(unix_socket=None, timeout=10.0)
+    result.update(cfg)
+    if "url" not in result:
+        raise ValueError("Federation nodes need an url")
+    return result
+
+
+def config_federation(cfg):
+    result = dict(name="federation", reconnect_delay=1.0, max_reconnect_delay=30.0)
+    result.update(cfg)
+    nodes = result.get("nodes", {})
+    result["nodes"] = {name: config_node(ncfg) for name, ncfg in nodes.items()}
+    result["logging"] = config_logging(result.get("logging", DEFAULT_LOG_CONFIG))
+    return result
+
+
+def parse_raw_federation_config(config):
+    return dict(
+        federation=config_federation(config.get("federation", {})),
         web=config_web(config.get("web", {})),
     )
 
 
+def load_federation_config(config_file):
+    return parse_raw_federation_config(load_config_tree(config_file))
+
+
 def load_config(config_file):
-    config = load_config_raw(config_file)
-    return parse_raw_config(config)
+    with timed("config_load", "Load and parse the configuration"):
+        config = load_config_tree(config_file)
+        return parse_raw_config(config)
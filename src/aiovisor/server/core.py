@@ -3,9 +3,22 @@ import enum
 import time
 import socket
 import asyncio
+import fnmatch
+import itertools
+import contextlib
 
-from ..util import log, signal
-from .process import Process
+from ..util import log, signal, AIOVisorError
+from .config import (
+    config_pool_process,
+    diff_programs,
+    load_config,
+    resolve_pool_dependencies,
+)
+from .process import Process, ProcessState
+from .sampler import Sampler
+from .health import HealthChecker
+from .logfile import LogWriter
+from . import metrics
 
 
 class State(enum.IntEnum):
@@ -16,15 +29,146 @@ class State(enum.IntEnum):
     Stopping = 3
 
 
+def limiter(limit):
+    """Semaphore for the given limit (0 or None means unlimited)"""
+    return asyncio.Semaphore(limit) if limit else contextlib.nullcontext()
+
+
+def effective_priorities(programs):
+    """
+    Program priorities raised to the priority of their dependencies so
+    dependencies are never started in a later batch than their dependents
+    """
+    result = {}
+
+    def resolve(name):
+        if name not in result:
+            cfg = programs[name]
+            deps = (resolve(dep) for dep in cfg["depends_on"])
+            result[name] = max([cfg["priority"], *deps])
+        return result[name]
+
+    for name in programs:
+        resolve(name)
+    return result
+
+
+def dependents(programs):
+    """Map of program name to the names of the programs which depend on it"""
+    result = {name: [] for name in programs}
+    for name, cfg in programs.items():
+        for dep in cfg["depends_on"]:
+            result[dep].append(name)
+    return result
+
+
+def priority_batches(procs, priorities, reverse=False):
+    """Group processes by ascending (or descending) priority"""
+
+    def key(proc):
+        return priorities[proc.name]
+
+    procs = sorted(procs, key=key, reverse=reverse)
+    return [list(batch) for _, batch in itertools.groupby(procs, key=key)]
+
+
+def batched(items, size):
+    """Split items in lists of *size* (a single list if size is 0 or None)"""
+    items = list(items)
+    if not size:
+        return [items]
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+class ProcessIndex:
+    """
+    Secondary indexes of the processes by state, tag and pool (each a map
+    of key to {name: process}) so filtered queries don't scan every process
+    """
+
+    def __init__(self):
+        self.by_state = {}
+        self.by_tag = {}
+        self.by_pool = {}
+
+    def clear(self):
+        self.by_state.clear()
+        self.by_tag.clear()
+        self.by_pool.clear()
+
+    def _keys(self, proc):
+        yield self.by_state, proc.state
+        for tag in proc.config.get("tags", ()):
+            yield self.by_tag, tag
+        if (pool := proc.config.get("pool")) is not None:
+            yield self.by_pool, pool
+
+    def add(self, proc):
+        for index, key in self._keys(proc):
+            index.setdefault(key, {})[proc.name] = proc
+
+    def remove(self, proc):
+        for index, key in self._keys(proc):
+            procs = index.get(key, {})
+            procs.pop(proc.name, None)
+            if not procs:
+                index.pop(key, None)
+
+    def update_state(self, proc, old_state, new_state):
+        procs = self.by_state.get(old_state, {})
+        procs.pop(proc.name, None)
+        if not procs:
+            self.by_state.pop(old_state, None)
+        self.by_state.setdefault(new_state, {})[proc.name] = proc
+
+    def state(self, state):
+        return self.by_state.get(state, {})
+
+    def tag(self, tag):
+        return self.by_tag.get(tag, {})
+
+    def pool(self, pool):
+        return self.by_pool.get(pool, {})
+
+
+async def start_and_wait(proc):
+    await proc.start()
+    return await proc.wait_started()
+
+
+BULK_ACTIONS = {
+    "start": start_and_wait,
+    "stop": lambda proc: proc.stop(),
+    "kill": lambda proc: proc.kill(),
+    "restart": lambda proc: proc.restart(),
+}
+
+
 class AIOVisor:
-    def __init__(self, config):
+    def __init__(self, config, config_file=None):
         self.config = config
+        self.config_file = config_file
+        # serializes the changes of the set of processes (start, stop,
+        # reload and scale): ex: a reload while the initial start is running
+        self.lock = asyncio.Lock()
         self.procs = {}
+        self.index = ProcessIndex()
+        # incremented on every change of the processes info (state change,
+        # health, addition, removal...) and of the pools
+        self.version = 0
+        signal("process_state").connect(self.on_process_state_event)
+        signal("process_info").connect(self.on_process_info_event)
         self.start_time = None
         self.state = State.Stopped
         self.pid = os.getpid()
         self.hostname = socket.gethostname()
         self.log = log.getChild("core")
+        self.sampler = Sampler(self, config["main"]["sampler"])
+        self.health = HealthChecker(config["main"]["health"], self)
+        self.log_writer = LogWriter()
+        instrumentation = config["main"]["instrumentation"]
+        metrics.configure(instrumentation)
+        self.loop_monitor = metrics.LoopLagMonitor(instrumentation["loop_lag_interval"])
 
     async def __aenter__(self):
         if self.state is State.Stopped:
@@ -46,24 +190,84 @@ class AIOVisor:
         )
 
     async def start(self):
+        async with self.lock:
+            await self._start()
+
+    async def _start(self):
         self.change_state(State.Starting)
         self.start_time = time.time()
+        self.log_writer.start()
         programs = self.config["programs"]
-        self.procs = {
-            name: Process(name, cfg)
-            for name, cfg in programs.items()
-            if cfg["autostart"]
-        }
-        starts = (proc.start() for proc in self.procs.values())
-        await asyncio.gather(*starts)
+        self.procs = {}
+        self.index.clear()
+        for name, cfg in programs.items():
+            if cfg["autostart"]:
+                self._add_process(Process(name, cfg, log_writer=self.log_writer))
+        self.sampler.start()
+        self.health.start()
+        self.loop_monitor.start()
+        await self._start_processes(list(self.procs.values()))
         self.change_state(State.Running)
 
+    async def _start_process(self, proc, semaphore, started):
+        """
+        Starts the process as soon as all its dependencies are Running.
+        *started* maps program names to futures of the state they reached.
+        """
+        try:
+            if failed := await self._failed_dependencies(proc, started):
+                proc.last_error = f"Dependencies not running: {', '.join(failed)}"
+                proc.log.error(proc.last_error)
+                proc.change_state(ProcessState.Fatal)
+                return proc.state
+            async with semaphore:
+                await proc.start()
+                return await proc.wait_started()
+        finally:
+            started[proc.name].set_result(proc.state)
+
+    async def _failed_dependencies(self, proc, started):
+        failed = []
+        for dep in proc.config["depends_on"]:
+            # dependency may not be started at all (autostart = false)
+            if dep not in started or await started[dep] != ProcessState.Running:
+                failed.append(dep)
+        return failed
+
     async def stop(self):
+        async with self.lock:
+            await self._stop()
+
+    async def _stop(self):
         self.change_state(State.Stopping)
-        stops = (proc._stop() for proc in self.procs.values())
-        await asyncio.gather(*stops)
+        await self.sampler.stop()
+        await self.health.stop()
+        await self.loop_monitor.stop()
+        semaphore = limiter(self.config["main"]["max_concurrent_stops"])
+        programs = self.config["programs"]
+        priorities = effective_priorities(programs)
+        users = dependents(programs)
+        loop = asyncio.get_running_loop()
+        stopped = {name: loop.create_future() for name in self.procs}
+        batches = priority_batches(self.procs.values(), priorities, reverse=True)
+        for batch in batches:
+            stops = (
+                self._stop_process(proc, semaphore, stopped, users[proc.name])
+                for proc in batch
+            )
+            await asyncio.gather(*stops)
+        await self.log_writer.stop()
         self.change_state(State.Stopped)
 
+    async def _stop_process(self, proc, semaphore, stopped, users):
+        """Stops the process once all processes depending on it are stopped"""
+        try:
+            await asyncio.gather(*(stopped[user] for user in users if user in stopped))
+            async with semaphore:
+                return await proc._stop()
+        finally:
+            stopped[proc.name].set_result(proc.state)
+
     def change_state(self, state):
         old_state = self.state
         if state == old_state:
@@ -73,5 +277,284 @@ class AIOVisor:
         sig = signal("server_state")
         sig.send(self, old_state=old_state, new_state=state)
 
+    def on_process_state_event(self, sender, old_state, new_state):
+        if self.procs.get(sender.name) is sender:
+            self.index.update_state(sender, old_state, new_state)
+            self.version += 1
+
+    def on_process_info_event(self, sender):
+        if self.procs.get(sender.name) is sender:
+            self.version += 1
+
+    def _add_process(self, proc):
+        self.procs[proc.name] = proc
+        self.index.add(proc)
+        self.version += 1
+        return proc
+
+    def _remove_process(self, proc):
+        del self.procs[proc.name]
+        self.index.remove(proc)
+        proc.close_logfiles()
+        self.version += 1
+
     def process(self, name):
         return self.procs[name]
+
+    def pool_programs(self, name):
+        """Program names of the given pool sorted by process number"""
+        if name not in self.config["pools"]:
+            raise AIOVisorError(f"Unknown pool {name!r}")
+        programs = self.config["programs"]
+        names = [pname for pname, cfg in programs.items() if cfg.get("pool") == name]
+        return sorted(names, key=lambda pname: programs[pname]["process_num"])
+
+    def pool(self, name):
+        """Processes of the given pool sorted by process number"""
+        procs = self.index.pool(name)
+        return [procs[pname] for pname in self.pool_programs(name) if pname in procs]
+
+    def pools(self):
+        return {name: self.pool_programs(name) for name in self.config["pools"]}
+
+    async def _stop_processes(self, procs):
+        """Stop the processes whatever their state (no error if already stopped)"""
+        semaphore = limiter(self.config["main"]["max_concurrent_stops"])
+
+        async def stop(proc):
+            async with semaphore:
+                await proc._stop()
+
+        await asyncio.gather(*(stop(proc) for proc in procs))
+
+    async def scale(self, name, numprocs):
+        """
+        Resize the pool to *numprocs* processes. Processes with the highest
+        process number are removed first; new processes take the lowest free
+        process numbers. Other processes of the pool are not touched and the
+        programs depending on the pool depend on its new processes. New
+        processes are only started if the server is running.
+        """
+        async with self.lock:
+            return await self._scale(name, numprocs)
+
+    async def _scale(self, name, numprocs):
+        if numprocs < 0:
+            raise AIOVisorError("numprocs must be >= 0")
+        names = self.pool_programs(name)
+        programs = self.config["programs"]
+        pool_cfg = self.config["pools"][name]
+        kept, removed_names = names[:numprocs], names[numprocs:]
+        used = {programs[pname]["process_num"] for pname in kept}
+        free = itertools.count(pool_cfg.get("numprocs_start", 0))
+        free = (process_num for process_num in free if process_num not in used)
+        new_programs = {}
+        for process_num in itertools.islice(free, max(0, numprocs - len(names))):
+            pname, cfg = config_pool_process(name, pool_cfg, process_num)
+            if pname in programs or pname in new_programs:
+                raise AIOVisorError(f"Cannot add {pname!r}: name already in use")
+            new_programs[pname] = cfg
+
+        removed = [self.procs[pname] for pname in removed_names if pname in self.procs]
+        await self._stop_processes(removed)
+        for proc in removed:
+            self._remove_process(proc)
+        for pname in removed_names:
+            del programs[pname]
+        programs.update(new_programs)
+        pool_cfg["numprocs"] = numprocs
+        self.version += 1
+        self._update_pool_dependencies(name, set(names))
+        added = [
+            self._add_process(Process(pname, cfg, log_writer=self.log_writer))
+            for pname, cfg in new_programs.items()
+            if cfg["autostart"]
+        ]
+        self._process_list_changed(added, removed)
+        if self.state in {State.Starting, State.Running}:
+            await self._start_processes(added)
+        return dict(
+            pool=name,
+            numprocs=numprocs,
+            added=list(new_programs),
+            removed=removed_names,
+        )
+
+    def _update_pool_dependencies(self, name, old_names):
+        """
+        The processes of the pool changed: make the programs which depend on
+        the pool depend on its current processes
+        """
+        programs = self.config["programs"]
+        pools = {pool: self.pool_programs(pool) for pool in self.config["pools"]}
+        for pname, cfg in programs.items():
+            if cfg.get("pool") == name and pname not in old_names:
+                # new process of the pool: depends_on as configured
+                resolve_pool_dependencies(cfg, pools)
+            elif name in cfg["depends_on_pools"]:
+                deps = [dep for dep in cfg["depends_on"] if dep not in old_names]
+                cfg["depends_on"] = deps + pools[name]
+
+    async def reload(self, config=None):
+        """
+        Apply a new configuration (by default loaded again from the config
+        file). Only programs whose effective configuration changed are
+        touched: removed ones are stopped, changed ones are stopped and
+        started again with the new configuration and new ones are started.
+        Other processes keep running. Returns the program diff.
+        """
+        async with self.lock:
+            if config is None:
+                if self.config_file is None:
+                    raise AIOVisorError("No configuration file to reload")
+                try:
+                    config = await asyncio.to_thread(load_config, self.config_file)
+                except Exception as error:
+                    raise AIOVisorError(
+                        f"Cannot load {str(self.config_file)!r}: {error!r}"
+                    ) from error
+            return await self._reload(config)
+
+    async def _reload(self, config):
+        programs = config["programs"]
+        diff = diff_programs(self.config["programs"], programs)
+        main = self.config["main"]
+        outdated = [
+            self.procs[name]
+            for name in diff["removed"] + diff["changed"]
+            if name in self.procs
+        ]
+        await self._stop_processes(outdated)
+        for proc in outdated:
+            self._remove_process(proc)
+        self.config["programs"] = programs
+        self.config["pools"] = config["pools"]
+        added = []
+        for name in diff["changed"] + diff["added"]:
+            if (cfg := programs[name])["autostart"]:
+                proc = Process(name, cfg, log_writer=self.log_writer)
+                added.append(self._add_process(proc))
+        if config["main"] != main or config["web"] != self.config["web"]:
+            self.log.warning("[main] and [web] changes need a restart to apply")
+        self.log.info(
+            "Reloaded: %d added, %d removed, %d changed, %d unchanged",
+            *(len(diff[key]) for key in ("added", "removed", "changed", "unchanged")),
+        )
+        self._process_list_changed(added, outdated)
+        if self.state in {State.Starting, State.Running}:
+            await self._start_processes(added)
+        return dict(diff, unchanged=len(diff["unchanged"]))
+
+    async def _start_processes(self, procs):
+        """
+        Starts the given processes in priority and dependency order. Other
+        processes are considered already started.
+        """
+        semaphore = limiter(self.config["main"]["max_concurrent_starts"])
+        priorities = effective_priorities(self.config["programs"])
+        loop = asyncio.get_running_loop()
+        names = {proc.name for proc in procs}
+        started = {name: loop.create_future() for name in self.procs}
+        for name, proc in self.procs.items():
+            if name not in names:
+                started[name].set_result(proc.state)
+        for batch in priority_batches(procs, priorities):
+            starts = (self._start_process(proc, semaphore, started) for proc in batch)
+            await asyncio.gather(*starts)
+
+    def _process_list_changed(self, added, removed):
+        if added or removed:
+            signal("process_list").send(self, added=added, removed=removed)
+
+    async def rolling_restart(self, procs, batch_size=1, timeout=None):
+        """
+        Restart processes in batches of *batch_size*, waiting for all the
+        processes of a batch to be Running again (within *timeout* seconds)
+        before moving to the next batch. Aborts at the first failed batch
+        so the remaining processes keep serving.
+        """
+        results, failed = {}, False
+        for batch in batched(procs, batch_size or 1):
+            if failed:
+                for proc in batch:
+                    results[proc.name] = dict(result="SKIPPED", state=proc.state.name)
+                continue
+            errors = await asyncio.gather(
+                *(self._restart_until_running(proc, timeout) for proc in batch)
+            )
+            for proc, error in zip(batch, errors):
+                if error is None:
+                    result = dict(result="ACK")
+                else:
+                    result = dict(result="ERROR", error=error)
+                results[proc.name] = dict(result, state=proc.state.name)
+            if any(errors):
+                failed = True
+                names = [proc.name for proc, error in zip(batch, errors) if error]
+                self.log.error("Rolling restart aborted: %s failed", ", ".join(names))
+        return dict(result="ABORTED" if failed else "ACK", processes=results)
+
+    async def _restart_until_running(self, proc, timeout):
+        """Returns None if the process is Running after restart or the error"""
+        try:
+            state = await asyncio.wait_for(proc.restart(), timeout)
+        except asyncio.TimeoutError:
+            return f"not running after {timeout}s"
+        except Exception as error:
+            return str(error)
+        if state != ProcessState.Running:
+            return f"start ended in {state.name}"
+
+    def select(self, tag=None, pattern=None, state=None):
+        """
+        Processes with the given tag, in the given state and which name
+        matches the glob pattern
+        """
+        selected = []
+        if tag is not None:
+            selected.append(self.index.tag(tag))
+        if state is not None:
+            selected.append(self.index.state(state))
+        if selected:
+            # scan the smallest index only
+            selected.sort(key=len)
+            first, *others = selected
+            procs = [p for name, p in first.items() if all(name in o for o in others)]
+        else:
+            procs = self.procs.values()
+        if pattern is not None:
+            procs = [proc for proc in procs if fnmatch.fnmatchcase(proc.name, pattern)]
+        return list(procs)
+
+    async def bulk(self, action, procs, concurrency=None, batch_size=None):
+        """
+        Run the action (start, stop, kill or restart) on the given processes.
+
+        Processes are handled in batches of *batch_size* (each batch waits for
+        the previous one) running at most *concurrency* actions at the same
+        time. Defaults come from [main] bulk_concurrency and bulk_batch_size.
+        Returns a map of process name to its result.
+        """
+        if (func := BULK_ACTIONS.get(action)) is None:
+            raise AIOVisorError(f"Unsupported action {action!r}")
+        main = self.config["main"]
+        if concurrency is None:
+            concurrency = main["bulk_concurrency"]
+        if batch_size is None:
+            batch_size = main["bulk_batch_size"]
+        semaphore = limiter(concurrency)
+        results = {}
+
+        async def run(proc):
+            async with semaphore:
+                try:
+                    await func(proc)
+                except Exception as error:
+                    result = dict(result="ERROR", error=str(error))
+                else:
+                    result = dict(result="ACK")
+            results[proc.name] = dict(result, state=proc.state.name)
+
+        for batch in batched(procs, batch_size):
+            await asyncio.gather(*(run(proc) for proc in batch))
+        return results
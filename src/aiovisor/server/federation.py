@@ -0,0 +1,275 @@
+"""
+Federation: a merged, cached view of the processes of several aiovisor
+servers (nodes).
+
+Each node is followed through a persistent /api/ws subscription: on
+(re)connection the state of all its processes is fetched once and then kept
+up to date by the node events, so fleet wide queries are local lookups.
+Fleet process names are ``<node>:<process>``.
+"""
+
+import os
+import asyncio
+import fnmatch
+
+import aiohttp
+
+from ..util import log, signal, AIOVisorError
+from ..client import AIOVisor as Client, CLIENT_ERRORS
+from .process import STATE_VERSIONS, ProcessState
+
+
+log = log.getChild("federation")
+
+
+# fields of a remote process info (see process.INFO_FIELDS)
+REMOTE_FIELDS = {
+    "name": lambda info: info["name"],
+    "node": lambda info: info["node"],
+    "state": lambda info: info["state"]["state"].name,
+    "tags": lambda info: info["config"].get("tags", []),
+    "pool": lambda info: info["config"].get("pool"),
+    "config": lambda info: info["config"],
+    "ps": lambda info: info["ps"],
+    "ps_time": lambda info: info.get("ps_time"),
+    **{
+        name: (lambda info, name=name: info["state"].get(name))
+        for name in (
+            "state_version",
+            "pid",
+            "start_time",
+            "stop_time",
+            "last_returncode",
+            "last_error",
+            "spawn_latency",
+            "restarts",
+            "health",
+        )
+    },
+}
+
+
+class RemoteProcess:
+    """Cached state of a process of a node"""
+
+    def __init__(self, node, info):
+        self.node = node
+        self.remote_name = info["name"]
+        self.name = f"{node.name}:{info['name']}"
+        self.remote_version = -1
+        self.state = ProcessState.Unknown
+        self.state_version = next(STATE_VERSIONS)
+        self.data = None
+        self.update(info)
+
+    @property
+    def config(self):
+        return self.data["config"]
+
+    @property
+    def ps_time(self):
+        return self.data.get("ps_time")
+
+    def info(self):
+        return self.data
+
+    def fields(self, names):
+        return {name: REMOTE_FIELDS[name](self.data) for name in names}
+
+    def update(self, info):
+        """Update from a node process info unless it is older than the current one"""
+        version = info["state"].get("state_version", 0)
+        if version < self.remote_version:
+            return
+        self.remote_version = version
+        state = dict(info["state"], state=ProcessState(info["state"]["state"]))
+        self.data = dict(info, name=self.name, node=self.node.name, state=state)
+        self.changed(state["state"])
+
+    def set_unknown(self):
+        """
+        The node is not reachable. It may come back restarted, with state
+        versions starting from 0 again: accept any next update
+        """
+        self.remote_version = -1
+        state = dict(self.data["state"], state=ProcessState.Unknown, pid=None)
+        self.data = dict(self.data, state=state)
+        self.changed(ProcessState.Unknown)
+
+    def changed(self, state):
+        old_state, self.state = self.state, state
+        self.state_version = next(STATE_VERSIONS)
+        self.node.fleet.version += 1
+        signal("process_state").send(self, old_state=old_state, new_state=state)
+
+
+class Node:
+    """Follows the state of the processes of an aiovisor server"""
+
+    def __init__(self, fleet, name, config):
+        self.fleet = fleet
+        self.name = name
+        self.config = config
+        self.client = Client(
+            config["url"], unix_socket=config["unix_socket"], timeout=config["timeout"]
+        )
+        self.procs = {}
+        self.seq = None
+        self.connected = False
+        self.server_state = None
+        self.last_error = None
+        self.task = None
+        self.log = log.getChild(name)
+
+    def info(self):
+        return dict(
+            name=self.name,
+            url=self.config["url"],
+            connected=self.connected,
+            server_state=self.server_state,
+            last_error=self.last_error,
+            processes=len(self.procs),
+        )
+
+    def start(self):
+        self.task = asyncio.create_task(self._run(), name=f"node-{self.name}")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await self.client.close()
+
+    async def _run(self):
+        fed = self.fleet.federation
+        delay = fed["reconnect_delay"]
+        while True:
+            try:
+                await self.sync()
+                self.connected, self.last_error = True, None
+                self.log.info("Connected (%d processes)", len(self.procs))
+                delay = fed["reconnect_delay"]
+                async for event in self.client.events(since=self.seq, reconnect=False):
+                    await self.handle(event)
+            except CLIENT_ERRORS + (OSError,) as error:
+                self.last_error = str(error) or type(error).__name__
+            except Exception as error:
+                # ex: an unexpected event. Start again from a snapshot
+                self.log.exception("Error following the node")
+                self.last_error = f"{type(error).__name__}: {error}"
+            if self.connected:
+                self.log.warning("Disconnected: %s", self.last_error)
+                self.connected = False
+                for proc in self.procs.values():
+                    proc.set_unknown()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, fed["max_reconnect_delay"])
+
+    async def sync(self):
+        """Fetch the state of all the processes of the node"""
+        self.seq, processes = await self.client.snapshot()
+        self.server_state = (await self.client.state())["state"]
+        # the snapshot is authoritative (the node may have been restarted)
+        for proc in self.procs.values():
+            proc.remote_version = -1
+        added = [proc for info in processes.values() if (proc := self._update(info))]
+        removed = [self.procs.pop(name) for name in set(self.procs) - set(processes)]
+        self.fleet.processes_changed(added, removed)
+
+    def _update(self, info):
+        """Update (or create) the process. Returns it only if created"""
+        if (proc := self.procs.get(info["name"])) is not None:
+            proc.update(info)
+            return None
+        self.procs[info["name"]] = proc = RemoteProcess(self, info)
+        return proc
+
+    async def handle(self, event):
+        event_type = event["event_type"]
+        seq = event.get("seq")
+        if event_type != "resync" and seq is not None and seq <= self.seq:
+            # already in the snapshot of the last resync
+            return
+        self.seq = event.get("seq", self.seq)
+        if event_type == "process_state":
+            if proc := self._update(event["process"]):
+                self.fleet.processes_changed([proc], [])
+        elif event_type == "process_list":
+            # a replaced (reloaded) process is both removed and added
+            removed = [self.procs.pop(name, None) for name in event["removed"]]
+            added = [self._update(info) for info in event["added"]]
+            self.fleet.processes_changed(
+                [proc for proc in added if proc], [proc for proc in removed if proc]
+            )
+        elif event_type == "server_state":
+            self.server_state = event["new_state"]
+        elif event_type == "resync":
+            await self.sync()
+
+
+class Fleet:
+    """Merged state of the processes of all nodes"""
+
+    def __init__(self, config):
+        self.federation = config["federation"]
+        # the subset of a server config used by the web app
+        self.config = dict(main=dict(name=self.federation["name"]), web=config["web"])
+        self.pid = os.getpid()
+        self.version = 0
+        self.procs = {}
+        self.nodes = {
+            name: Node(self, name, ncfg)
+            for name, ncfg in self.federation["nodes"].items()
+        }
+
+    async def start(self):
+        for node in self.nodes.values():
+            node.start()
+
+    async def stop(self):
+        await asyncio.gather(*(node.stop() for node in self.nodes.values()))
+
+    def info(self):
+        return dict(
+            name=self.federation["name"],
+            nodes={name: node.info() for name, node in self.nodes.items()},
+        )
+
+    def processes_changed(self, added, removed):
+        for proc in removed:
+            self.procs.pop(proc.name, None)
+        for proc in added:
+            self.procs[proc.name] = proc
+        if added or removed:
+            self.version += 1
+            signal("process_list").send(self, added=added, removed=removed)
+
+    def process(self, name):
+        return self.procs[name]
+
+    def locate(self, name):
+        """(node, remote process name) of the fleet process name"""
+        if (proc := self.procs.get(name)) is None:
+            raise AIOVisorError(f"Unknown process {name!r}")
+        return proc.node, proc.remote_name
+
+    def select(self, tag=None, pattern=None, state=None):
+        procs = self.procs.values()
+        if state is not None:
+            procs = [proc for proc in procs if proc.state == state]
+        if tag is not None:
+            procs = [proc for proc in procs if tag in proc.config.get("tags", ())]
+        if pattern is not None:
+            procs = [proc for proc in procs if fnmatch.fnmatchcase(proc.name, pattern)]
+        return list(procs)
+
+    async def action(self, action, name):
+        """Forward the process action (start, stop or kill) to its node"""
+        node, remote_name = self.locate(name)
+        try:
+            return await node.client.request(
+                "POST", f"/api/process/{action}/{remote_name}"
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            raise AIOVisorError(f"{node.name}: {error}") from error
@@ -0,0 +1,199 @@
+import heapq
+import shlex
+import asyncio
+import functools
+import itertools
+
+import aiohttp
+
+from ..util import log, signal
+from .process import ProcessState
+
+
+HEALTHCHECK_TYPES = {"tcp", "http", "exec"}
+
+CHECKED_STATES = {
+    ProcessState.Starting,
+    ProcessState.Running,
+    ProcessState.Unhealthy,
+}
+
+
+async def check_tcp(cfg, session):
+    reader, writer = await asyncio.open_connection(cfg["host"], cfg["port"])
+    writer.close()
+    await writer.wait_closed()
+
+
+async def check_http(cfg, session):
+    url = cfg.get("url") or f"http://{cfg['host']}:{cfg['port']}{cfg['path']}"
+    async with session.get(url) as response:
+        if response.status >= 400:
+            raise ValueError(f"HTTP {response.status}")
+
+
+async def check_exec(cfg, session):
+    command = cfg["command"]
+    if isinstance(command, str):
+        command = shlex.split(command)
+    proc = await asyncio.create_subprocess_exec(
+        *command, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+    )
+    try:
+        returncode = await proc.wait()
+    except asyncio.CancelledError:
+        proc.kill()
+        raise
+    if returncode:
+        raise ValueError(f"exit code {returncode}")
+
+
+CHECKS = {"tcp": check_tcp, "http": check_http, "exec": check_exec}
+
+
+class HealthChecker:
+    """
+    Runs the health checks of all processes.
+
+    A single scheduler task keeps a heap of (due time, process) and hands
+    due checks to a fixed pool of worker tasks, so there is no task (nor
+    timer) per process.
+
+    While a process is Starting it is checked every ``start_interval``
+    until the first success, which makes it ready (Running). Afterwards it
+    is checked every ``interval``: ``retries`` consecutive failures make it
+    Unhealthy (and restart it if ``restart`` is set) and a success makes it
+    Running again.
+    """
+
+    def __init__(self, config, aiovisor):
+        self.config = config
+        self.aiovisor = aiovisor
+        self.heap = []
+        self.tokens = {}
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.queue = asyncio.Queue()
+        self.tasks = []
+        # restarts of unhealthy processes (the loop only keeps weak references)
+        self.restarts = set()
+        self.session = None
+        self.log = log.getChild("health")
+
+    def start(self):
+        if self.tasks:
+            return
+        signal("process_state").connect(self.on_process_state_event)
+        self.session = aiohttp.ClientSession()
+        self.tasks.append(asyncio.create_task(self._schedule(), name="health"))
+        self.tasks.extend(
+            asyncio.create_task(self._work(), name=f"health-{i}")
+            for i in range(self.config["workers"])
+        )
+
+    async def stop(self):
+        signal("process_state").disconnect(self.on_process_state_event)
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        self.heap.clear()
+        self.tokens.clear()
+
+    def on_process_state_event(self, sender, old_state, new_state):
+        if self.aiovisor.procs.get(sender.name) is not sender:
+            return
+        cfg = sender.config["healthcheck"]
+        if cfg is not None and new_state == ProcessState.Starting:
+            sender.health.update(failures=0, last_error=None)
+            self.schedule(sender, cfg["start_interval"])
+
+    def schedule(self, proc, delay):
+        token = next(self.counter)
+        self.tokens[proc] = token
+        due = asyncio.get_running_loop().time() + delay
+        heapq.heappush(self.heap, (due, token, proc))
+        if self.heap[0][1] == token:
+            self.wakeup.set()
+
+    async def _schedule(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.wakeup.clear()
+            timeout = None
+            now = loop.time()
+            while self.heap and self.heap[0][0] <= now:
+                _, token, proc = heapq.heappop(self.heap)
+                if self.tokens.get(proc) != token:
+                    continue  # rescheduled meanwhile
+                if proc.state not in CHECKED_STATES:
+                    del self.tokens[proc]
+                    continue
+                self.queue.put_nowait((token, proc))
+            if self.heap:
+                timeout = self.heap[0][0] - now
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _work(self):
+        while True:
+            token, proc = await self.queue.get()
+            cfg = proc.config["healthcheck"]
+            error = None
+            try:
+                check = CHECKS[cfg["type"]](cfg, self.session)
+                await asyncio.wait_for(check, cfg["timeout"])
+            except Exception as exc:
+                error = str(exc) or type(exc).__name__
+            if self.tokens.get(proc) == token:
+                self._handle_result(proc, cfg, error)
+
+    def _handle_result(self, proc, cfg, error):
+        before = dict(proc.health)
+        self._update_health(proc, cfg, error)
+        if proc.health != before:
+            proc.info_changed()
+
+    def _update_health(self, proc, cfg, error):
+        health = proc.health
+        health["last_error"] = error
+        state = proc.state
+        if state == ProcessState.Starting:
+            if error is None:
+                proc.set_ready()
+                self.schedule(proc, cfg["interval"])
+            else:
+                self.schedule(proc, cfg["start_interval"])
+            return
+        if error is None:
+            health["failures"] = 0
+            if state == ProcessState.Unhealthy:
+                proc.log.info("Healthy again")
+                proc.change_state(ProcessState.Running)
+        else:
+            health["failures"] += 1
+            failures = health["failures"]
+            proc.log.warning("Health check failed (%d): %s", failures, error)
+            if failures >= cfg["retries"] and state == ProcessState.Running:
+                proc.change_state(ProcessState.Unhealthy)
+                if cfg["restart"]:
+                    proc.log.warning("Restarting unhealthy process")
+                    self.tokens.pop(proc, None)
+                    self._restart(proc)
+                    return
+        self.schedule(proc, cfg["interval"])
+
+    def _restart(self, proc):
+        task = asyncio.create_task(proc.restart(), name=f"{proc.name}-restart")
+        self.restarts.add(task)
+        task.add_done_callback(functools.partial(self._restart_done, proc))
+
+    def _restart_done(self, proc, task):
+        self.restarts.discard(task)
+        if not task.cancelled() and (error := task.exception()) is not None:
+            proc.log.error("Cannot restart unhealthy process: %s", error)
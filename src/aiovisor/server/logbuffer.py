@@ -0,0 +1,86 @@
+import asyncio
+
+
+class RingBuffer:
+    """
+    Fixed size in-memory byte buffer keeping the last *maxbytes* of output.
+
+    Positions are absolute (total number of bytes ever written) so readers
+    can follow the buffer by remembering the position they reached.
+    """
+
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.buffer = bytearray(maxbytes)
+        self.position = 0
+        self._waiters = []
+
+    @property
+    def start(self):
+        """Oldest absolute position still available"""
+        return max(0, self.position - self.maxbytes)
+
+    def __len__(self):
+        return self.position - self.start
+
+    def write(self, data):
+        size, n = self.maxbytes, len(data)
+        if n > size:
+            data = memoryview(data)[n - size :]
+        offset = (self.position + n - len(data)) % size
+        first = min(len(data), size - offset)
+        self.buffer[offset : offset + first] = data[:first]
+        self.buffer[: len(data) - first] = data[first:]
+        self.position += n
+        if self._waiters:
+            for waiter in self._waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+            self._waiters.clear()
+
+    def read(self, position=None):
+        """Bytes from absolute *position* (or start) until the end"""
+        start = self.start
+        if position is None or position < start:
+            position = start
+        n = self.position - position
+        if n <= 0:
+            return b""
+        size = self.maxbytes
+        offset = position % size
+        first = min(n, size - offset)
+        if first == n:
+            return bytes(self.buffer[offset : offset + n])
+        return bytes(self.buffer[offset:]) + bytes(self.buffer[: n - first])
+
+    def tail(self, lines=None):
+        """Last *lines* lines (all available data if None)"""
+        data = self.read()
+        if lines is None:
+            return data
+        if lines <= 0:
+            return b""
+        end = len(data) - 1 if data.endswith(b"\n") else len(data)
+        for _ in range(lines):
+            end = data.rfind(b"\n", 0, end)
+            if end < 0:
+                return data
+        return data[end + 1 :]
+
+    async def wait(self, position):
+        """Wait until there is data after absolute *position*"""
+        if self.position > position:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        await waiter
+
+    async def follow(self, position=None):
+        """Yields chunks of data as they are written, forever"""
+        if position is None:
+            position = self.position
+        while True:
+            await self.wait(position)
+            data = self.read(position)
+            position = self.position
+            yield data
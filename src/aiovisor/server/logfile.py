@@ -0,0 +1,175 @@
+import os
+import queue
+import asyncio
+import threading
+
+from ..util import log
+
+
+log = log.getChild("logfile")
+
+
+if hasattr(os, "writev"):
+    writev = os.writev
+    IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") else 1024
+else:
+
+    def writev(fd, chunks):
+        return os.write(fd, b"".join(chunks))
+
+    IOV_MAX = 1024
+
+
+class RotatingFile:
+    """
+    Append only file rotated when it reaches *maxbytes* keeping *backups*
+    old files (``<path>.1`` ... ``<path>.<backups>``).
+
+    Only used from the writer thread.
+    """
+
+    def __init__(self, path, maxbytes=0, backups=0):
+        self.path = os.fspath(path)
+        self.maxbytes = maxbytes
+        self.backups = backups
+        self.fd = None
+        self.size = 0
+
+    def open(self):
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.size = os.fstat(self.fd).st_size
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def rotate(self):
+        self.close()
+        if self.backups > 0:
+            for i in range(self.backups - 1, 0, -1):
+                src = f"{self.path}.{i}"
+                if os.path.exists(src):
+                    os.replace(src, f"{self.path}.{i + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.truncate(self.path, 0)
+        self.open()
+
+    def write(self, chunks):
+        if self.fd is None:
+            self.open()
+        maxbytes = self.maxbytes
+        batch, size = [], 0
+        for chunk in chunks:
+            while maxbytes and self.size + size + len(chunk) > maxbytes:
+                room = maxbytes - self.size - size
+                if room > 0:
+                    batch.append(chunk[:room])
+                    chunk = chunk[room:]
+                self._writev(batch)
+                batch, size = [], 0
+                self.rotate()
+            batch.append(chunk)
+            size += len(chunk)
+        self._writev(batch)
+
+    def _writev(self, chunks):
+        for i in range(0, len(chunks), IOV_MAX):
+            batch = chunks[i : i + IOV_MAX]
+            total = sum(map(len, batch))
+            written = writev(self.fd, batch)
+            if written < total:
+                data = memoryview(b"".join(batch))[written:]
+                while data:
+                    data = data[os.write(self.fd, data) :]
+            self.size += total
+
+
+class LogWriter:
+    """
+    Writes program output to files from a single dedicated thread.
+
+    Chunks are appended to a queue by the event loop (never blocks) and the
+    thread writes everything available for each file in one ``os.writev``.
+    At most *max_pending* bytes wait in the queue: if the disk can't keep up
+    further output is dropped (and reported) instead of growing the memory.
+    """
+
+    def __init__(self, max_pending=64 * 1024 * 1024):
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.max_pending = max_pending
+        self.pending = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self._run, name="aiovisor-logwriter", daemon=True
+            )
+            self.thread.start()
+
+    async def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            await asyncio.to_thread(self.thread.join)
+            self.thread = None
+
+    def write(self, logfile, data):
+        with self.lock:
+            if self.pending + len(data) > self.max_pending:
+                if not self.dropped:
+                    log.warning("Log writer overloaded: dropping output")
+                self.dropped += len(data)
+                return
+            self.pending += len(data)
+        self.queue.put((logfile, data))
+
+    def close(self, logfile):
+        """Close the file once the output queued before is written"""
+        self.queue.put((logfile, None))
+
+    def _run(self):
+        logfiles = set()
+        running = True
+        while running:
+            items = [self.queue.get()]
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            batches = {}
+            size = 0
+            for item in items:
+                if item is None:
+                    running = False
+                    continue
+                logfile, data = item
+                logfiles.add(logfile)
+                batches.setdefault(logfile, []).append(data)
+                if data is not None:
+                    size += len(data)
+            for logfile, chunks in batches.items():
+                try:
+                    self._write(logfile, chunks)
+                except OSError as error:
+                    log.error("Error writing %s: %r", logfile.path, error)
+                if logfile.fd is None:
+                    logfiles.discard(logfile)
+            with self.lock:
+                self.pending -= size
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                log.error("Dropped %d bytes of output (log writer too slow)", dropped)
+        for logfile in logfiles:
+            logfile.close()
+
+    def _write(self, logfile, chunks):
+        data = [chunk for chunk in chunks if chunk is not None]
+        if data:
+            logfile.write(data)
+        if chunks[-1] is None:
+            logfile.close()
@@ -0,0 +1,152 @@
+import time
+import bisect
+import asyncio
+import contextlib
+
+from ..util import log
+
+
+log = log.getChild("metrics")
+
+
+DURATION_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+class Histogram:
+    """Cumulative histogram of durations (in seconds)"""
+
+    def __init__(self, name, doc="", buckets=DURATION_BUCKETS, labels=None):
+        self.name = name
+        self.doc = doc
+        self.labels = labels or {}
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Upper bound of the bucket containing the *q* quantile"""
+        if not self.count:
+            return None
+        rank, total = q * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return self.max
+
+    def info(self):
+        cumulative, total = {}, 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            cumulative[bound] = total
+        return dict(
+            name=self.name,
+            doc=self.doc,
+            labels=self.labels,
+            count=self.count,
+            sum=self.sum,
+            max=self.max,
+            p50=self.quantile(0.5),
+            p99=self.quantile(0.99),
+            buckets=cumulative,
+        )
+
+
+histograms = {}
+
+# operations slower than this (seconds) are logged (0 disables)
+slow_threshold = 0
+
+
+def configure(config):
+    global slow_threshold
+    slow_threshold = config["slow_threshold"]
+
+
+def histogram(name, doc="", **labels):
+    """Get (or create) the histogram with the given name and labels"""
+    key = name, tuple(sorted(labels.items()))
+    if (result := histograms.get(key)) is None:
+        result = histograms[key] = Histogram(name, doc, labels=labels)
+    return result
+
+
+def observe(hist, duration):
+    hist.observe(duration)
+    if slow_threshold and duration > slow_threshold:
+        labels = " ".join(f"{k}={v}" for k, v in hist.labels.items())
+        log.warning("Slow %s %s took %.3fs", hist.name, labels, duration)
+
+
+@contextlib.contextmanager
+def timed(name, doc="", **labels):
+    """Measure the duration of the block into the given histogram"""
+    hist = histogram(name, doc, **labels)
+    start = time.perf_counter()
+    try:
+        yield hist
+    finally:
+        observe(hist, time.perf_counter() - start)
+
+
+def histograms_info():
+    return [hist.info() for hist in histograms.values()]
+
+
+class LoopLagMonitor:
+    """
+    Measures the event loop lag: how late a sleep of *interval* seconds
+    wakes up. A high lag means something is blocking the loop.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lag = 0.0
+        self.histogram = histogram("loop_lag", "Event loop lag")
+        self.task = None
+
+    def start(self):
+        if self.interval and self.task is None:
+            self.task = asyncio.create_task(self._loop(), name="loop-lag")
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    async def _loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, loop.time() - start - self.interval)
+            observe(self.histogram, self.lag)
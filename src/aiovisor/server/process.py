@@ -1,32 +1,30 @@
 import datetime
+import contextlib
 import enum
 import time
+import itertools
 import asyncio
+import random
+import shutil
 import resource
 import subprocess
 
+from ..util import is_posix, signal, log, AIOVisorError
+from .logbuffer import RingBuffer
+from .logfile import RotatingFile
+from .metrics import histogram, observe, timed
 
-try:
-    import psutil
-except ModuleNotFoundError:
-    psutil = None
 
-from ..util import is_posix, signal, log, AIOVisorError
+OUTPUT_STREAMS = ("stdout", "stderr")
+OUTPUT_CHUNK_SIZE = 64 * 1024
 
+# util-linux prlimit used as a minimal exec wrapper to apply resource limits
+PRLIMIT = shutil.which("prlimit") if is_posix else None
 
-PSUTIL_ATTRS = (
-    "cmdline",
-    "cpu_times",
-    "create_time",
-    "cwd",
-    "exe",
-    "memory_full_info",
-    "name",
-    "num_ctx_switches",
-    "num_fds",
-    "num_threads",
-    "open_files",
-)
+# global: a process replaced (reload) never reuses the version of the old one
+STATE_VERSIONS = itertools.count()
+
+SPAWN_LATENCY = histogram("spawn_latency", "Time to create a program process")
 
 
 class ProcessState(enum.IntEnum):
@@ -37,6 +35,7 @@ class ProcessState(enum.IntEnum):
     Stopping = 4
     Exited = 5
     Fatal = 6
+    Unhealthy = 7
     Unknown = 1000
 
     @property
@@ -62,7 +61,14 @@ STOPPED_STATES = {
     ProcessState.Fatal,
     ProcessState.Unknown,
 }
-RUNNING_STATES = {ProcessState.Starting, ProcessState.Running, ProcessState.Backoff}
+RUNNING_STATES = {
+    ProcessState.Starting,
+    ProcessState.Running,
+    ProcessState.Unhealthy,
+    ProcessState.Backoff,
+}
+# states in which the process is up and was found ready
+UP_STATES = {ProcessState.Running, ProcessState.Unhealthy}
 STARTABLE_STATES = {
     ProcessState.Stopped,
     ProcessState.Exited,
@@ -72,22 +78,31 @@ STARTABLE_STATES = {
 STOPPABLE_STATES = {
     ProcessState.Starting,
     ProcessState.Running,
+    ProcessState.Unhealthy,
     ProcessState.Backoff,
     ProcessState.Unknown,
 }
 
 
-def get_ps(pid):
-    if psutil is None or pid is None:
-        return {}
-    try:
-        proc = psutil.Process(pid)
-        return {
-            k: v._asdict() if isinstance(v, tuple) else v
-            for k, v in proc.as_dict(PSUTIL_ATTRS).items()
-        }
-    except psutil.NoSuchProcess:
-        return {}
+# fields which can be requested individually (see Process.fields())
+INFO_FIELDS = {
+    "name": lambda proc: proc.name,
+    "state": lambda proc: proc.state.name,
+    "state_version": lambda proc: proc.state_version,
+    "pid": lambda proc: proc.pid,
+    "start_time": lambda proc: proc.start_time,
+    "stop_time": lambda proc: proc.stop_time,
+    "last_returncode": lambda proc: proc.last_returncode,
+    "last_error": lambda proc: proc.last_error,
+    "spawn_latency": lambda proc: proc.spawn_latency,
+    "restarts": lambda proc: proc.restarts,
+    "health": lambda proc: proc.health,
+    "tags": lambda proc: proc.config.get("tags", []),
+    "pool": lambda proc: proc.config.get("pool"),
+    "config": lambda proc: proc.config,
+    "ps": lambda proc: proc.ps(),
+    "ps_time": lambda proc: proc.ps_time,
+}
 
 
 async def wait_for(aw, timeout):
@@ -100,16 +115,44 @@ async def wait_for(aw, timeout):
 
 
 class Process:
-    def __init__(self, name, config):
+    def __init__(self, name, config, log_writer=None):
         self.name = name
         self.config = config
         self.state = ProcessState.Stopped
+        self.state_version = next(STATE_VERSIONS)
         self.start_time = None
         self.stop_time = None
         self.log = log.getChild(f"{type(self).__name__}.{name}")
         self.proc = None
         self.last_error = None
         self.last_returncode = None
+        self.spawn_latency = None
+        self.restarts = 0
+        self.start_finished = None
+        self.run_task = None
+        self.ready = None
+        self.health = dict(failures=0, last_error=None)
+        self.ps_data = {}
+        self.ps_time = None
+        self.ps_expensive = {}
+        self.ps_expensive_time = None
+        self.output = {
+            stream: RingBuffer(maxbytes)
+            for stream in OUTPUT_STREAMS
+            if (maxbytes := config[f"{stream}_capture_maxbytes"])
+        }
+        # the event loop only keeps weak references to the tasks
+        self.readers = set()
+        self.log_writer = log_writer
+        self.logfiles = {
+            stream: RotatingFile(
+                path,
+                config[f"{stream}_logfile_maxbytes"],
+                config[f"{stream}_logfile_backups"],
+            )
+            for stream in OUTPUT_STREAMS
+            if log_writer is not None and (path := config[f"{stream}_logfile"])
+        }
 
     @property
     def is_running(self):
@@ -139,7 +182,25 @@ class Process:
         )
 
     def ps(self):
-        return get_ps(self.pid)
+        """Last psutil snapshot taken by the sampler"""
+        if self.ps_expensive:
+            return dict(self.ps_data, **self.ps_expensive)
+        return self.ps_data
+
+    def set_ps(self, data, timestamp):
+        self.ps_data = data
+        self.ps_time = timestamp
+
+    def set_ps_expensive(self, data, timestamp):
+        changed = data != self.ps_expensive
+        self.ps_expensive = data
+        self.ps_expensive_time = timestamp
+        if changed:
+            self.info_changed()
+
+    def info_changed(self):
+        """Notify a change of info() other than a state change"""
+        signal("process_info").send(self)
 
     def info(self):
         return dict(
@@ -152,22 +213,69 @@ class Process:
                 last_returncode=self.last_returncode,
                 last_error=self.last_error,
                 pid=self.pid,
+                spawn_latency=self.spawn_latency,
+                restarts=self.restarts,
+                health=self.health,
+                state_version=self.state_version,
             ),
             ps=self.ps(),
+            ps_time=self.ps_time,
+            ps_expensive_time=self.ps_expensive_time,
         )
 
+    def fields(self, names):
+        """Cheap projection of info(): only the given INFO_FIELDS"""
+        return {name: INFO_FIELDS[name](self) for name in names}
+
+    def _resources(self):
+        return {
+            key: value
+            for key, value in self.config["resources"].items()
+            if value is not None
+        }
+
+    def _rlimit_mode(self):
+        """
+        How resource limits are applied to the child:
+
+        * None: no limits (fast vfork/posix_spawn path)
+        * "wrapper": exec through util-linux prlimit (fast path, applied before exec)
+        * "prlimit": resource.prlimit() on the child right after spawn
+        * "preexec": preexec_fn hook (slow fork+exec path)
+        """
+        if not is_posix or not self._resources():
+            return None
+        if PRLIMIT is not None:
+            return "wrapper"
+        if hasattr(resource, "prlimit"):
+            return "prlimit"
+        return "preexec"
+
     def _pre_exec(self):
-        if not (resources := self.config["resources"]):
-            return
-        for key, value in resources.items():
-            if value is None:
-                continue
+        for key, value in self._resources().items():
             res = getattr(resource, "RLIMIT_" + key.upper())
             soft, hard = resource.getrlimit(res)
             resource.setrlimit(res, (value, hard))
 
+    def _apply_prlimit(self, pid):
+        for key, value in self._resources().items():
+            res = getattr(resource, "RLIMIT_" + key.upper())
+            soft, hard = resource.prlimit(pid, res)
+            resource.prlimit(pid, res, (value, hard))
+
     def _create_process_args(self):
-        if self.config["shell"]:
+        """Returns (shell, args, kwargs)"""
+        mode = self._rlimit_mode()
+        shell = self.config["shell"]
+        if mode == "wrapper":
+            resources = self._resources().items()
+            limits = [f"--{key.lower()}={value}:" for key, value in resources]
+            if shell:
+                command = ["/bin/sh", "-c", self.config["command_line"]]
+            else:
+                command = self.config["command"]
+            shell, args = False, [PRLIMIT, *limits, "--", *command]
+        elif shell:
             args = [self.config["command_line"]]
         else:
             args = self.config["command"]
@@ -176,31 +284,67 @@ class Process:
             cwd=self.config["directory"],
             close_fds=True,
         )
+        for stream in self.output.keys() | self.logfiles.keys():
+            kwargs[stream] = subprocess.PIPE
         if is_posix:
             kwargs["start_new_session"] = True
             kwargs["user"] = self.config["user"]
-            kwargs["preexec_fn"] = self._pre_exec
+            if mode == "preexec":
+                kwargs["preexec_fn"] = self._pre_exec
         else:
             kwargs["creationflags"] = [subprocess.CREATE_NEW_PROCESS_GROUP]
-        return args, kwargs
+        return shell, args, kwargs
 
     async def _create_process(self):
-        args, kwargs = self._create_process_args()
-        if self.config["shell"]:
+        shell, args, kwargs = self._create_process_args()
+        if shell:
             create = asyncio.create_subprocess_shell
         else:
             create = asyncio.create_subprocess_exec
+        start = time.perf_counter()
         try:
-            return await create(*args, **kwargs)
+            proc = await create(*args, **kwargs)
         except Exception as error:
             self.log.error("Cannot start program: %r", error)
             self.last_error = str(error)
+            return
+        if self._rlimit_mode() == "prlimit":
+            try:
+                self._apply_prlimit(proc.pid)
+            except OSError as error:
+                self.log.warning("Cannot apply resource limits: %r", error)
+        self.spawn_latency = time.perf_counter() - start
+        observe(SPAWN_LATENCY, self.spawn_latency)
+        for stream in self.output.keys() | self.logfiles.keys():
+            reader = asyncio.create_task(
+                self._read_output(proc, stream), name=f"{self.name}-{stream}"
+            )
+            self.readers.add(reader)
+            reader.add_done_callback(self.readers.discard)
+        return proc
+
+    async def _read_output(self, proc, stream):
+        reader = getattr(proc, stream)
+        buffer = self.output.get(stream)
+        while data := await reader.read(OUTPUT_CHUNK_SIZE):
+            if buffer is not None:
+                buffer.write(data)
+            # looked up each time: the logfiles are gone once closed
+            if (logfile := self.logfiles.get(stream)) is not None:
+                self.log_writer.write(logfile, data)
+
+    def close_logfiles(self):
+        """Close the log files (the process is discarded)"""
+        for logfile in self.logfiles.values():
+            self.log_writer.close(logfile)
+        self.logfiles = {}
 
     def change_state(self, state):
         old_state = self.state
         if state == old_state:
             return
         self.state = state
+        self.state_version = next(STATE_VERSIONS)
         self.log.info("State changed from %s to %s", old_state.name, state.name)
         sig = signal("process_state")
         sig.send(self, old_state=old_state, new_state=state)
@@ -212,7 +356,34 @@ class Process:
             raise AIOVisorError(
                 f"{self.name!r} not in startable state (is {self.state.name})"
             )
-        asyncio.create_task(self._run(), name=self.name + "-loop")
+        if self.run_task is not None and not self.run_task.done():
+            # waiting for the next (re)start attempt: this start replaces it
+            self.run_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.run_task
+        self.start_finished = asyncio.Event()
+        self.run_task = asyncio.create_task(self._run(), name=self.name + "-loop")
+
+    async def wait_started(self):
+        """
+        Wait for the start sequence to finish (either Running or given up).
+        Returns the state reached.
+        """
+        if self.start_finished is not None:
+            await self.start_finished.wait()
+        return self.state
+
+    async def _start_loop(self):
+        attempt, attempts = 0, self.config["startretries"] + 1
+        while attempt < attempts:
+            attempt += 1
+            await self._try_start(attempt, attempts)
+            if self.state != ProcessState.Backoff:
+                break
+            await asyncio.sleep(self.backoff_delay(attempt))
+            if self.state != ProcessState.Backoff:
+                # stopped by user while waiting
+                break
 
     async def _try_start(self, attempt, attempts):
         self.log.info("Starting (attempt %d of %d)", attempt, attempts)
@@ -222,9 +393,12 @@ class Process:
             return
         self.change_state(ProcessState.Starting)
         self.proc = proc
-        startsecs = self.config["startsecs"]
         self.start_time = time.time()
-        done = await wait_for(self.proc.wait(), timeout=startsecs)
+        if self.config["healthcheck"] is None:
+            done = await wait_for(self.proc.wait(), timeout=self.config["startsecs"])
+            ready = not done
+        else:
+            done, ready = await self._wait_ready()
         if done:
             # process was stopped before reached running
             self.last_returncode = self.proc.returncode
@@ -239,30 +413,102 @@ class Process:
             else:
                 self.log.error("Give up start (attempt %d of %d)", attempt, attempts)
                 self.change_state(ProcessState.Fatal)
-        else:
+        elif ready:
             self.log.info("Successfull start")
             self.change_state(ProcessState.Running)
+        else:
+            timeout = self.config["healthcheck"]["start_timeout"]
+            self.log.warning("Not ready after %g seconds. Killing it", timeout)
+            self.last_error = f"not ready after {timeout:g} seconds"
+            self.proc.kill()
+            self.last_returncode = await self.proc.wait()
+            if self.state == ProcessState.Stopping:
+                self.change_state(ProcessState.Stopped)
+            elif attempt < attempts:
+                self.change_state(ProcessState.Backoff)
+            else:
+                self.log.error("Give up start (attempt %d of %d)", attempt, attempts)
+                self.change_state(ProcessState.Fatal)
 
-    async def _run(self):
-        attempt, attempts = 0, self.config["startretries"] + 1
-        while attempt < attempts:
-            attempt += 1
-            await self._try_start(attempt, attempts)
-            if self.state != ProcessState.Backoff:
-                break
-            await asyncio.sleep(attempt)
+    async def _wait_ready(self):
+        """
+        Wait for the health checker to find the process ready (see
+        set_ready()) or for the process to exit, whichever comes first.
+        Returns (exited, ready)
+        """
+        self.ready = asyncio.get_running_loop().create_future()
+        exited = asyncio.ensure_future(self.proc.wait())
+        try:
+            await asyncio.wait(
+                (exited, self.ready),
+                timeout=self.config["healthcheck"]["start_timeout"],
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+        finally:
+            exited.cancel()
+            ready, self.ready = self.ready.done(), None
+        return exited.done() and not exited.cancelled(), ready
 
-        if self.state != ProcessState.Running:
-            return
+    def set_ready(self):
+        """Called by the health checker on the first successful check"""
+        if self.ready is not None and not self.ready.done():
+            self.ready.set_result(True)
 
-        self.last_returncode = await self.proc.wait()
-        if self.state in {ProcessState.Stopping, ProcessState.Stopped}:
-            return
-        # Process finished by itself
-        self.stop_time = time.time()
-        dt = self.stop_time - self.start_time
-        self.log.info("Process exited by itself after %g seconds", dt)
-        self.change_state(ProcessState.Exited)
+    async def _run(self):
+        try:
+            await self._start_loop()
+        finally:
+            self.start_finished.set()
+
+        attempt = 0
+        while self.state in UP_STATES:
+            self.last_returncode = await self.proc.wait()
+            if self.state in {ProcessState.Stopping, ProcessState.Stopped}:
+                return
+            # Process finished by itself
+            self.stop_time = time.time()
+            dt = self.stop_time - self.start_time
+            self.log.info("Process exited by itself after %g seconds", dt)
+            self.change_state(ProcessState.Exited)
+            if not self._should_restart(self.last_returncode):
+                return
+            # a process which was up longer than the maximum delay is
+            # considered stable: restart the backoff sequence
+            attempt = 1 if dt > self.config["backoff_max"] else attempt + 1
+            delay = self.backoff_delay(attempt)
+            self.log.info("Restarting in %g seconds", delay)
+            self.change_state(ProcessState.Backoff)
+            await asyncio.sleep(delay)
+            if self.state != ProcessState.Backoff:
+                # stopped (or started) by user while waiting
+                return
+            self.restarts += 1
+            self.info_changed()
+            await self._start_loop()
+
+    def _should_restart(self, returncode):
+        autorestart = self.config["autorestart"]
+        if autorestart == "unexpected":
+            return returncode not in self.config["exitcodes"]
+        return bool(autorestart)
+
+    def backoff_delay(self, attempt):
+        """
+        Exponential delay before the given attempt (starting at 1) with
+        random jitter so programs don't restart in lockstep
+        """
+        cfg = self.config
+        delay = cfg["backoff_initial"] * cfg["backoff_factor"] ** (attempt - 1)
+        delay = min(delay, cfg["backoff_max"])
+        jitter = cfg["backoff_jitter"]
+        return delay * random.uniform(1 - jitter, 1 + jitter)
+
+    async def restart(self):
+        """Stops (if needed) and starts. Returns the state reached by the start"""
+        if self.state.is_stoppable:
+            await self.stop()
+        await self.start()
+        return await self.wait_started()
 
     async def stop(self):
         if self.state == ProcessState.Stopped:
@@ -277,8 +523,15 @@ class Process:
         return await self._stop()
 
     async def _stop(self):
+        with timed("stop", "Time to stop a program"):
+            return await self._do_stop()
+
+    async def _do_stop(self):
         proc = self.proc
         if proc is None or proc.returncode is not None:
+            if self.state == ProcessState.Backoff:
+                # waiting to be (re)started: cancel it
+                self.change_state(ProcessState.Stopped)
             return
         start_stop_time = time.monotonic()
         self.change_state(ProcessState.Stopping)
@@ -0,0 +1,182 @@
+import time
+import asyncio
+
+try:
+    import psutil
+except ModuleNotFoundError:
+    psutil = None
+
+from ..util import log
+from .metrics import timed
+
+
+# cheap tier: read from /proc/<pid>/stat, status and cmdline
+CHEAP_ATTRS = (
+    "cmdline",
+    "cpu_times",
+    "create_time",
+    "memory_info",
+    "name",
+    "num_ctx_switches",
+    "num_fds",
+    "num_threads",
+)
+
+# expensive tier: walks /proc/<pid>/fd, smaps and the socket tables
+EXPENSIVE_ATTRS = (
+    "cwd",
+    "exe",
+    "memory_full_info",
+    "net_connections",
+    "open_files",
+)
+
+PSUTIL_ATTRS = CHEAP_ATTRS + EXPENSIVE_ATTRS
+
+
+def ps_to_dict(handle, attrs):
+    return {
+        k: v._asdict() if isinstance(v, tuple) else v
+        for k, v in handle.as_dict(attrs).items()
+    }
+
+
+def get_ps(pid, attrs=PSUTIL_ATTRS):
+    if psutil is None or pid is None:
+        return {}
+    try:
+        return ps_to_dict(psutil.Process(pid), attrs)
+    except psutil.NoSuchProcess:
+        return {}
+
+
+class Sampler:
+    """
+    Periodically refreshes the psutil information of every supervised
+    process in a single batch which runs in a worker thread.
+
+    The psutil.Process handles are kept between passes so psutil can
+    reuse its cached data. Results are stored in each process
+    ``ps`` snapshot together with the time they were taken.
+
+    Attributes are split in two tiers: the *cheap* tier is sampled every
+    ``interval`` seconds and the *expensive* one every ``expensive_interval``
+    seconds (or only on demand if ``expensive_interval`` is 0).
+    Programs may override the attributes of each tier with their own
+    ``sampler`` configuration.
+    """
+
+    def __init__(self, aiovisor, config):
+        self.aiovisor = aiovisor
+        self.config = config
+        self.handles = {}
+        self.task = None
+        self.last_time = None
+        self.last_expensive_time = None
+        self.last_duration = None
+        self.log = log.getChild("sampler")
+
+    @property
+    def interval(self):
+        return self.config["interval"]
+
+    @property
+    def expensive_interval(self):
+        return self.config["expensive_interval"]
+
+    def attrs(self, proc):
+        """(cheap, expensive) attributes for the given process"""
+        cfg = proc.config["sampler"]
+        cheap = cfg.get("cheap", self.config["cheap"])
+        expensive = cfg.get("expensive", self.config["expensive"])
+        return tuple(cheap), tuple(expensive)
+
+    def _expensive_due(self, now):
+        interval = self.expensive_interval
+        if not interval:
+            return False
+        last = self.last_expensive_time
+        return last is None or now - last >= interval
+
+    def start(self):
+        if psutil is None:
+            self.log.warning("psutil not installed: process stats disabled")
+            return
+        if self.task is None:
+            self.task = asyncio.create_task(self._loop(), name="sampler")
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.sample()
+            except Exception:
+                self.log.exception("Error sampling processes")
+            await asyncio.sleep(self.interval)
+
+    async def sample(self, expensive=None):
+        if expensive is None:
+            expensive = self._expensive_due(time.time())
+        procs = [(proc, proc.pid) for proc in self.aiovisor.procs.values()]
+        jobs = []
+        for proc, pid in procs:
+            if pid is None:
+                continue
+            cheap_attrs, expensive_attrs = self.attrs(proc)
+            jobs.append((pid, cheap_attrs, expensive_attrs if expensive else ()))
+        with timed("get_ps", "psutil sampling", mode="batch"):
+            start = time.monotonic()
+            samples = await asyncio.to_thread(self._sample, jobs)
+            self.last_duration = time.monotonic() - start
+        self.last_time = now = time.time()
+        if expensive:
+            self.last_expensive_time = now
+        for proc, pid in procs:
+            if pid is None:
+                # not running: only forget the data of the last run
+                if proc.ps_data or proc.ps_expensive:
+                    proc.set_ps({}, now)
+                    proc.set_ps_expensive({}, now)
+                continue
+            cheap, expensive_data = samples.get(pid, ({}, None))
+            proc.set_ps(cheap, now)
+            if expensive_data is not None or pid not in samples:
+                proc.set_ps_expensive(expensive_data or {}, now)
+
+    def _sample(self, jobs):
+        """Runs in a worker thread. Only one pass runs at any time"""
+        handles = self.handles
+        for pid in set(handles).difference(job[0] for job in jobs):
+            del handles[pid]
+        result = {}
+        for pid, cheap_attrs, expensive_attrs in jobs:
+            try:
+                handle = handles.get(pid)
+                if handle is None or not handle.is_running():
+                    handle = handles[pid] = psutil.Process(pid)
+                with handle.oneshot():
+                    cheap = ps_to_dict(handle, cheap_attrs)
+                    expensive = (
+                        ps_to_dict(handle, expensive_attrs) if expensive_attrs else None
+                    )
+                result[pid] = cheap, expensive
+            except psutil.NoSuchProcess:
+                handles.pop(pid, None)
+        return result
+
+    async def sample_expensive(self, proc):
+        """On demand refresh of the expensive tier of a single process"""
+        _, attrs = self.attrs(proc)
+        with timed("get_ps", "psutil sampling", mode="single"):
+            data = await asyncio.to_thread(get_ps, proc.pid, attrs)
+        proc.set_ps_expensive(data, time.time())
+        return data
@@ -1,38 +1,229 @@
+import json
 import asyncio
+import codecs
 
-from aiohttp import web
+from aiohttp import ETag, WSCloseCode, WSMsgType, web
+from aiohttp_sse import sse_response
 
-from aiovisor.util import log, signal
+from aiovisor.util import log, AIOVisorError
+from aiovisor.server.web.bus import EventBus, SlowConsumer
+from aiovisor.server.metrics import histograms_info, timed
+from aiovisor.server.process import INFO_FIELDS, ProcessState
+from aiovisor.server.web import prometheus
+
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 log = log.getChild("web.api")
 
+# smaller responses are not worth compressing
+COMPRESS_MIN_SIZE = 1024
+
+# fields which depend on the sampler snapshot
+PS_FIELDS = {"ps", "ps_time"}
+
+# keys of the application state
+AIOVISOR_KEY = web.AppKey("aiovisor")
+BUS_KEY = web.AppKey("bus")
+CLIENTS_KEY = web.AppKey("clients")
+SSE_CLIENTS_KEY = web.AppKey("sse_clients")
+PROCESS_METRICS_KEY = web.AppKey("process_metrics")
+
 api = web.RouteTableDef()
 
 
+def json_dumps(data):
+    """JSON encoded bytes (with orjson if installed)"""
+    if orjson is None:
+        return json.dumps(data).encode()
+    return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+
+def json_response(data, etag=None):
+    """
+    JSON response, compressed (gzip or deflate as accepted by the client)
+    when large enough, with an optional (weak) ETag
+    """
+    with timed("json_encode", "Encode a JSON response"):
+        body = json_dumps(data)
+    response = web.Response(body=body, content_type="application/json")
+    if etag is not None:
+        response.etag = ETag(value=etag, is_weak=True)
+    if len(body) >= COMPRESS_MIN_SIZE:
+        response.enable_compression()
+    return response
+
+
+def not_modified(request, etag):
+    """Raises 304 Not Modified if If-None-Match matches the etag"""
+    if_none_match = request.if_none_match
+    if if_none_match and any(tag.value in {etag, "*"} for tag in if_none_match):
+        raise web.HTTPNotModified(headers={"ETag": f'W/"{etag}"'})
+
+
+def query_fields(request, known=INFO_FIELDS):
+    if (fields := request.query.get("fields")) is None:
+        return None
+    fields = [field for field in fields.split(",") if field]
+    if unknown := [field for field in fields if field not in known]:
+        raise web.HTTPBadRequest(text=f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+
+def query_state(request):
+    if (state := request.query.get("state")) is None:
+        return None
+    try:
+        return ProcessState[state]
+    except KeyError:
+        raise web.HTTPBadRequest(text=f"Unknown state {state!r}")
+
+
 @api.get("/processes")
 async def processes(request):
-    aiovisor = request.app["aiovisor"]
-    return web.json_response({name: p.info() for name, p in aiovisor.procs.items()})
+    """
+    Processes filtered by ?state=<state>, ?tag=<tag> and ?match=<glob>.
+    ?fields=name,pid returns only the given fields of each process.
+    """
+    aiovisor = request.app[AIOVISOR_KEY]
+    # number of the last event included in the response
+    seq = request.app[BUS_KEY].seq
+    fields = query_fields(request)
+    # pid: versions restart from 0 with the server
+    etag = f"{aiovisor.pid}-{aiovisor.version}"
+    if fields is None or PS_FIELDS.intersection(fields):
+        etag += f"-{aiovisor.sampler.last_time}"
+    not_modified(request, etag)
+    procs = aiovisor.select(
+        tag=request.query.get("tag"),
+        pattern=request.query.get("match"),
+        state=query_state(request),
+    )
+    if fields is None:
+        result = {proc.name: proc.info() for proc in procs}
+    else:
+        result = {proc.name: proc.fields(fields) for proc in procs}
+    response = json_response(result, etag=etag)
+    response.headers["X-Aiovisor-Seq"] = str(seq)
+    return response
 
 
 @api.get("/process/info/{name}")
 async def process_info(request):
-    aiovisor = request.app["aiovisor"]
+    aiovisor = request.app[AIOVISOR_KEY]
     name = request.match_info["name"]
     process = aiovisor.process(name)
+    if request.query.get("expensive", "").lower() in {"1", "true", "yes"}:
+        await aiovisor.sampler.sample_expensive(process)
     return web.json_response(process.info())
 
 
+def process_output(request):
+    aiovisor = request.app[AIOVISOR_KEY]
+    name = request.match_info["name"]
+    stream = request.query.get("stream", "stdout")
+    try:
+        return aiovisor.process(name).output[stream]
+    except KeyError:
+        raise web.HTTPNotFound(text=f"{stream!r} of {name!r} is not captured")
+
+
+def query_tail(request):
+    return query_int(request, "tail")
+
+
+@api.get("/process/{name}/log")
+async def process_log(request):
+    output = process_output(request)
+    data = output.tail(query_tail(request))
+    return web.Response(body=data, content_type="text/plain", charset="utf-8")
+
+
+async def send_output(sse, output, tail):
+    decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    position = output.position
+    if tail != 0:
+        await sse.send(decoder.decode(output.tail(tail)), event="log")
+    try:
+        async for chunk in output.follow(position):
+            await sse.send(decoder.decode(chunk), event="log")
+    except ConnectionResetError:
+        log.info("Client closed log stream")
+
+
+@api.get("/process/{name}/log/follow")
+async def process_log_follow(request):
+    output = process_output(request)
+    tail = query_tail(request)
+    async with sse_response(request) as sse:
+        request.app[SSE_CLIENTS_KEY].add(sse)
+        sender = asyncio.create_task(send_output(sse, output, tail))
+        try:
+            await sse.wait()
+        finally:
+            sender.cancel()
+            request.app[SSE_CLIENTS_KEY].discard(sse)
+    return sse
+
+
+@api.get("/metrics")
+async def metrics(request):
+    aiovisor = request.app[AIOVISOR_KEY]
+    running = int(aiovisor.state.name == "Running")
+    lag = aiovisor.loop_monitor.lag
+    ws_clients, sse_clients = request.app[CLIENTS_KEY], request.app[SSE_CLIENTS_KEY]
+    gauges = (
+        ("aiovisor_up", "Supervisor is running", running),
+        ("aiovisor_processes", "Supervised processes", len(aiovisor.procs)),
+        ("aiovisor_event_loop_lag_seconds", "Event loop lag", lag),
+        ("aiovisor_websocket_clients", "Websocket clients", len(ws_clients)),
+        ("aiovisor_sse_clients", "SSE clients", len(sse_clients)),
+    )
+    text = prometheus.render(aiovisor, request.app[PROCESS_METRICS_KEY], gauges)
+    return web.Response(text=text, headers={"Content-Type": prometheus.CONTENT_TYPE})
+
+
+@api.get("/stats")
+async def stats(request):
+    aiovisor = request.app[AIOVISOR_KEY]
+    sampler = aiovisor.sampler
+    return web.json_response(
+        dict(
+            loop_lag=aiovisor.loop_monitor.lag,
+            sampler=dict(
+                last_time=sampler.last_time,
+                last_duration=sampler.last_duration,
+                last_expensive_time=sampler.last_expensive_time,
+            ),
+            histograms=histograms_info(),
+        )
+    )
+
+
 @api.get("/state")
 async def state(request):
-    aiovisor = request.app["aiovisor"]
+    aiovisor = request.app[AIOVISOR_KEY]
     return web.json_response({"state": aiovisor.state.name})
 
 
+@api.post("/reload")
+async def reload(request):
+    """Reload the configuration file and apply the program changes"""
+    aiovisor = request.app[AIOVISOR_KEY]
+    try:
+        result = await aiovisor.reload()
+    except AIOVisorError as error:
+        raise web.HTTPBadRequest(text=str(error))
+    return web.json_response(dict(result, result="ACK"))
+
+
 @api.post("/process/stop/{name}")
 async def process_stop(request):
-    aiovisor = request.app["aiovisor"]
+    aiovisor = request.app[AIOVISOR_KEY]
     name = request.match_info["name"]
     process = aiovisor.process(name)
     await process.stop()
@@ -41,74 +232,171 @@ async def process_stop(request):
 
 @api.post("/process/start/{name}")
 async def process_start(request):
-    aiovisor = request.app["aiovisor"]
+    aiovisor = request.app[AIOVISOR_KEY]
     name = request.match_info["name"]
     process = aiovisor.process(name)
     await process.start()  # TODO: Convert to background task
     return web.json_response({"result": "ACK"})
 
 
-@api.get("/ws")
-async def ws(request):
-    def on_server_state_event(sender, old_state, new_state):
-        queue.put_nowait(
-            dict(
-                event_type="server_state",
-                old_state=old_state.name,
-                new_state=new_state.name,
-                server=sender.info(),
-            )
-        )
+@api.post("/process/kill/{name}")
+async def process_kill(request):
+    aiovisor = request.app[AIOVISOR_KEY]
+    name = request.match_info["name"]
+    process = aiovisor.process(name)
+    await process.kill()
+    return web.json_response({"result": "ACK"})
 
-    def on_process_state_event(sender, old_state, new_state):
-        queue.put_nowait(
-            dict(
-                event_type="process_state",
-                old_state=old_state.name,
-                new_state=new_state.name,
-                process=sender.info(),
-            )
+
+def query_int(request, name, convert=int):
+    value = request.query.get(name)
+    if value is None:
+        return None
+    try:
+        return convert(value)
+    except ValueError:
+        raise web.HTTPBadRequest(text=f"Invalid {name} {value!r}")
+
+
+async def bulk_response(request, procs):
+    aiovisor = request.app[AIOVISOR_KEY]
+    action = request.match_info["action"]
+    try:
+        results = await aiovisor.bulk(
+            action,
+            procs,
+            concurrency=query_int(request, "concurrency"),
+            batch_size=query_int(request, "batch_size"),
         )
+    except AIOVisorError as error:
+        raise web.HTTPBadRequest(text=str(error))
+    ok = all(result["result"] == "ACK" for result in results.values())
+    return web.json_response(
+        {"result": "ACK" if ok else "ERROR", "processes": results}
+    )
+
+
+async def rolling_restart_response(request, procs):
+    aiovisor = request.app[AIOVISOR_KEY]
+    result = await aiovisor.rolling_restart(
+        procs,
+        batch_size=query_int(request, "batch_size") or 1,
+        timeout=query_int(request, "timeout", float),
+    )
+    return web.json_response(result)
+
+
+@api.post("/group/{tag}/rolling-restart")
+async def group_rolling_restart(request):
+    aiovisor = request.app[AIOVISOR_KEY]
+    procs = aiovisor.select(tag=request.match_info["tag"])
+    return await rolling_restart_response(request, procs)
 
+
+@api.post("/group/{tag}/{action}")
+async def group_action(request):
+    aiovisor = request.app[AIOVISOR_KEY]
+    procs = aiovisor.select(tag=request.match_info["tag"])
+    return await bulk_response(request, procs)
+
+
+@api.post("/processes/{action}")
+async def processes_action(request):
+    """Bulk action on processes selected by ?tag=<tag> and/or ?match=<glob>"""
+    aiovisor = request.app[AIOVISOR_KEY]
+    procs = aiovisor.select(
+        tag=request.query.get("tag"), pattern=request.query.get("match")
+    )
+    return await bulk_response(request, procs)
+
+
+@api.get("/pools")
+async def pools(request):
+    aiovisor = request.app[AIOVISOR_KEY]
+    return web.json_response(aiovisor.pools())
+
+
+@api.post("/pool/{name}/scale/{numprocs}")
+async def pool_scale(request):
+    aiovisor = request.app[AIOVISOR_KEY]
+    name = request.match_info["name"]
+    try:
+        result = await aiovisor.scale(name, int(request.match_info["numprocs"]))
+    except (AIOVisorError, ValueError) as error:
+        raise web.HTTPBadRequest(text=str(error))
+    return web.json_response(dict(result, result="ACK"))
+
+
+@api.post("/pool/{name}/rolling-restart")
+async def pool_rolling_restart(request):
+    aiovisor = request.app[AIOVISOR_KEY]
+    try:
+        procs = aiovisor.pool(request.match_info["name"])
+    except AIOVisorError as error:
+        raise web.HTTPBadRequest(text=str(error))
+    return await rolling_restart_response(request, procs)
+
+
+@api.get("/ws")
+async def ws(request):
+    """
+    Stream of state events. Each event has a ``seq`` number: reconnecting
+    with ?since=<seq> first sends the events missed meanwhile (or a
+    ``resync`` event if they are no longer available)
+    """
+    # before the handshake: errors are still plain HTTP responses
+    since = query_int(request, "since")
     ws = web.WebSocketResponse()
     await ws.prepare(request)
 
     log.info("Client %s connected to stream", request.remote)
-    request.app["clients"].add(ws)
+    bus = request.app[BUS_KEY]
+    request.app[CLIENTS_KEY].add(ws)
+    subscriber, missed = bus.subscribe(name=request.remote, since=since)
     try:
-        sstate = signal("server_state")
-        pstate = signal("process_state")
-        sstate.connect(on_server_state_event)
-        pstate.connect(on_process_state_event)
-        queue = asyncio.Queue()
-        try:
-            while True:
-                data = await queue.get()
-                log.info("Sending %s to %s", data["event_type"], request.remote)
-                await ws.send_json(data)
-        finally:
-            pstate.disconnect(on_process_state_event)
-            sstate.disconnect(on_server_state_event)
+        if missed is None:
+            # cannot resume: the client must fetch the whole state again
+            resync = dict(event_type="resync", seq=bus.seq)
+            await ws.send_frame(json_dumps(resync), WSMsgType.TEXT)
+        else:
+            for event_type, data in missed:
+                await ws.send_frame(data, WSMsgType.TEXT)
+        while (event := await subscriber.get()) is not None:
+            event_type, data = event
+            log.debug("Sending %s to %s", event_type, request.remote)
+            with timed("ws_send", "Send an event to a websocket client"):
+                await ws.send_frame(data, WSMsgType.TEXT)
+        # the bus was disconnected: the server is shutting down
+        await ws.close(code=WSCloseCode.GOING_AWAY, message=b"server shutdown")
+    except SlowConsumer as error:
+        log.warning("Disconnecting %s: %s", request.remote, error)
+        await ws.close(code=WSCloseCode.TRY_AGAIN_LATER, message=b"slow consumer")
     except ConnectionResetError:
         log.info("ws connection reset")
     finally:
-        request.app["clients"].remove(ws)
+        bus.unsubscribe(subscriber)
+        request.app[CLIENTS_KEY].remove(ws)
     return ws
 
 
 async def on_shutdown(app):
-    clients = set(app["clients"])
+    app[BUS_KEY].disconnect()
+    clients = set(app[CLIENTS_KEY])
     if clients:
         # ugly hack: wait for server_state to be sent to all WS clients
         await asyncio.sleep(0.1)
         for client in clients:
-            await client.close()
+            await client.close(code=WSCloseCode.GOING_AWAY, message=b"server shutdown")
 
 
 async def create_app(aiovisor):
     api_app = web.Application()
     api_app.add_routes(api)
-    api_app["aiovisor"] = aiovisor
-    api_app["clients"] = set()
+    api_app[AIOVISOR_KEY] = aiovisor
+    api_app[CLIENTS_KEY] = set()
+    api_app[SSE_CLIENTS_KEY] = set()
+    api_app[PROCESS_METRICS_KEY] = prometheus.ProcessMetrics()
+    api_app[BUS_KEY] = bus = EventBus(aiovisor.config["web"]["ws"], aiovisor)
+    bus.connect()
     api_app.on_shutdown.append(on_shutdown)
     return api_app
@@ -1,18 +1,33 @@
 import asyncio
+import codecs
+import contextlib
 import datetime
 import functools
+import html
+import os
 import pathlib
+import signal as signals
+import socket
+import stat
+import time
 
 from aiohttp import ClientConnectionResetError, web
 from aiohttp_sse import sse_response
 
-from aiovisor.util import log, setup_event_loop, signal
+from aiovisor.util import AIOVisorError, is_posix, log, setup_event_loop, signal
+from aiovisor.server.metrics import histogram, observe, timed
+from aiovisor.server.web.api import AIOVISOR_KEY, SSE_CLIENTS_KEY, process_output
 from aiovisor.server.web.api import create_app as create_api
 
 log = log.getChild("web.app")
 
 routes = web.RouteTableDef()
 
+ROW_CACHE_KEY = web.AppKey("row_cache")
+START_TASK_KEY = web.AppKey("start_task")
+# reloads requested by SIGHUP (the loop only keeps weak references)
+RELOAD_TASKS_KEY = web.AppKey("reload_tasks")
+
 
 def HTML(text, **kwargs):
     return web.Response(text=text, content_type="text/html", **kwargs)
@@ -21,10 +36,12 @@ def HTML(text, **kwargs):
 DATASTAR_PATCH_ELEMENTS = "datastar-patch-elements"
 
 
-def datastar_patch_elements(sse, elements: str, mode=None):
+def datastar_patch_elements(sse, elements: str, mode=None, selector=None):
     lines = []
+    if selector is not None:
+        lines.append(f"selector {selector}")
     if mode is not None and mode != "outer":
-        lines.append("mode {mode}")
+        lines.append(f"mode {mode}")
     lines.extend(f"elements {line}" for line in elements.splitlines())
 
     return sse.send("\n".join(lines), event=DATASTAR_PATCH_ELEMENTS)
@@ -48,6 +65,14 @@ def Button(text, post, disabled=False):
     return BUTTON.format(text=text, post=post, attrs=" ".join(attrs))
 
 
+LINK_BUTTON = """<button data-on:click="window.open('{href}')" {attrs}>{text}</button>"""
+
+
+def LinkButton(text, href, disabled=False):
+    attrs = ["disabled"] if disabled else []
+    return LINK_BUTTON.format(text=text, href=href, attrs=" ".join(attrs))
+
+
 PAGE = """\
 <!DOCTYPE html>
 <html lang="en">
@@ -74,6 +99,28 @@ PAGE = """\
 """
 
 
+LOG_PAGE = """\
+<!DOCTYPE html>
+<html lang="en">
+
+<head>
+  <title>AIOVisor {title}</title>
+  <meta http-equiv="Content-Type" content="text/html; charset=utf-8" />
+  <script type="module" src="/static/datastar.js"></script>
+  <link rel="stylesheet" type="text/css" href="/static/style.css">
+</head>
+
+<body style="margin: 0px; padding-top: 40px;">
+  <nav style="background-color: #aabbbb; position: fixed; width:100%; top: 0; padding: 10px 20px;">
+    AIOVisor {title}
+  </nav>
+  <pre id="log" class="log" data-init="@get('{events}')"></pre>
+</body>
+
+</html>
+"""
+
+
 class Column:
     def __init__(self, name, getter, classes=None):
         self.name = name
@@ -102,6 +149,11 @@ def render_process_buttons(proc):
             Button(START, f"/process/start/{name}", disabled=not state.is_startable),
             Button(STOP, f"/process/stop/{name}", disabled=not state.is_stoppable),
             Button(KILL, f"/process/kill/{name}", disabled=not state.is_stoppable),
+            LinkButton(
+                LOGS,
+                f"/process/logs/{name}",
+                disabled=not proc["config"]["stdout_capture_maxbytes"],
+            ),
         )
     )
 
@@ -117,7 +169,7 @@ class ProcessTable:
         Column("Stopped", lambda p: human_timestamp(p["state"]["stop_time"])),
         Column(
             "RSS",
-            lambda p: human_bytes(p["ps"].get("memory_full_info", {}).get("rss")),
+            lambda p: human_bytes(p["ps"].get("memory_info", {}).get("rss")),
         ),
         Column("Command", lambda p: p["ps"].get("cmdline")),
         Column("Process name", lambda p: p["ps"].get("name")),
@@ -169,6 +221,30 @@ class ProcessTable:
         return "\n".join(self.iter_render())
 
 
+class RowCache:
+    """
+    Rendered rows cached per process state version and sampler snapshot
+    (the RSS and command columns)
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.rows = {}
+
+    def render(self, proc):
+        cached = self.rows.get(proc.name)
+        key = proc.state_version, proc.ps_time
+        if cached is None or cached[0] != key:
+            with timed("render_row", "Render a process table row"):
+                cached = key, self.table.render_row(proc)
+            self.rows[proc.name] = cached
+        return cached[1]
+
+    def forget(self, names):
+        for name in set(self.rows).difference(names):
+            del self.rows[name]
+
+
 def human_bytes(num_bytes: int | None) -> str:
     if num_bytes is None:
         return "---"
@@ -193,31 +269,108 @@ def value_to_text(value):
 
 @routes.get("/")
 async def index(request):
-    aiovisor = request.app["aiovisor"]
-    processes = ProcessTable(aiovisor)
+    aiovisor = request.app[AIOVISOR_KEY]
+    with timed("render_table", "Render the process table"):
+        processes = "\n".join(ProcessTable(aiovisor).iter_render())
     return HTML(PAGE.format(title=aiovisor.config["main"]["name"], processes=processes))
 
 
 @routes.get("/processes/table/events")
 async def processes_events(request):
-    table = ProcessTable(request.app["aiovisor"])
-    events = asyncio.Queue()
+    rows = request.app[ROW_CACHE_KEY]
+    window = request.app[AIOVISOR_KEY].config["web"]["sse"]["coalesce_window"]
+    table = rows.table
+    pending = {}
+    ready = asyncio.Event()
+    # processes were added or removed: the whole body must be sent
+    reset = False
 
     def on_process_state_event(sender, old_state, new_state):
-        events.put_nowait(sender)
+        # signals are global: ignore the processes of other servers
+        if table.aiovisor.procs.get(sender.name) is sender:
+            pending[sender.name] = sender
+            ready.set()
+
+    def on_process_list_event(sender, added, removed):
+        nonlocal reset
+        if sender is not table.aiovisor:
+            return
+        reset = True
+        ready.set()
 
     state_event = signal("process_state")
     state_event.connect(on_process_state_event)
+    list_event = signal("process_list")
+    list_event.connect(on_process_list_event)
     try:
         async with sse_response(request) as sse:
+            request.app[SSE_CLIENTS_KEY].add(sse)
             while sse.is_connected():
-                proc = await events.get()
-                text = table.render_row(proc)
+                await ready.wait()
+                if window:
+                    # merge bursts of updates (ex: Starting -> Backoff -> Starting)
+                    await asyncio.sleep(window)
+                ready.clear()
+                if reset:
+                    procs = table.aiovisor.procs.values()
+                else:
+                    procs = list(pending.values())
+                pending.clear()
+                text = "\n".join(rows.render(proc) for proc in procs)
+                if reset:
+                    reset = False
+                    rows.forget(table.aiovisor.procs)
+                    body = table.table_id + "-body"
+                    text = f'<tbody id="{body}">\n{text}\n</tbody>'
                 await datastar_patch_elements(sse, text)
     except ClientConnectionResetError:
         log.info("Client closed connection")
     finally:
+        list_event.disconnect(on_process_list_event)
         state_event.disconnect(on_process_state_event)
+        request.app[SSE_CLIENTS_KEY].discard(sse)
+    return sse
+
+
+@routes.get("/process/logs/{name}")
+async def process_logs(request):
+    aiovisor = request.app[AIOVISOR_KEY]
+    name = request.match_info["name"]
+    process_output(request)
+    title = f"{aiovisor.config['main']['name']} - {name} stdout"
+    events = f"/process/logs/{name}/events"
+    return HTML(LOG_PAGE.format(title=html.escape(title), events=events))
+
+
+@routes.get("/process/logs/{name}/events")
+async def process_logs_events(request):
+    output = process_output(request)
+    decoder = codecs.getincrementaldecoder("utf-8")("replace")
+
+    async def send(data):
+        # keep the chunk in a single line: elements are split by line
+        text = html.escape(decoder.decode(data)).replace("\n", "&#10;")
+        await datastar_patch_elements(
+            sse, f"<span>{text}</span>", mode="append", selector="#log"
+        )
+
+    async def send_output():
+        position = output.position
+        try:
+            await send(output.read())
+            async for chunk in output.follow(position):
+                await send(chunk)
+        except ConnectionResetError:
+            log.info("Client closed connection")
+
+    async with sse_response(request) as sse:
+        request.app[SSE_CLIENTS_KEY].add(sse)
+        sender = asyncio.create_task(send_output())
+        try:
+            await sse.wait()
+        finally:
+            sender.cancel()
+            request.app[SSE_CLIENTS_KEY].discard(sse)
     return sse
 
 
@@ -237,7 +390,7 @@ def process_action(f):
 @routes.post("/process/start/{name}")
 @process_action
 async def process_start(request):
-    aiovisor = request.app["aiovisor"]
+    aiovisor = request.app[AIOVISOR_KEY]
     name = request.match_info["name"]
     process = aiovisor.process(name)
     await process.start()
@@ -246,7 +399,7 @@ async def process_start(request):
 @routes.post("/process/stop/{name}")
 @process_action
 async def process_stop(request):
-    aiovisor = request.app["aiovisor"]
+    aiovisor = request.app[AIOVISOR_KEY]
     name = request.match_info["name"]
     process = aiovisor.process(name)
     await process.stop()
@@ -255,32 +408,129 @@ async def process_stop(request):
 @routes.post("/process/kill/{name}")
 @process_action
 async def process_kill(request):
-    aiovisor = request.app["aiovisor"]
+    aiovisor = request.app[AIOVISOR_KEY]
     name = request.match_info["name"]
     process = aiovisor.process(name)
     await process.kill()
 
 
+@web.middleware
+async def request_timer(request, handler):
+    start = time.perf_counter()
+    response = None
+    try:
+        response = await handler(request)
+        return response
+    except web.HTTPException as error:
+        # 304, 4xx... are raised
+        response = error
+        raise
+    finally:
+        # streams (SSE, websockets, files) duration is not a latency
+        if type(response) is web.Response or isinstance(response, web.HTTPException):
+            resource = request.match_info.route.resource
+            # not the path of unmatched requests: one histogram per URL
+            path = "unmatched" if resource is None else resource.canonical
+            hist = histogram(
+                "request", "HTTP request latency", method=request.method, path=path
+            )
+            observe(hist, time.perf_counter() - start)
+
+
+async def reload(aiovisor):
+    try:
+        await aiovisor.reload()
+    except AIOVisorError as error:
+        # same error as the answer to POST /api/reload
+        log.error("Cannot reload the configuration: %s", error)
+    except Exception:
+        log.exception("Cannot reload the configuration")
+
+
+def on_sighup(app):
+    tasks = app[RELOAD_TASKS_KEY]
+    task = asyncio.create_task(reload(app[AIOVISOR_KEY]), name="reload")
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+
+
 async def on_startup(app):
-    await app["aiovisor"].start()
+    aiovisor = app[AIOVISOR_KEY]
+    # programs may take long to start: don't hold the web server
+    app[START_TASK_KEY] = asyncio.create_task(aiovisor.start())
+    if is_posix and aiovisor.config_file is not None:
+        asyncio.get_running_loop().add_signal_handler(signals.SIGHUP, on_sighup, app)
 
 
 async def on_shutdown(app):
-    await app["aiovisor"].stop()
+    start_task = app[START_TASK_KEY]
+    if not start_task.done():
+        start_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await start_task
+    await app[AIOVISOR_KEY].stop()
 
 
 async def web_app(aiovisor):
     setup_event_loop()
-    app = web.Application()
-    app["aiovisor"] = aiovisor
+    app = web.Application(middlewares=[request_timer])
+    app[AIOVISOR_KEY] = aiovisor
+    app[ROW_CACHE_KEY] = RowCache(ProcessTable(aiovisor))
+    app[RELOAD_TASKS_KEY] = set()
     app.add_routes([web.static("/static", pathlib.Path(__file__).parent / "static")])
     app.add_routes(routes)
     api = await create_api(aiovisor)
+    app[SSE_CLIENTS_KEY] = api[SSE_CLIENTS_KEY]
     app.add_subapp("/api/", api)
     app.on_startup.append(on_startup)
     app.on_shutdown.append(on_shutdown)
     return app
 
 
+def unix_socket(path, mode):
+    """
+    Unix socket bound to *path* with the file permissions *mode*. A stale
+    socket file (left by a server which died) is replaced.
+    """
+    with contextlib.suppress(FileNotFoundError):
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            raise AIOVisorError(f"{path} exists and is not a socket")
+        with socket.socket(socket.AF_UNIX) as probe:
+            try:
+                probe.connect(path)
+            except ConnectionRefusedError:
+                os.unlink(path)
+            else:
+                raise AIOVisorError(f"{path} is used by a running server")
+    sock = socket.socket(socket.AF_UNIX)
+    try:
+        sock.bind(path)
+        # set before listen(): nobody can connect with the umask permissions
+        os.chmod(path, mode)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def serve(app, config):
+    """
+    Run the web app on TCP ([web.aiohttp] options) and/or on a Unix socket
+    ([web.unix]). Without [web.aiohttp] a configured Unix socket is the only
+    listener
+    """
+    options = dict(config.get("aiohttp", {}))
+    path = config["unix"]["path"]
+    if path is not None:
+        options["sock"] = unix_socket(path, config["unix"]["mode"])
+        log.info("Listening on unix socket %s", path)
+    try:
+        web.run_app(app, **options)
+    finally:
+        if path is not None:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+
+
 def run_app(aiovisor, config):
-    web.run_app(web_app(aiovisor), **config)
+    serve(web_app(aiovisor), config)
@@ -0,0 +1,205 @@
+import json
+import asyncio
+import itertools
+import collections
+
+from aiovisor.util import log, signal
+from aiovisor.server.metrics import timed
+
+
+log = log.getChild("web.bus")
+
+
+class SlowConsumer(Exception):
+    pass
+
+
+class Subscriber:
+    """
+    Bounded queue of pre-encoded events for a single client.
+
+    When the queue is full the *policy* decides what happens:
+
+    * ``drop``: the new event is discarded
+    * ``coalesce``: the pending event with the same key (ex: the same
+      process) is discarded, or the oldest one if there is none
+    * ``disconnect``: the subscriber is closed and the client disconnected
+
+    Events are always sent in the order they were put: clients detect the
+    discarded ones by the gaps of the ``seq`` numbers.
+
+    Once closed, get() returns the pending events then raises SlowConsumer
+    (or returns None if the bus was shut down).
+    """
+
+    def __init__(self, maxsize, policy, name=None):
+        self.maxsize = maxsize
+        self.policy = policy
+        self.name = name
+        # id -> (key, event) in order
+        self.pending = {}
+        # key -> id of its last pending event
+        self.keys = {}
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.slow = False
+        self.dropped = 0
+        self._ids = itertools.count()
+
+    def put(self, key, event):
+        if self.closed:
+            return
+        pending = self.pending
+        if len(pending) >= self.maxsize:
+            self.dropped += 1
+            if self.policy == "drop":
+                return
+            elif self.policy == "coalesce":
+                slot = self.keys.get(key) if key is not None else None
+                self._pop(next(iter(pending)) if slot is None else slot)
+            else:
+                self.slow = True
+                self.close()
+                return
+        slot = next(self._ids)
+        pending[slot] = key, event
+        if key is not None:
+            self.keys[key] = slot
+        self.ready.set()
+
+    def _pop(self, slot):
+        key, event = self.pending.pop(slot)
+        if key is not None and self.keys.get(key) == slot:
+            del self.keys[key]
+        return event
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+
+    async def get(self):
+        while not self.pending:
+            if self.slow:
+                raise SlowConsumer(f"{self.name} too slow. Dropped")
+            if self.closed:
+                return None
+            self.ready.clear()
+            await self.ready.wait()
+        return self._pop(next(iter(self.pending)))
+
+
+class EventBus:
+    """
+    Builds and JSON encodes each state change event exactly once and fans
+    out the encoded bytes to every subscriber.
+
+    Events are numbered (``seq``) and the last ones are kept so a client
+    which reconnects can resume where it left (see subscribe()). Until the
+    first subscription nothing is kept (nor encoded): there is no client
+    to resume.
+
+    Signals are global: if *aiovisor* is given only the events of that
+    server (and of its processes) are published.
+    """
+
+    def __init__(self, config, aiovisor=None):
+        self.aiovisor = aiovisor
+        self.queue_size = config["queue_size"]
+        self.policy = config["slow_consumer"]
+        self.subscribers = set()
+        self.seq = 0
+        self.history = collections.deque(maxlen=config["history_size"])
+        self.subscribed = False
+
+    def connect(self):
+        signal("server_state").connect(self.on_server_state_event)
+        signal("process_state").connect(self.on_process_state_event)
+        signal("process_list").connect(self.on_process_list_event)
+
+    def disconnect(self):
+        signal("process_list").disconnect(self.on_process_list_event)
+        signal("process_state").disconnect(self.on_process_state_event)
+        signal("server_state").disconnect(self.on_server_state_event)
+        for subscriber in self.subscribers:
+            subscriber.close()
+
+    def subscribe(self, name=None, since=None):
+        """
+        New subscriber. If *since* is given, also returns the events which
+        followed event *since* or None if they are not all in the history
+        (the client must then fetch the whole state again)
+        """
+        subscriber = Subscriber(self.queue_size, self.policy, name=name)
+        self.subscribers.add(subscriber)
+        self.subscribed = True
+        if since is None:
+            return subscriber, []
+        history = self.history
+        if since > self.seq:
+            # numbered by a previous server
+            return subscriber, None
+        if since < self.seq and (not history or history[0][0] > since + 1):
+            # some events are not in the history anymore
+            return subscriber, None
+        return subscriber, [event for seq, event in history if seq > since]
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+    def publish(self, event_type, key, build):
+        self.seq += 1
+        if not self.subscribers and not (self.subscribed and self.history.maxlen):
+            return
+        with timed("event_encode", "Build and encode an event", event=event_type):
+            data = json.dumps(dict(build(), seq=self.seq)).encode()
+        event = event_type, data
+        self.history.append((self.seq, event))
+        for subscriber in self.subscribers:
+            subscriber.put(key, event)
+
+    def owns(self, sender):
+        return self.aiovisor is None or sender is self.aiovisor
+
+    def owns_process(self, proc):
+        return self.aiovisor is None or self.aiovisor.procs.get(proc.name) is proc
+
+    def on_server_state_event(self, sender, old_state, new_state):
+        if not self.owns(sender):
+            return
+        self.publish(
+            "server_state",
+            None,
+            lambda: dict(
+                event_type="server_state",
+                old_state=old_state.name,
+                new_state=new_state.name,
+                server=sender.info(),
+            ),
+        )
+
+    def on_process_state_event(self, sender, old_state, new_state):
+        if not self.owns_process(sender):
+            return
+        self.publish(
+            "process_state",
+            sender.name,
+            lambda: dict(
+                event_type="process_state",
+                old_state=old_state.name,
+                new_state=new_state.name,
+                process=sender.info(),
+            ),
+        )
+
+    def on_process_list_event(self, sender, added, removed):
+        if not self.owns(sender):
+            return
+        self.publish(
+            "process_list",
+            None,
+            lambda: dict(
+                event_type="process_list",
+                added=[proc.info() for proc in added],
+                removed=[proc.name for proc in removed],
+            ),
+        )
@@ -0,0 +1,121 @@
+"""
+Web app of the federation: the process table and /api/processes of the
+merged fleet state. Process actions are forwarded to the node.
+"""
+
+import pathlib
+
+from aiohttp import web
+
+from aiovisor.util import AIOVisorError, setup_event_loop
+from aiovisor.server.federation import REMOTE_FIELDS
+from aiovisor.server.web.api import (
+    AIOVISOR_KEY,
+    SSE_CLIENTS_KEY,
+    json_response,
+    not_modified,
+    query_fields,
+    query_state,
+)
+from aiovisor.server.web.app import (
+    ROW_CACHE_KEY,
+    RowCache,
+    ProcessTable,
+    index,
+    process_action,
+    processes_events,
+    request_timer,
+    serve,
+)
+
+
+api = web.RouteTableDef()
+routes = web.RouteTableDef()
+
+FLEET_KEY = web.AppKey("fleet")
+
+
+@api.get("/processes")
+async def processes(request):
+    """Same as the server /api/processes over all the nodes"""
+    fleet = request.app[FLEET_KEY]
+    fields = query_fields(request, REMOTE_FIELDS)
+    etag = f"{fleet.pid}-{fleet.version}"
+    not_modified(request, etag)
+    procs = fleet.select(
+        tag=request.query.get("tag"),
+        pattern=request.query.get("match"),
+        state=query_state(request),
+    )
+    if fields is None:
+        result = {proc.name: proc.info() for proc in procs}
+    else:
+        result = {proc.name: proc.fields(fields) for proc in procs}
+    return json_response(result, etag=etag)
+
+
+@api.get("/nodes")
+async def nodes(request):
+    return web.json_response(request.app[FLEET_KEY].info()["nodes"])
+
+
+@api.post("/process/{action:start|stop|kill}/{name}")
+async def api_process_action(request):
+    fleet = request.app[FLEET_KEY]
+    action, name = request.match_info["action"], request.match_info["name"]
+    try:
+        return web.json_response(await fleet.action(action, name))
+    except AIOVisorError as error:
+        raise web.HTTPBadRequest(text=str(error))
+
+
+@routes.post("/process/{action:start|stop|kill}/{name}")
+@process_action
+async def table_process_action(request):
+    fleet = request.app[AIOVISOR_KEY]
+    await fleet.action(request.match_info["action"], request.match_info["name"])
+
+
+@routes.get("/process/logs/{name}")
+async def process_logs(request):
+    """The logs page is served by the node"""
+    fleet = request.app[AIOVISOR_KEY]
+    try:
+        node, name = fleet.locate(request.match_info["name"])
+    except AIOVisorError as error:
+        raise web.HTTPNotFound(text=str(error))
+    if node.config["unix_socket"] is not None:
+        raise web.HTTPNotFound(text=f"{node.name} is only reachable by unix socket")
+    raise web.HTTPFound(f"{node.config['url'].rstrip('/')}/process/logs/{name}")
+
+
+async def on_startup(app):
+    await app[AIOVISOR_KEY].start()
+
+
+async def on_cleanup(app):
+    await app[AIOVISOR_KEY].stop()
+
+
+async def federation_app(fleet):
+    setup_event_loop()
+    app = web.Application(middlewares=[request_timer])
+    # the process table handlers expect an "aiovisor"
+    app[AIOVISOR_KEY] = fleet
+    app[ROW_CACHE_KEY] = RowCache(ProcessTable(fleet))
+    app[SSE_CLIENTS_KEY] = set()
+    app.add_routes([web.static("/static", pathlib.Path(__file__).parent / "static")])
+    app.router.add_get("/", index)
+    app.router.add_get(f"{ProcessTable.base_path}/events", processes_events)
+    app.add_routes(routes)
+    api_app = web.Application()
+    api_app[FLEET_KEY] = fleet
+    api_app.add_routes(api)
+    app.add_subapp("/api/", api_app)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def run_federation(fleet, config):
+    serve(federation_app(fleet), config)
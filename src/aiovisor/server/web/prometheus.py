@@ -0,0 +1,131 @@
+"""
+Prometheus text exposition of the supervisor and process metrics.
+
+Everything is built from the state and the psutil snapshot already cached
+in each process: the lines of a process are only re-rendered when its
+state or snapshot changes.
+"""
+
+import time
+
+from aiovisor.server.metrics import histograms
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# (name, type, help) of the per process metric families cached per process
+PROCESS_FAMILIES = (
+    ("aiovisor_process_state", "gauge", "Current state (1 for the state label)"),
+    ("aiovisor_process_restarts_total", "counter", "Automatic restarts"),
+    ("aiovisor_process_start_time_seconds", "gauge", "Start time since epoch"),
+    ("aiovisor_process_cpu_seconds_total", "counter", "User and system CPU time"),
+    ("aiovisor_process_resident_memory_bytes", "gauge", "Resident memory size"),
+    ("aiovisor_process_open_fds", "gauge", "Number of open file descriptors"),
+)
+
+UPTIME = ("aiovisor_process_uptime_seconds", "gauge", "Seconds since last start")
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def header(name, type_, doc):
+    return f"# HELP {name} {doc}\n# TYPE {name} {type_}\n"
+
+
+def sample(name, labels, value):
+    if value is None:
+        return ""
+    return f"{name}{{{labels}}} {value}\n"
+
+
+def render_histograms(name, hists):
+    """Histograms of the same family (same name, different labels)"""
+    lines = [header(name, "histogram", hists[0].doc or hists[0].name)]
+    for hist in hists:
+        labels = ",".join(f'{k}="{escape(v)}"' for k, v in hist.labels.items())
+        prefix = f"{labels}," if labels else ""
+        total = 0
+        for bound, count in zip(hist.buckets, hist.counts):
+            total += count
+            lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {total}\n')
+        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {hist.count}\n')
+        labels = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{labels} {hist.sum}\n")
+        lines.append(f"{name}_count{labels} {hist.count}\n")
+    return "".join(lines)
+
+
+class ProcessMetrics:
+    """Per process lines of each PROCESS_FAMILIES, cached"""
+
+    def __init__(self):
+        self.cache = {}
+
+    def lines(self, proc):
+        key = proc.state_version, proc.ps_time
+        cached = self.cache.get(proc.name)
+        if cached is None or cached[0] != key:
+            cached = key, self.render(proc)
+            self.cache[proc.name] = cached
+        return cached[1]
+
+    def render(self, proc):
+        labels = f'program="{escape(proc.name)}"'
+        ps = proc.ps()
+        cpu = ps.get("cpu_times")
+        cpu = cpu["user"] + cpu["system"] if cpu else None
+        values = (
+            1,
+            proc.restarts,
+            proc.start_time if proc.is_running else None,
+            cpu,
+            ps.get("memory_info", {}).get("rss"),
+            ps.get("num_fds"),
+        )
+        state_labels = f'{labels},state="{proc.state.name}"'
+        return tuple(
+            sample(name, state_labels if i == 0 else labels, value)
+            for i, ((name, _, _), value) in enumerate(zip(PROCESS_FAMILIES, values))
+        )
+
+    def forget(self, names):
+        for name in set(self.cache).difference(names):
+            del self.cache[name]
+
+
+def iter_render(aiovisor, process_metrics, gauges):
+    """
+    Yields the exposition text in chunks. *gauges* is an iterable of
+    (name, help, value) supervisor level gauges.
+    """
+    procs = list(aiovisor.procs.values())
+    process_metrics.forget(aiovisor.procs)
+    lines = [process_metrics.lines(proc) for proc in procs]
+    for i, (name, type_, doc) in enumerate(PROCESS_FAMILIES):
+        yield header(name, type_, doc)
+        yield "".join(proc_lines[i] for proc_lines in lines)
+
+    now = time.time()
+    yield header(*UPTIME)
+    yield "".join(
+        sample(UPTIME[0], f'program="{escape(proc.name)}"', now - proc.start_time)
+        for proc in procs
+        if proc.is_running and proc.start_time is not None
+    )
+
+    for name, doc, value in gauges:
+        yield header(name, "gauge", doc)
+        yield f"{name} {value}\n"
+
+    families = {}
+    for hist in histograms.values():
+        families.setdefault(hist.name, []).append(hist)
+    for name, hists in families.items():
+        yield render_histograms(f"aiovisor_{name}_seconds", hists)
+
+
+def render(aiovisor, process_metrics, gauges):
+    return "".join(iter_render(aiovisor, process_metrics, gauges))
@@ -0,0 +1,113 @@
+import json
+import asyncio
+
+import pytest
+
+from aiovisor.client import next_event
+from aiovisor.server.web.bus import EventBus, SlowConsumer, Subscriber
+
+
+def drain(subscriber):
+    async def get_all():
+        result = []
+        while subscriber.pending:
+            result.append(await subscriber.get())
+        return result
+
+    return asyncio.run(get_all())
+
+
+def test_subscriber_drop():
+    sub = Subscriber(2, "drop")
+    for i in range(4):
+        sub.put("p1", i)
+    assert drain(sub) == [0, 1]
+    assert sub.dropped == 2
+
+
+def test_subscriber_coalesce():
+    sub = Subscriber(2, "coalesce")
+    sub.put("p1", 1)
+    sub.put("p2", 2)
+    # full: replaces the pending event of p1 but after p2
+    sub.put("p1", 3)
+    # full, nothing pending for p3: replaces the oldest
+    sub.put("p3", 4)
+    assert drain(sub) == [3, 4]
+    assert sub.dropped == 2
+    sub.put(None, 5)
+    sub.put(None, 6)
+    sub.put(None, 7)
+    assert drain(sub) == [6, 7]
+    # not full: nothing coalesced
+    sub.put("p1", 8)
+    sub.put("p1", 9)
+    assert drain(sub) == [8, 9]
+    assert sub.keys == {}
+
+
+def test_subscriber_disconnect():
+    sub = Subscriber(1, "disconnect")
+    sub.put("p1", 1)
+    sub.put("p1", 2)
+    assert sub.closed
+    assert drain(sub) == [1]
+    with pytest.raises(SlowConsumer):
+        asyncio.run(sub.get())
+
+
+def test_bus_disconnect():
+    bus = EventBus(dict(queue_size=1, slow_consumer="disconnect", history_size=0))
+    sub = bus.subscribe()[0]
+    bus.publish("test", None, lambda: dict(value=1))
+    bus.disconnect()
+    # shutdown: the pending events then the end, not a slow consumer
+    assert asyncio.run(sub.get())[0] == "test"
+    assert asyncio.run(sub.get()) is None
+
+
+def test_bus_resume():
+    bus = EventBus(dict(queue_size=10, slow_consumer="drop", history_size=3))
+    # nobody to resume yet: not even built
+    bus.publish("test", None, lambda: 1 / 0)
+    bus.unsubscribe(bus.subscribe()[0])
+    for i in range(1, 5):
+        bus.publish("test", None, lambda: dict(value=i))
+
+    def values(events):
+        return [json.loads(data)["value"] for _, data in events]
+
+    assert values(bus.subscribe(since=3)[1]) == [3, 4]
+    assert values(bus.subscribe(since=2)[1]) == [2, 3, 4]
+    assert bus.subscribe(since=1)[1] is None
+    assert bus.subscribe(since=5)[1] == []
+    assert bus.subscribe(since=6)[1] is None
+    assert bus.subscribe()[1] == []
+
+
+def test_client_seq_gap():
+    events = [
+        dict(event_type="process_state", seq=5),
+        dict(event_type="process_state", seq=6),
+        # already received
+        dict(event_type="process_state", seq=6),
+        # seq 7 was discarded by the server
+        dict(event_type="process_state", seq=8),
+        dict(event_type="process_state", seq=9),
+        # the server was restarted
+        dict(event_type="resync", seq=2),
+        dict(event_type="process_state", seq=3),
+    ]
+    since, result = 4, []
+    for event in events:
+        event, since = next_event(event, since)
+        result.append(event and (event["event_type"], event["seq"]))
+    assert result == [
+        ("process_state", 5),
+        ("process_state", 6),
+        None,
+        ("resync", 8),
+        ("process_state", 9),
+        ("resync", 2),
+        ("process_state", 3),
+    ]
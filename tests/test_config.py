@@ -4,7 +4,7 @@ import contextlib
 
 import pytest
 
-from aiovisor.server import config
+from aiovisor.server import config, sampler
 
 
 C1_RAW = {
@@ -21,24 +21,61 @@ C1_PARSED = {
     "main": {
         "name": platform.uname().node,
         "uname": platform.uname(),
-        "logging": dict(config.DEFAULT_LOG_CONFIG)
+        "max_concurrent_starts": 0,
+        "max_concurrent_stops": 0,
+        "bulk_concurrency": 0,
+        "bulk_batch_size": 0,
+        "logging": dict(config.DEFAULT_LOG_CONFIG),
+        "sampler": {
+            "interval": 2.0,
+            "expensive_interval": 60.0,
+            "cheap": list(sampler.CHEAP_ATTRS),
+            "expensive": list(sampler.EXPENSIVE_ATTRS),
+        },
+        "health": {"workers": 16},
+        "instrumentation": {"loop_lag_interval": 0.5, "slow_threshold": 0},
+    },
+    "pools": {},
+    "web": {
+        "unix": {"path": None, "mode": 0o660},
+        "ws": {"queue_size": 1000, "slow_consumer": "drop", "history_size": 1000},
+        "sse": {"coalesce_window": 0.1},
     },
-    "web": {},
     "programs": {
         "web-server-lab1": {
             "name": "web-server-lab1",
+            "priority": 999,
+            "depends_on": [],
+            "depends_on_pools": [],
             "environment": None,
             "directory": None,
             "exitcodes": [0],
             "startsecs": 1,
             "startretries": 3,
+            "autorestart": False,
+            "backoff_initial": 1.0,
+            "backoff_factor": 2.0,
+            "backoff_max": 60.0,
+            "backoff_jitter": 0.1,
             "autostart": True,
             "stopwaitsecs": 10,
             "stopsignal": 15,
             "user": None,
             "umask": -1,
             "resources": {},
+            "shell": False,
+            "sampler": {},
+            "stdout_capture_maxbytes": 65536,
+            "stderr_capture_maxbytes": 65536,
+            "stdout_logfile": None,
+            "stdout_logfile_maxbytes": 52428800,
+            "stdout_logfile_backups": 10,
+            "stderr_logfile": None,
+            "stderr_logfile_maxbytes": 52428800,
+            "stderr_logfile_backups": 10,
+            "healthcheck": None,
             "command":["/hello/exec", "something"],
+            "command_line": "/hello/exec something",
             "tags": ["web", "lab1"],
         }
     },
@@ -90,3 +127,86 @@ def test_load_config_raw(filename, ctx_result):
 def test_load_config(filename, ctx_result):
     with ctx_result as config_parsed:
         assert config.load_config(filename) == config_parsed
+
+
+@pytest.mark.parametrize(
+    "programs, error",
+    [({"a": {"command": "a", "depends_on": ["b"]}}, "unknown 'b'"),
+     ({"a": {"command": "a", "depends_on": ["a"]}}, "cycle: a -> a"),
+     ({"a": {"command": "a", "depends_on": ["b"]},
+       "b": {"command": "b", "depends_on": ["c"]},
+       "c": {"command": "c", "depends_on": ["b"]}}, "cycle: b -> c -> b")],
+    ids=["missing", "self", "cycle"]
+)
+def test_invalid_dependencies(programs, error):
+    with pytest.raises(ValueError, match=error):
+        config.parse_raw_config({"programs": programs})
+
+
+def test_numprocs():
+    raw = {
+        "programs": {
+            "worker": {
+                "command": "worker --port 80{process_num}",
+                "environment": {"NAME": "{program_name}-{process_num}"},
+                "numprocs": 2,
+                "numprocs_start": 1,
+            },
+            "web": {"command": "web", "depends_on": ["worker"]},
+        }
+    }
+    parsed = config.parse_raw_config(raw)
+    programs = parsed["programs"]
+    assert list(programs) == ["worker-1", "worker-2", "web"]
+    assert programs["worker-2"]["command"] == ["worker", "--port", "802"]
+    assert programs["worker-2"]["environment"] == {"NAME": "worker-2"}
+    assert programs["worker-2"]["pool"] == "worker"
+    assert programs["worker-2"]["process_num"] == 2
+    assert "numprocs" not in programs["worker-2"]
+    assert programs["web"]["depends_on"] == ["worker-1", "worker-2"]
+    assert programs["web"]["depends_on_pools"] == ["worker"]
+    assert parsed["pools"] == {"worker": raw["programs"]["worker"]}
+    raw["programs"]["worker-1"] = {"command": "other"}
+    with pytest.raises(ValueError, match="'worker-1' already in use"):
+        config.parse_raw_config(raw)
+
+
+def test_include(tmp_path, monkeypatch):
+    parsed = []
+    load_config_raw = config.load_config_raw
+
+    def load(filename):
+        parsed.append(filename.name)
+        return load_config_raw(filename)
+
+    monkeypatch.setattr(config, "load_config_raw", load)
+    monkeypatch.setattr(config, "PARSE_CACHE", {})
+    (tmp_path / "conf.d").mkdir()
+    main = tmp_path / "main.toml"
+    main.write_text('[include]\nfiles = ["conf.d/*.toml"]\n')
+    for name in "abc":
+        (tmp_path / "conf.d" / f"{name}.toml").write_text(
+            f'[programs.{name}]\ncommand = "sleep 1"\n'
+        )
+    assert list(config.load_config(main)["programs"]) == ["a", "b", "c"]
+    assert sorted(parsed) == ["a.toml", "b.toml", "c.toml", "main.toml"]
+
+    parsed.clear()
+    (tmp_path / "conf.d" / "b.toml").write_text('[programs.b]\ncommand = "sleep 22"\n')
+    programs = config.load_config(main)["programs"]
+    assert parsed == ["b.toml"]
+    assert programs["b"]["command"] == ["sleep", "22"]
+
+    (tmp_path / "conf.d" / "d.toml").write_text('[programs.a]\ncommand = "true"\n')
+    with pytest.raises(ValueError, match="already defined"):
+        config.load_config(main)
+
+    # the cache only keeps the files of the last load
+    for name in "cd":
+        (tmp_path / "conf.d" / f"{name}.toml").unlink()
+    assert list(config.load_config(main)["programs"]) == ["a", "b"]
+    assert sorted(pathlib.Path(path).name for path in config.PARSE_CACHE) == [
+        "a.toml",
+        "b.toml",
+        "main.toml",
+    ]
@@ -0,0 +1,277 @@
+import asyncio
+
+from aiovisor.util import AIOVisorError, signal
+from aiovisor.server.config import parse_raw_config
+from aiovisor.server.core import AIOVisor
+from aiovisor.server.process import ProcessState
+
+
+def program(command="sleep 30", **kwargs):
+    return dict(command=command, startsecs=0.1, **kwargs)
+
+
+def run(programs, check, **main):
+    config = parse_raw_config({"main": main, "programs": programs})
+
+    async def main_loop():
+        async with AIOVisor(config) as aiovisor:
+            return await check(aiovisor)
+
+    return asyncio.run(main_loop())
+
+
+def test_start_dependencies():
+    programs = {
+        "db": program(),
+        "web": program(depends_on=["db"], priority=1),
+        "bad": program("false", startretries=0),
+        "needs-bad": program(depends_on=["bad"]),
+    }
+
+    async def check(aiovisor):
+        return {name: proc.state for name, proc in aiovisor.procs.items()}
+
+    assert run(programs, check, max_concurrent_starts=1) == {
+        "db": ProcessState.Running,
+        "web": ProcessState.Running,
+        "bad": ProcessState.Fatal,
+        "needs-bad": ProcessState.Fatal,
+    }
+
+
+def test_start_stop_order():
+    programs = {
+        "low": program(numprocs=3, priority=1),
+        "mid": program(numprocs=3, priority=2),
+        "high": program(numprocs=3, priority=3),
+    }
+    events = []
+
+    def on_state(proc, old_state, new_state):
+        events.append((proc.name, proc.config["priority"], new_state))
+
+    def order(state):
+        return [priority for _, priority, new_state in events if new_state == state]
+
+    def peak(state):
+        """Most processes in *state* at the same time"""
+        current, result = set(), 0
+        for name, _, new_state in events:
+            if new_state == state:
+                current.add(name)
+            else:
+                current.discard(name)
+            result = max(result, len(current))
+        return result
+
+    async def check(aiovisor):
+        return None
+
+    with signal("process_state").connected_to(on_state):
+        run(programs, check, max_concurrent_starts=2, max_concurrent_stops=2)
+    assert order(ProcessState.Starting) == [1] * 3 + [2] * 3 + [3] * 3
+    assert order(ProcessState.Stopping) == [3] * 3 + [2] * 3 + [1] * 3
+    assert peak(ProcessState.Starting) == peak(ProcessState.Stopping) == 2
+
+
+def test_rolling_restart_aborts():
+    programs = {"w": program(numprocs=4)}
+
+    async def check(aiovisor):
+        procs = aiovisor.pool("w")
+        procs[1].config["command"] = ["false"]
+        procs[1].config["startretries"] = 0
+        return await aiovisor.rolling_restart(procs, batch_size=1)
+
+    result = run(programs, check)
+    assert result["result"] == "ABORTED"
+    assert [p["result"] for p in result["processes"].values()] == [
+        "ACK",
+        "ERROR",
+        "SKIPPED",
+        "SKIPPED",
+    ]
+
+
+def test_scale_pool():
+    programs = {"w": program(numprocs=2)}
+
+    async def check(aiovisor):
+        up = await aiovisor.scale("w", 3)
+        down = await aiovisor.scale("w", 1)
+        return up, down, sorted(aiovisor.procs)
+
+    up, down, names = run(programs, check)
+    assert up["added"] == ["w-2"]
+    assert down["removed"] == ["w-1", "w-2"]
+    assert names == ["w-0"]
+
+
+def test_scale_pool_stopped():
+    programs = {"db": program(), "w": program(numprocs=1, depends_on=["db"])}
+
+    async def check(aiovisor):
+        await aiovisor.scale("w", 2)
+        running = aiovisor.process("w-1").state
+        await aiovisor.stop()
+        # not started while the server is stopped
+        await aiovisor.scale("w", 3)
+        return running, aiovisor.process("w-2").state
+
+    assert run(programs, check) == (ProcessState.Running, ProcessState.Stopped)
+
+
+def test_scale_pool_dependencies():
+    programs = {
+        "w": program(numprocs=2),
+        "web": program(depends_on=["w"], priority=1),
+        "idle": program(numprocs=1, autostart=False),
+    }
+
+    async def check(aiovisor):
+        web = aiovisor.config["programs"]["web"]
+        await aiovisor.scale("w", 1)
+        down = list(web["depends_on"])
+        await aiovisor.scale("w", 3)
+        up = list(web["depends_on"])
+        idle = await aiovisor.scale("idle", 2)
+        await aiovisor.stop()
+        return down, up, idle["added"], aiovisor.pools()
+
+    down, up, idle, pools = run(programs, check)
+    assert down == ["w-0"]
+    assert up == ["w-0", "w-1", "w-2"]
+    assert idle == ["idle-1"]
+    assert pools == {"w": ["w-0", "w-1", "w-2"], "idle": ["idle-0", "idle-1"]}
+
+
+def test_healthcheck(tmp_path):
+    flag = tmp_path / "healthy"
+    flag.touch()
+    check = dict(type="exec", interval=0.05, start_interval=0.05, retries=2)
+    programs = {
+        "ok": program(healthcheck=dict(check, command=["test", "-e", str(flag)])),
+        "never": program(
+            startretries=0, healthcheck=dict(check, command="false", start_timeout=0.3)
+        ),
+    }
+
+    async def check_states(aiovisor):
+        states = [{name: p.state for name, p in aiovisor.procs.items()}]
+        flag.unlink()
+        await asyncio.sleep(0.5)
+        states.append(aiovisor.process("ok").state)
+        flag.touch()
+        await asyncio.sleep(0.3)
+        states.append(aiovisor.process("ok").state)
+        return states
+
+    assert run(programs, check_states) == [
+        {"ok": ProcessState.Running, "never": ProcessState.Fatal},
+        ProcessState.Unhealthy,
+        ProcessState.Running,
+    ]
+
+
+def test_healthcheck_restart_fails(tmp_path, caplog):
+    flag = tmp_path / "healthy"
+    flag.touch()
+    check = dict(type="exec", interval=0.05, start_interval=0.05, retries=1)
+    check["command"] = ["test", "-e", str(flag)]
+    programs = {"a": program(healthcheck=dict(check, restart=True))}
+
+    async def restart():
+        raise AIOVisorError("'a' not in startable state")
+
+    async def check_restart(aiovisor):
+        proc = aiovisor.process("a")
+        proc.restart = restart
+        flag.unlink()
+        await asyncio.sleep(0.3)
+        return proc.state, aiovisor.health.restarts
+
+    assert run(programs, check_restart) == (ProcessState.Unhealthy, set())
+    assert "Cannot restart unhealthy process: 'a' not in startable" in caplog.text
+
+
+def test_reload():
+    programs = {"same": program(), "changed": program(), "removed": program()}
+
+    async def check(aiovisor):
+        pids = {name: proc.pid for name, proc in aiovisor.procs.items()}
+        new = dict(programs, changed=program("sleep 31"), added=program())
+        del new["removed"]
+        diff = await aiovisor.reload(parse_raw_config({"programs": new}))
+        states = {name: proc.state for name, proc in aiovisor.procs.items()}
+        same = aiovisor.process("same").pid == pids["same"]
+        changed = aiovisor.process("changed").pid != pids["changed"]
+        return diff, states, same, changed
+
+    diff, states, same, changed = run(programs, check)
+    assert diff == dict(
+        added=["added"], removed=["removed"], changed=["changed"], unchanged=1
+    )
+    assert states == dict.fromkeys(["same", "changed", "added"], ProcessState.Running)
+    assert same and changed
+
+
+def test_reload_during_start():
+    programs = {"a": program(), "b": program(depends_on=["a"], priority=2)}
+    config = parse_raw_config({"programs": programs})
+    new = parse_raw_config({"programs": {"a": program(), "c": program()}})
+
+    async def main():
+        aiovisor = AIOVisor(config)
+        start = asyncio.create_task(aiovisor.start())
+        await asyncio.sleep(0.01)
+        # b waits for a: the reload must not let the start sequence go on
+        b = aiovisor.process("b")
+        diff = await aiovisor.reload(new)
+        await start
+        states = {name: proc.state for name, proc in aiovisor.procs.items()}
+        await aiovisor.stop()
+        return diff, states, b.state
+
+    diff, states, removed = asyncio.run(main())
+    assert diff == dict(added=["c"], removed=["b"], changed=[], unchanged=1)
+    assert states == dict.fromkeys(["a", "c"], ProcessState.Running)
+    assert removed == ProcessState.Stopped
+
+
+def test_reload_closes_logfiles(tmp_path):
+    logfile = str(tmp_path / "out.log")
+    command = "sh -c 'echo hello; exec sleep 30'"
+    programs = {"a": program(command, stdout_logfile=logfile)}
+
+    async def check(aiovisor):
+        await asyncio.sleep(0.1)
+        rotating = aiovisor.process("a").logfiles["stdout"]
+        await aiovisor.reload(parse_raw_config({"programs": {}}))
+        for _ in range(50):
+            if rotating.fd is None:
+                break
+            await asyncio.sleep(0.02)
+        return rotating.fd
+
+    assert run(programs, check) is None
+    assert (tmp_path / "out.log").read_text() == "hello\n"
+
+
+def test_select_index():
+    programs = {
+        "a": program(tags=["web"]),
+        "b": program(tags=["web", "db"]),
+        "bad": program("false", startretries=0, tags=["web"]),
+    }
+
+    async def check(aiovisor):
+        def names(**kwargs):
+            return [proc.name for proc in aiovisor.select(**kwargs)]
+
+        result = [names(tag="web", state=ProcessState.Running), names(tag="db")]
+        await aiovisor.process("b").stop()
+        result.append(names(state=ProcessState.Stopped))
+        result.append(names(tag="web", state=ProcessState.Fatal, pattern="b*"))
+        return result
+
+    assert run(programs, check) == [["a", "b"], ["b"], ["b"], ["bad"]]
@@ -0,0 +1,64 @@
+import sys
+import asyncio
+import subprocess
+
+from aiohttp import web
+
+from aiovisor import ctl
+from aiovisor.server.config import parse_raw_config
+from aiovisor.server.core import AIOVisor
+from aiovisor.server.process import ProcessState
+from aiovisor.server.web.app import unix_socket, web_app
+
+
+HEAVY_MODULES = ("aiohttp", "aiohttp_sse", "asyncio", "blinker", "psutil")
+
+
+def test_ctl_imports():
+    """aiovisorctl must start fast: none of the server dependencies"""
+    code = (
+        "import sys, aiovisor.ctl;"
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    output = subprocess.check_output([sys.executable, "-c", code], text=True)
+    assert output.strip() == ""
+
+
+def test_ctl(tmp_path, capsys):
+    path = str(tmp_path / "aiovisor.sock")
+    programs = {
+        "a": {"command": "sh -c 'echo hello; exec sleep 30'", "startsecs": 0.1},
+        "b": {"command": "sleep 30", "startsecs": 0.1},
+    }
+    config = parse_raw_config({"programs": programs})
+
+    def run(*args):
+        code = ctl.main(["-s", path, *args])
+        return code, capsys.readouterr()
+
+    async def main():
+        aiovisor = AIOVisor(config)
+        runner = web.AppRunner(await web_app(aiovisor))
+        await runner.setup()
+        await web.SockSite(runner, unix_socket(path, 0o600)).start()
+        try:
+            while any(p.state != ProcessState.Running for p in aiovisor.procs.values()):
+                await asyncio.sleep(0.02)
+            stop = await asyncio.to_thread(run, "stop", "b")
+            status = await asyncio.to_thread(run, "status")
+            missing = await asyncio.to_thread(run, "start", "c*")
+            tail = await asyncio.to_thread(run, "tail", "a")
+            return stop, status, missing, tail
+        finally:
+            await runner.cleanup()
+
+    stop, status, missing, tail = asyncio.run(main())
+    assert stop[0] == 0
+    assert stop[1].out == "b: Stopped\n"
+    assert status[0] == 0
+    lines = status[1].out.splitlines()
+    assert lines[0].split()[:3] == ["a", "Running", "pid"]
+    assert lines[1].split() == ["b", "Stopped"]
+    assert missing[0] == 1
+    assert missing[1].err == "c*: no such process\n"
+    assert tail == (0, ("hello\n", ""))
@@ -0,0 +1,106 @@
+import asyncio
+import types
+
+from aiohttp import ClientSession
+from aiohttp.test_utils import TestServer
+
+from aiovisor.server.config import parse_raw_config, parse_raw_federation_config
+from aiovisor.server.core import AIOVisor
+from aiovisor.server.federation import Fleet, RemoteProcess
+from aiovisor.server.process import ProcessState
+from aiovisor.server.web.app import web_app
+from aiovisor.server.web.federation import federation_app
+
+
+def node_config(*names):
+    programs = {name: dict(command="sleep 30", startsecs=0.1) for name in names}
+    return parse_raw_config({"programs": programs})
+
+
+async def wait_for(condition, timeout=5):
+    for _ in range(int(timeout / 0.02)):
+        if condition():
+            return
+        await asyncio.sleep(0.02)
+    raise TimeoutError
+
+
+def test_federation():
+    async def main():
+        node1 = AIOVisor(node_config("a", "b"))
+        node2 = AIOVisor(node_config("a"))
+        async with (
+            TestServer(await web_app(node1)) as server1,
+            TestServer(await web_app(node2)) as server2,
+        ):
+            nodes = {"n1": str(server1.make_url("")), "n2": str(server2.make_url(""))}
+            fleet = Fleet(parse_raw_federation_config({"federation": {"nodes": nodes}}))
+            async with (
+                TestServer(await federation_app(fleet)) as server,
+                ClientSession(str(server.make_url(""))) as session,
+            ):
+                procs = fleet.procs
+                await wait_for(
+                    lambda: len(procs) == 3
+                    and all(p.state == ProcessState.Running for p in procs.values())
+                )
+                async with session.post("/api/process/stop/n1:b") as response:
+                    assert response.status == 200
+                await wait_for(lambda: procs["n1:b"].state == ProcessState.Stopped)
+                async with session.get("/api/processes?fields=node,state") as response:
+                    result = await response.json()
+                await node2.reload(node_config("a", "c"))
+                await wait_for(lambda: "n2:c" in procs)
+                return result
+
+    assert asyncio.run(main()) == {
+        "n1:a": {"node": "n1", "state": "Running"},
+        "n1:b": {"node": "n1", "state": "Stopped"},
+        "n2:a": {"node": "n2", "state": "Running"},
+    }
+
+
+def test_remote_process_node_restart():
+    node = types.SimpleNamespace(name="n1", fleet=types.SimpleNamespace(version=0))
+
+    def info(state, version):
+        return dict(name="a", config={}, state=dict(state=state, state_version=version))
+
+    proc = RemoteProcess(node, info(ProcessState.Running, 10))
+    proc.update(info(ProcessState.Stopped, 9))
+    assert proc.state == ProcessState.Running
+    proc.set_unknown()
+    # the node restarted: its versions start from 0 again
+    proc.update(info(ProcessState.Starting, 2))
+    assert proc.state == ProcessState.Starting
+
+
+def test_node_error_reconnects():
+    async def main():
+        node = AIOVisor(node_config("a"))
+        async with TestServer(await web_app(node)) as server:
+            federation = {"nodes": {"n1": str(server.make_url(""))}}
+            federation["reconnect_delay"] = 0.05
+            fleet = Fleet(parse_raw_federation_config({"federation": federation}))
+            follower = fleet.nodes["n1"]
+            handle = follower.handle
+            errors = []
+
+            async def broken_handle(event):
+                if not errors:
+                    errors.append(event)
+                    raise KeyError("process")
+                await handle(event)
+
+            follower.handle = broken_handle
+            await fleet.start()
+            try:
+                procs = fleet.procs
+                await wait_for(lambda: "n1:a" in procs)
+                await node.process("a").stop()
+                await wait_for(lambda: procs["n1:a"].state == ProcessState.Stopped)
+                return len(errors), follower.connected, follower.task.done()
+            finally:
+                await fleet.stop()
+
+    assert asyncio.run(main()) == (1, True, False)
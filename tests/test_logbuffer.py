@@ -0,0 +1,51 @@
+import asyncio
+
+from aiovisor.server.logbuffer import RingBuffer
+
+
+def test_ring_buffer_wraps():
+    buffer = RingBuffer(8)
+    buffer.write(b"hello ")
+    assert buffer.read() == b"hello "
+    buffer.write(b"world")
+    assert buffer.read() == b"lo world"
+    assert buffer.position == 11
+    assert buffer.start == 3
+    assert len(buffer) == 8
+    assert buffer.read(9) == b"ld"
+    assert buffer.read(0) == b"lo world"
+    buffer.write(b"0123456789")
+    assert buffer.read() == b"23456789"
+
+
+def test_ring_buffer_tail():
+    buffer = RingBuffer(64)
+    buffer.write(b"line 1\nline 2\nline 3\n")
+    assert buffer.tail() == b"line 1\nline 2\nline 3\n"
+    assert buffer.tail(0) == b""
+    assert buffer.tail(1) == b"line 3\n"
+    assert buffer.tail(2) == b"line 2\nline 3\n"
+    assert buffer.tail(10) == b"line 1\nline 2\nline 3\n"
+    buffer.write(b"partial")
+    assert buffer.tail(1) == b"partial"
+
+
+def test_ring_buffer_follow():
+    buffer = RingBuffer(16)
+
+    async def follow():
+        chunks = []
+        async for chunk in buffer.follow():
+            chunks.append(chunk)
+            if len(chunks) == 2:
+                return chunks
+
+    async def main():
+        task = asyncio.create_task(follow())
+        await asyncio.sleep(0)
+        buffer.write(b"a")
+        await asyncio.sleep(0)
+        buffer.write(b"bc")
+        return await task
+
+    assert asyncio.run(main()) == [b"a", b"bc"]
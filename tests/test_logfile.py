@@ -0,0 +1,42 @@
+import asyncio
+
+from aiovisor.server.logfile import LogWriter, RotatingFile
+
+
+def test_rotating_file(tmp_path):
+    path = tmp_path / "out.log"
+    logfile = RotatingFile(path, maxbytes=10, backups=2)
+    logfile.write([b"0123456", b"789abc"])
+    logfile.write([b"defghijklmnopqrstuvwxyz"])
+    logfile.close()
+    assert path.read_bytes() == b"uvwxyz"
+    assert (tmp_path / "out.log.1").read_bytes() == b"klmnopqrst"
+    assert (tmp_path / "out.log.2").read_bytes() == b"abcdefghij"
+    assert not (tmp_path / "out.log.3").exists()
+
+
+def test_log_writer(tmp_path):
+    writer = LogWriter()
+    writer.start()
+    logfile = RotatingFile(tmp_path / "out.log")
+    for i in range(100):
+        writer.write(logfile, f"line {i}\n".encode())
+    asyncio.run(writer.stop())
+    lines = (tmp_path / "out.log").read_text().splitlines()
+    assert lines == [f"line {i}" for i in range(100)]
+
+
+def test_log_writer_close_and_limit(tmp_path):
+    writer = LogWriter(max_pending=10)
+    logfile = RotatingFile(tmp_path / "out.log")
+    # not started: nothing is consumed so the queue fills up
+    writer.write(logfile, b"12345")
+    writer.write(logfile, b"67890")
+    writer.write(logfile, b"dropped")
+    writer.close(logfile)
+    assert (writer.pending, writer.dropped) == (10, 7)
+    writer.start()
+    asyncio.run(writer.stop())
+    assert (writer.pending, writer.dropped) == (0, 0)
+    assert logfile.fd is None
+    assert (tmp_path / "out.log").read_bytes() == b"1234567890"
@@ -0,0 +1,119 @@
+import asyncio
+import resource
+
+import pytest
+
+from aiovisor.server import process as process_module
+from aiovisor.server.config import parse_raw_config
+from aiovisor.server.metrics import histogram
+from aiovisor.server.process import Process, ProcessState
+
+
+def process(command="sleep 30", **kwargs):
+    config = parse_raw_config({"programs": {"p": dict(command=command, **kwargs)}})
+    return Process("p", config["programs"]["p"])
+
+
+def test_backoff_delay():
+    proc = process(
+        backoff_initial=0.5, backoff_factor=3, backoff_max=10, backoff_jitter=0
+    )
+    assert [proc.backoff_delay(attempt) for attempt in range(1, 6)] == [
+        0.5,
+        1.5,
+        4.5,
+        10,
+        10,
+    ]
+    proc.config["backoff_jitter"] = 0.1
+    for _ in range(100):
+        assert 0.45 <= proc.backoff_delay(1) <= 0.55
+
+
+def test_should_restart():
+    proc = process(exitcodes=[0, 2])
+    assert not proc._should_restart(0)
+    proc.config["autorestart"] = "unexpected"
+    assert [proc._should_restart(code) for code in (0, 1, 2, -9)] == [
+        False,
+        True,
+        False,
+        True,
+    ]
+    proc.config["autorestart"] = True
+    assert proc._should_restart(0)
+
+
+def test_start_during_backoff():
+    # exits right after being Running, restarted after a long delay
+    proc = process(
+        "sh -c 'sleep 0.2'", startsecs=0.1, autorestart=True, backoff_initial=30
+    )
+
+    async def main():
+        await proc.start()
+        while proc.state != ProcessState.Backoff:
+            await asyncio.sleep(0.02)
+        waiting = proc.run_task
+        await proc.start()
+        assert waiting.cancelled()
+        assert await proc.wait_started() == ProcessState.Running
+        await proc.stop()
+        await asyncio.wait_for(proc.run_task, 1)
+        return [task for task in asyncio.all_tasks() if task.get_name() == "p-loop"]
+
+    assert asyncio.run(main()) == []
+
+
+def test_prlimit_wrapper_args(monkeypatch):
+    monkeypatch.setattr(process_module, "PRLIMIT", "/usr/bin/prlimit")
+    proc = process("sleep 30", shell=True, resources={"nofile": 64, "nproc": None})
+    shell, args, kwargs = proc._create_process_args()
+    assert not shell
+    assert args == [
+        "/usr/bin/prlimit",
+        "--nofile=64:",
+        "--",
+        "/bin/sh",
+        "-c",
+        "sleep 30",
+    ]
+    assert "preexec_fn" not in kwargs
+
+
+def test_no_resources_args():
+    # all limits unset: plain fast spawn path
+    proc = process("sleep 30", resources={"nofile": None})
+    shell, args, kwargs = proc._create_process_args()
+    assert proc._rlimit_mode() is None
+    assert (shell, args) == (False, ["sleep", "30"])
+    assert "preexec_fn" not in kwargs
+
+
+@pytest.mark.parametrize("mode", ["wrapper", "prlimit", "preexec"])
+def test_resource_limits_applied(monkeypatch, mode):
+    if mode == "wrapper":
+        if process_module.PRLIMIT is None:
+            pytest.skip("no prlimit command")
+    else:
+        monkeypatch.setattr(process_module, "PRLIMIT", None)
+    if mode == "preexec":
+        monkeypatch.delattr(resource, "prlimit")
+    proc = process(
+        "sh -c 'sleep 0.1; ulimit -n; exec sleep 30'",
+        resources={"nofile": 64},
+        startsecs=0.05,
+    )
+    spawns = histogram("spawn_latency").count
+
+    async def main():
+        assert proc._rlimit_mode() == mode
+        await proc.start()
+        while not proc.output["stdout"].tail(1):
+            await asyncio.sleep(0.02)
+        await proc.stop()
+        return proc.output["stdout"].tail(1)
+
+    assert asyncio.run(main()) == b"64\n"
+    assert histogram("spawn_latency").count == spawns + 1
+    assert proc.spawn_latency > 0
@@ -0,0 +1,90 @@
+import asyncio
+import threading
+
+from aiovisor.server.config import parse_raw_config
+from aiovisor.server.core import AIOVisor
+
+
+def run(programs, check, **sampler):
+    # the periodic pass is stopped: the tests call sample() themselves
+    sampler.setdefault("interval", 3600)
+    config = parse_raw_config({"main": {"sampler": sampler}, "programs": programs})
+
+    async def main_loop():
+        async with AIOVisor(config) as aiovisor:
+            await aiovisor.sampler.stop()
+            return await check(aiovisor, aiovisor.sampler)
+
+    return asyncio.run(main_loop())
+
+
+def test_sample_batch():
+    programs = {"a": {"command": "sleep 30"}, "b": {"command": "sleep 30"}}
+
+    async def check(aiovisor, sampler):
+        passes = []
+        sample = sampler._sample
+
+        def spy(jobs):
+            passes.append((threading.current_thread(), {job[0] for job in jobs}))
+            return sample(jobs)
+
+        sampler._sample = spy
+        a, b = aiovisor.process("a"), aiovisor.process("b")
+        pids = {a.pid, b.pid}
+        await sampler.sample()
+        handles = dict(sampler.handles)
+        assert a.ps()["cmdline"] == ["sleep", "30"]
+        await sampler.sample()
+        # psutil handles are kept between passes
+        assert all(sampler.handles[pid] is handles[pid] for pid in pids)
+        await b.stop()
+        await sampler.sample()
+        assert list(sampler.handles) == [a.pid]
+        assert b.ps() == {} and b.ps_time is not None
+        assert [jobs for _, jobs in passes] == [pids, pids, {a.pid}]
+        return {thread for thread, _ in passes}
+
+    assert threading.main_thread() not in run(programs, check)
+
+
+def test_sample_tiers():
+    programs = {
+        "a": {"command": "sleep 30"},
+        "b": {"command": "sleep 30", "sampler": {"cheap": ["name"], "expensive": []}},
+    }
+
+    async def check(aiovisor, sampler):
+        a, b = aiovisor.process("a"), aiovisor.process("b")
+        sampler.last_expensive_time = None
+        await sampler.sample()
+        tiers = [(set(a.ps_data), set(a.ps_expensive), set(b.ps()))]
+        await sampler.sample()
+        # not due yet: the last expensive data is kept
+        tiers.append((set(a.ps_data), set(a.ps_expensive), set(b.ps())))
+        return tiers
+
+    cheap, expensive = {"name", "num_fds"}, {"cwd", "open_files"}
+    tiers = run(programs, check, cheap=sorted(cheap), expensive=sorted(expensive))
+    assert tiers == [(cheap, expensive, {"name"})] * 2
+
+
+def test_sample_expensive_on_demand():
+    programs = {
+        "a": {"command": "sleep 30"},
+        "b": {"command": "sleep 30", "sampler": {"expensive": ["exe"]}},
+    }
+
+    async def check(aiovisor, sampler):
+        a, b = aiovisor.process("a"), aiovisor.process("b")
+        await sampler.sample()
+        assert a.ps_expensive == b.ps_expensive == {}
+        await sampler.sample_expensive(b)
+        assert a.ps_expensive == {} and set(b.ps_expensive) == {"exe"}
+        await sampler.sample(expensive=True)
+        return set(a.ps_expensive), set(b.ps_expensive)
+
+    assert run(programs, check, expensive_interval=0, expensive=["cwd"]) == (
+        {"cwd"},
+        {"exe"},
+    )
@@ -0,0 +1,350 @@
+import os
+import stat
+import signal
+import asyncio
+import contextlib
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from aiovisor.client import AIOVisor as Client
+from aiovisor.util import AIOVisorError
+from aiovisor.server.config import parse_raw_config
+from aiovisor.server.core import AIOVisor, State
+from aiovisor.server.metrics import histogram
+from aiovisor.server.process import Process, ProcessState
+from aiovisor.server.web.app import RELOAD_TASKS_KEY, RowCache, unix_socket, web_app
+
+
+@contextlib.asynccontextmanager
+async def serve(programs, config_file=None, **main):
+    """(AIOVisor, TestClient of its web app) once the server is Running"""
+    config = parse_raw_config({"main": main, "programs": programs})
+    aiovisor = AIOVisor(config, config_file=config_file)
+    async with TestClient(TestServer(await web_app(aiovisor))) as client:
+        while aiovisor.state != State.Running:
+            await asyncio.sleep(0.02)
+        yield aiovisor, client
+
+
+def test_unix_socket(tmp_path):
+    path = str(tmp_path / "aiovisor.sock")
+    config = parse_raw_config({"programs": {"a": {"command": "sleep 30"}}})
+
+    async def main():
+        aiovisor = AIOVisor(config)
+        sock = unix_socket(path, 0o600)
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+        runner = web.AppRunner(await web_app(aiovisor))
+        await runner.setup()
+        await web.SockSite(runner, sock).start()
+        try:
+            with pytest.raises(AIOVisorError, match="running server"):
+                unix_socket(path, 0o600)
+            async with Client(unix_socket=path) as client:
+                return await client.processes(fields="name")
+        finally:
+            await runner.cleanup()
+
+    assert asyncio.run(main()) == {"a": {"name": "a"}}
+    # stale socket file of a dead server
+    unix_socket(path, 0o660).close()
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o660
+
+
+def test_client_process_log():
+    programs = {"a": {"command": "sh -c 'echo hello; exec sleep 30'"}}
+
+    async def main():
+        async with serve(programs) as (aiovisor, client):
+            proc = aiovisor.process("a")
+            while not proc.output["stdout"].tail(1):
+                await asyncio.sleep(0.02)
+            async with Client(str(client.make_url(""))) as api:
+                return await api.process_log("a", tail=1)
+
+    assert asyncio.run(main()) == "hello\n"
+
+
+def test_process_log_errors():
+    programs = {"a": {"command": "sleep 30", "stdout_capture_maxbytes": 0}}
+    paths = [
+        "/process/logs/a",
+        "/process/logs/missing",
+        "/process/logs/a/events",
+        "/process/logs/missing/events",
+        "/api/process/a/log?stream=stderr&tail=x",
+        "/api/process/a/log/follow?stream=stderr&tail=x",
+    ]
+
+    async def main():
+        statuses = []
+        async with serve(programs) as (aiovisor, client):
+            for path in paths:
+                async with client.get(path) as response:
+                    statuses.append(response.status)
+        return statuses
+
+    assert asyncio.run(main()) == [404, 404, 404, 404, 400, 400]
+
+
+def test_processes_etag(tmp_path):
+    flag = tmp_path / "restarted"
+    # exits once (after being Running) and is restarted
+    once = f"sh -c 'sleep 0.3; test -e {flag} && exec sleep 30; touch {flag}'"
+    programs = {
+        "a": {"command": "sleep 30", "startsecs": 0.1},
+        "idle": {"command": "sleep 30", "numprocs": 1, "autostart": False},
+        "r": {
+            "command": once,
+            "startsecs": 0.1,
+            "autorestart": True,
+            "backoff_initial": 0.05,
+        },
+        # down while the sampler runs
+        "exited": {"command": "sh -c 'sleep 0.1'", "startsecs": 0.05},
+    }
+
+    async def main():
+        statuses = []
+        sampler = {"interval": 0.05}
+        async with serve(programs, sampler=sampler) as (aiovisor, client):
+            etag = None
+
+            async def get():
+                nonlocal etag
+                headers = {} if etag is None else {"If-None-Match": etag}
+                url = "/api/processes?fields=name,health,restarts"
+                async with client.get(url, headers=headers) as response:
+                    etag = response.headers.get("ETag", etag)
+                    return response.status
+
+            statuses.append(await get())
+            restarted = aiovisor.process("r")
+            while restarted.restarts == 0 or restarted.state != ProcessState.Running:
+                await asyncio.sleep(0.02)
+            statuses += [await get(), await get()]
+            proc = aiovisor.process("a")
+            check = {"retries": 3, "interval": 10, "restart": False}
+            aiovisor.health._handle_result(proc, check, "refused")
+            statuses.append(await get())
+            async with client.get("/api/process/info/a?expensive=1") as response:
+                assert response.status == 200
+            statuses.append(await get())
+            await aiovisor.scale("idle", 2)
+            statuses += [await get(), await get()]
+            assert aiovisor.process("exited").state == ProcessState.Exited
+            # several sampler passes
+            await asyncio.sleep(0.3)
+            statuses.append(await get())
+        return statuses
+
+    assert asyncio.run(main()) == [200, 200, 304, 200, 200, 200, 304, 304]
+
+
+def test_invalid_query():
+    requests = [
+        ("POST", "/api/processes/stop?concurrency=x"),
+        ("POST", "/api/group/web/stop?batch_size=1.5"),
+        ("GET", "/api/ws?since=x"),
+        ("POST", "/api/group/web/rolling-restart?timeout=never"),
+    ]
+
+    async def main():
+        statuses = []
+        async with serve({"a": {"command": "sleep 30"}}) as (aiovisor, client):
+            for method, path in requests:
+                async with client.request(method, path) as response:
+                    statuses.append(response.status)
+        return statuses
+
+    assert asyncio.run(main()) == [400, 400, 400, 400]
+
+
+def test_row_cache():
+    config = parse_raw_config({"programs": {"a": {"command": "sleep 30"}}})
+    proc = Process("a", config["programs"]["a"])
+    rendered = []
+
+    class Table:
+        def render_row(self, proc):
+            rendered.append(proc.ps().get("memory_info"))
+            return f"row {len(rendered)}"
+
+    rows = RowCache(Table())
+    assert rows.render(proc) == rows.render(proc) == "row 1"
+    proc.set_ps({"memory_info": {"rss": 1024}}, 1.0)
+    assert rows.render(proc) == rows.render(proc) == "row 2"
+    proc.change_state(ProcessState.Fatal)
+    assert rows.render(proc) == "row 3"
+    assert rendered == [None, {"rss": 1024}, {"rss": 1024}]
+    rows.forget([])
+    assert rows.rows == {}
+
+
+def test_processes_events_coalesce():
+    programs = {"a": {"command": "sleep 30", "startsecs": 0.1}}
+
+    async def main():
+        async with serve(programs) as (aiovisor, client):
+            proc = aiovisor.process("a")
+            async with client.get("/processes/table/events") as response:
+                # a burst of changes within the coalescing window
+                for state in (ProcessState.Starting, ProcessState.Backoff):
+                    proc.change_state(state)
+                    await asyncio.sleep(0.01)
+                proc.change_state(ProcessState.Unhealthy)
+                event = await response.content.readuntil(b"\r\n\r\n")
+                with pytest.raises(asyncio.TimeoutError):
+                    await asyncio.wait_for(response.content.readany(), 0.3)
+                return event.decode()
+
+    event = asyncio.run(main())
+    assert event.startswith("event: datastar-patch-elements")
+    assert "Unhealthy" in event and "Backoff" not in event
+
+
+def test_request_timer():
+    requests = [
+        ("/api/state", "/api/state", 200),
+        ("/api/processes?fields=x", "/api/processes", 400),
+        ("/nowhere/1", "unmatched", 404),
+        ("/nowhere/2", "unmatched", 404),
+    ]
+
+    def counts():
+        return {
+            path: histogram("request", method="GET", path=path).count
+            for _, path, _ in requests
+        }
+
+    async def main():
+        before = counts()
+        async with serve({"a": {"command": "sleep 30"}}) as (aiovisor, client):
+            for url, _, status in requests:
+                async with client.get(url) as response:
+                    assert response.status == status
+        return {path: count - before[path] for path, count in counts().items()}
+
+    assert asyncio.run(main()) == {"/api/state": 1, "/api/processes": 1, "unmatched": 2}
+
+
+def test_sighup_reload_error(tmp_path, caplog):
+    path = tmp_path / "aiovisor.toml"
+    path.write_text("[programs.a\n")
+    error = f"Cannot reload the configuration: Cannot load '{path}'"
+
+    async def main():
+        async with serve({"a": {"command": "sleep 30"}}, path) as (aiovisor, client):
+            os.kill(os.getpid(), signal.SIGHUP)
+            for _ in range(100):
+                if error in caplog.text:
+                    break
+                await asyncio.sleep(0.02)
+            return client.app[RELOAD_TASKS_KEY]
+
+    assert asyncio.run(main()) == set()
+    assert error in caplog.text
+
+
+def test_process_info_expensive():
+    programs = {"a": {"command": "sleep 30"}}
+
+    async def main():
+        result = []
+        sampler = {"expensive_interval": 0, "expensive": ["cwd"]}
+        async with serve(programs, sampler=sampler) as (aiovisor, client):
+            for url in ("/api/process/info/a", "/api/process/info/a?expensive=1"):
+                async with client.get(url) as response:
+                    info = await response.json()
+                    result.append(("cwd" in info["ps"], info["ps_expensive_time"]))
+        return result
+
+    (before, no_time), (after, time) = asyncio.run(main())
+    assert (before, no_time, after) == (False, None, True)
+    assert time is not None
+
+
+def test_metrics():
+    programs = {"a": {"command": "sleep 30"}, "b": {"command": "sleep 30"}}
+
+    async def main():
+        async with serve(programs) as (aiovisor, client):
+
+            async def scrape():
+                async with client.get("/api/metrics") as response:
+                    assert response.content_type == "text/plain"
+                    return await response.text()
+
+            running = await scrape()
+            await aiovisor.process("a").stop()
+            return running, await scrape()
+
+    running, stopped = asyncio.run(main())
+    for name, type_ in (
+        ("aiovisor_process_state", "gauge"),
+        ("aiovisor_process_restarts_total", "counter"),
+        ("aiovisor_up", "gauge"),
+        ("aiovisor_spawn_latency_seconds", "histogram"),
+    ):
+        assert f"# HELP {name} " in running
+        assert f"# TYPE {name} {type_}\n" in running
+    for name in ("a", "b"):
+        labels = f'program="{name}"'
+        assert f'aiovisor_process_state{{{labels},state="Running"}} 1\n' in running
+        assert f"aiovisor_process_restarts_total{{{labels}}} 0\n" in running
+        assert f"aiovisor_process_uptime_seconds{{{labels}}} " in running
+    # the cached lines of "a" are refreshed after its state change
+    assert 'aiovisor_process_state{program="a",state="Stopped"} 1\n' in stopped
+    assert 'aiovisor_process_state{program="a",state="Running"}' not in stopped
+    assert 'aiovisor_process_uptime_seconds{program="a"}' not in stopped
+    assert 'aiovisor_process_state{program="b",state="Running"} 1\n' in stopped
+
+
+def test_bulk_selectors():
+    programs = {
+        "web": {"command": "sleep 30", "numprocs": 2, "tags": ["web"]},
+        "worker": {"command": "sleep 30", "numprocs": 2, "tags": ["batch"]},
+        "db": {"command": "sleep 30"},
+    }
+    requests = [
+        "/api/group/web/stop",
+        "/api/processes/stop?match=worker-*",
+        "/api/processes/stop?tag=batch",
+        "/api/processes/start?tag=batch&match=*-1",
+        "/api/group/web/start?concurrency=1",
+    ]
+
+    async def main():
+        results = []
+        async with serve(programs) as (aiovisor, client):
+            for path in requests:
+                async with client.post(path) as response:
+                    result = await response.json()
+                processes = {
+                    name: (proc["result"], proc["state"])
+                    for name, proc in result["processes"].items()
+                }
+                procs = aiovisor.procs.items()
+                states = {name: proc.state.name for name, proc in procs}
+                results.append((result["result"], processes, states))
+        return results
+
+    stopped, running = ("ACK", "Stopped"), ("ACK", "Running")
+    web, workers, again, worker, web_start = asyncio.run(main())
+    assert web[:2] == ("ACK", {"web-0": stopped, "web-1": stopped})
+    assert web[2] == {
+        "web-0": "Stopped",
+        "web-1": "Stopped",
+        "worker-0": "Running",
+        "worker-1": "Running",
+        "db": "Running",
+    }
+    assert workers[:2] == ("ACK", {"worker-0": stopped, "worker-1": stopped})
+    assert workers[2]["db"] == "Running"
+    assert again[0] == "ERROR"
+    assert {result for result, _ in again[1].values()} == {"ERROR"}
+    assert worker[:2] == ("ACK", {"worker-1": running})
+    assert worker[2]["worker-0"] == "Stopped"
+    assert web_start[:2] == ("ACK", {"web-0": running, "web-1": running})